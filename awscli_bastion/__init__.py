@@ -5,3 +5,18 @@
 __author__ = """Aidan Melen"""
 __email__ = 'aidan.l.melen@gmail.com'
 __version__ = '0.9.5'
+
+
+def session(profile="bastion-sts", **kwargs):
+    """ Return a boto3 session for the profile whose credentials are refreshed in-process.
+
+    See :func:`awscli_bastion.refreshable.session` for the keyword arguments.
+    boto3 is only imported when this is called.
+
+    :param profile: The bastion-sts profile or an assume role profile.
+    :type profile: str
+    :return: The boto3 session.
+    :rtype: boto3.Session
+    """
+    from .refreshable import session as refreshable_session
+    return refreshable_session(profile, **kwargs)
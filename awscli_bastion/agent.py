@@ -0,0 +1,198 @@
+from . import expiration
+from .agent_client import get_socket_path
+from .cache import Cache, DEFAULT_REFRESH_WINDOW_IN_SECONDS
+from .credentials import Credentials
+from .sts import STS, ONE_HOUR_IN_SECONDS
+import click
+import os
+import socket
+import socketserver
+import threading
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """ Answer a single 'PROFILE\\n' request with the credential_process response. """
+
+    def handle(self):
+        profile = self.rfile.readline().decode("utf-8").strip()
+        try:
+            response = self.server.agent.get_credential_process_response(profile)
+        except Exception as e:
+            response = "ERROR {}\n".format(e).encode("utf-8")
+        self.wfile.write(response)
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Agent:
+    """ Serve bastion-sts and assume role credentials from memory over a unix socket. """
+
+    def __init__(self, bastion="bastion", bastion_sts="bastion-sts", region="us-west-2",
+        endpoint_url=None, regional_endpoints=None, socket_path=None, duration_seconds=ONE_HOUR_IN_SECONDS,
+        refresh_window=DEFAULT_REFRESH_WINDOW_IN_SECONDS, check_interval=30):
+        self.bastion_sts = bastion_sts
+        self.socket_path = socket_path or get_socket_path()
+        self.duration_seconds = duration_seconds
+        self.refresh_window = refresh_window
+        self.check_interval = check_interval
+
+        self.credentials = Credentials()
+        self.cache = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region)
+        self.sts = STS(
+            bastion=bastion,
+            bastion_sts=bastion_sts,
+            region=region,
+            credentials=self.credentials,
+            cache=self.cache,
+            endpoint_url=endpoint_url,
+            regional_endpoints=regional_endpoints
+        )
+
+        self._credentials_signature = self.credentials.backend.get_profiles_signature()
+        self._role_creds = {}
+        self._profile_locks = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+
+    def _get_profile_lock(self, profile):
+        with self._lock:
+            return self._profile_locks.setdefault(profile, threading.Lock())
+
+    def reload_if_changed(self):
+        """ Re-read the profiles when they have changed.
+
+        Cached assume role credentials are dropped for profiles whose 'role_arn' changed or that were removed.
+
+        :return: Whether or not the profiles were re-read.
+        :rtype: bool
+        """
+        signature = self.credentials.backend.get_profiles_signature()
+        if signature == self._credentials_signature:
+            return False
+
+        credentials = Credentials()
+        with self._lock:
+            for profile in list(self._role_creds):
+                if credentials.get(profile, "role_arn") != self.credentials.get(profile, "role_arn"):
+                    del self._role_creds[profile]
+            self.credentials = self.sts.credentials = credentials
+            self._credentials_signature = signature
+        return True
+
+    def _remaining_seconds(self, creds):
+        return expiration.get_remaining_seconds(expiration.to_epoch(creds["Expiration"]))
+
+    def get_credentials(self, profile):
+        """ Return the sts credentials for the bastion-sts profile or an assume role profile.
+
+        :param profile: The bastion-sts profile or an assume role profile.
+        :type profile: str
+        :raises RuntimeError: The bastion-sts credentials are expired, since the agent cannot prompt for the mfa code.
+        :return: sts credentials
+        :rtype: dict
+        """
+        if profile == self.bastion_sts:
+            if self.cache.is_expired():
+                raise RuntimeError("The bastion-sts cached credentials are expired. Run 'bastion get-session-token'.")
+            return self.cache.read()
+
+        creds = self._role_creds.get(profile)
+        if creds and self._remaining_seconds(creds) > self.refresh_window:
+            return creds
+        return self.refresh(profile)
+
+    def refresh(self, profile, lead_time=None):
+        """ Assume the role for the profile unless another thread already refreshed it.
+
+        :param profile: The assume role profile.
+        :type profile: str
+        :param lead_time: Refresh credentials that expire within this many seconds. Defaults to the refresh window.
+        :type lead_time: int
+        :return: sts credentials
+        :rtype: dict
+        """
+        lead_time = self.refresh_window if lead_time is None else lead_time
+        with self._get_profile_lock(profile):
+            creds = self._role_creds.get(profile)
+            if creds and self._remaining_seconds(creds) > lead_time:
+                return creds
+
+            creds = self.sts._assume_role(profile, duration_seconds=self.duration_seconds,
+                refresh_window=lead_time)
+            self._role_creds[profile] = creds
+            return creds
+
+    def get_credential_process_response(self, profile):
+        """ Return the credential_process json response for the profile.
+
+        :param profile: The bastion-sts profile or an assume role profile.
+        :type profile: str
+        :return: The credential_process json response.
+        :rtype: bytes
+        """
+        self.reload_if_changed()
+        return self.cache.to_credential_process_response(self.get_credentials(profile))
+
+    def _refresh_loop(self):
+        """ Refresh roles before they expire so that requests are answered from memory. """
+        lead_time = self.refresh_window + 2 * self.check_interval
+        while not self._stopped.wait(self.check_interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                click.echo("Failed to reload the aws shared credentials file: {}".format(e), err=True)
+
+            for profile in list(self._role_creds):
+                try:
+                    self.refresh(profile, lead_time=lead_time)
+                except Exception as e:
+                    click.echo("Failed to refresh the '{}' profile: {}".format(profile, e), err=True)
+
+    def _bind(self):
+        """ Bind the unix socket, replacing a stale socket left behind by an agent that is no longer running. """
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.socket_path)
+                except OSError:
+                    os.remove(self.socket_path)
+                else:
+                    raise RuntimeError("A bastion agent is already listening on {}.".format(self.socket_path))
+
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, mode=0o700)
+
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.agent = self
+
+    def serve_forever(self):
+        """ Answer requests on the unix socket until stopped. """
+        self._bind()
+        try:
+            self.sts._get_client()  # keep the sts client warm for the first request.
+        except Exception as e:
+            click.echo("Failed to create the sts client: {}".format(e), err=True)
+
+        refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+        refresher.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def stop(self):
+        """ Stop answering requests. Safe to call from another thread. """
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
@@ -0,0 +1,73 @@
+"""
+A tiny client for the bastion agent that is fast enough to be used as a credential_process.
+
+Only the standard library modules needed to talk to the agent's unix socket are imported::
+
+    [dev-admin]
+    credential_process = bastion-agent-client dev-admin
+"""
+
+import os
+import socket
+import sys
+
+
+def get_socket_path():
+    """ Return the unix socket the bastion agent listens on.
+
+    :return: The $BASTION_AGENT_SOCK environment variable or ~/.aws/cli/bastion-agent.sock.
+    :rtype: str
+    """
+    return os.environ.get("BASTION_AGENT_SOCK") or os.path.join(
+        os.path.expanduser("~"), ".aws", "cli", "bastion-agent.sock")
+
+
+def request(profile, socket_path=None, timeout=30):
+    """ Request the credential_process response for the profile from the bastion agent.
+
+    :param profile: The bastion-sts profile or an assume role profile.
+    :type profile: str
+    :param socket_path: The unix socket the bastion agent listens on.
+    :type socket_path: str
+    :param timeout: The number of seconds to wait for the agent.
+    :type timeout: int
+    :raises RuntimeError: The agent failed to get credentials for the profile.
+    :raises OSError: The agent is not running.
+    :return: The credential_process json response.
+    :rtype: bytes
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path or get_socket_path())
+        sock.sendall(profile.encode("utf-8") + b"\n")
+
+        chunks = []
+        chunk = sock.recv(65536)
+        while chunk:
+            chunks.append(chunk)
+            chunk = sock.recv(65536)
+
+    response = b"".join(chunks)
+    if response.startswith(b"ERROR "):
+        raise RuntimeError(response[6:].decode("utf-8").strip())
+    return response
+
+
+def main():
+    """ The entry point for awscli credential_process. """
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: bastion-agent-client PROFILE\n")
+        sys.exit(2)
+
+    try:
+        response = request(sys.argv[1])
+    except (OSError, RuntimeError) as e:
+        sys.stderr.write("The bastion agent failed to get credentials for the '{}' profile: {}\n".format(sys.argv[1], e))
+        sys.exit(1)
+
+    sys.stdout.buffer.write(response)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,567 @@
+""" Storage backends for the aws shared credentials profiles and the bastion credential cache.
+
+The 'file' backend is the default. It keeps the layout that awscli reads: the ~/.aws/credentials ini file
+and a file per cache entry in ~/.aws/cli/cache. The 'sqlite' backend keeps both in ~/.aws/cli/bastion.sqlite3,
+so single profiles are looked up and upserted without reading or rewriting every other profile.
+Select a backend with the $BASTION_BACKEND environment variable.
+"""
+
+from .lock import FileLock
+from configparser import ConfigParser, DEFAULTSECT
+import abc
+import io
+import json
+import marshal
+import os
+import pathlib
+import threading
+import time
+
+
+DEFAULT_BACKEND = "file"
+BACKENDS = ("file", "sqlite")
+
+INDEX_VERSION = 1
+
+
+def get_backend(name=None):
+    """ Return the storage backend.
+
+    :param name: The backend name. Defaults to $BASTION_BACKEND or 'file'.
+    :type name: str
+    :raises ValueError: The backend is unknown.
+    :return: The storage backend.
+    :rtype: Backend
+    """
+    name = name or os.environ.get("BASTION_BACKEND") or DEFAULT_BACKEND
+    if name == "file":
+        return FileBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    raise ValueError("Unknown backend '{}'. Expected one of: {}.".format(name, ", ".join(BACKENDS)))
+
+
+def _to_dict(config):
+    """ Return the raw values of every section, including the default section.
+
+    :param config: The parsed aws shared credentials file.
+    :type config: ConfigParser
+    :return: The attributes for each section.
+    :rtype: dict
+    """
+    sections = {config.default_section: dict(config.defaults())}
+    for section in config.sections():
+        sections[section] = {option: config.get(section, option, raw=True) for option in config.options(section)}
+    return sections
+
+
+def _apply(attributes, change):
+    """ Apply a profile change to a copy of the profile attributes.
+
+    :param attributes: The current profile attributes or None when the profile is not defined.
+    :type attributes: dict
+    :param change: The attributes to set and the attributes to remove.
+    :type change: tuple
+    :return: The changed profile attributes.
+    :rtype: dict
+    """
+    set_options, removed_options = change
+    attributes = dict(attributes or {})
+    attributes.update(set_options)
+    for option in removed_options:
+        attributes.pop(option, None)
+    return attributes
+
+
+def _atomic_write(path, content, mode=0o600, fsync=False):
+    """ Atomically write bytes to a file.
+
+    The content is written to a temporary file that replaces the destination file,
+    so concurrent readers never see a partially written file. A symlinked destination, e.g. from a dotfiles
+    repository, is written through, so the link is kept.
+
+    :param path: The file to write.
+    :type path: str
+    :param content: The file content.
+    :type content: bytes
+    :param mode: The file permissions.
+    :type mode: int
+    :param fsync: Whether or not to flush the file to disk before replacing the destination file.
+    :type fsync: bool
+    """
+    path = os.path.realpath(path)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb') as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Backend(abc.ABC):
+    """ The interface that Credentials and Cache use to store profiles and cache entries.
+
+    Profiles are dicts of raw attribute values, keyed by profile. The ini default section is stored as the 'DEFAULT' profile.
+    Profile changes are keyed by profile and are either None, to remove the profile,
+    or a tuple of the attributes to set and the attribute names to remove.
+    Cache entries are bytes keyed by name, e.g. 'bastion-sts.json'.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def load_profiles(self):
+        """ Return every profile.
+
+        :return: The attributes for each profile in the order they were added.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def load_config(self):
+        """ Return every profile as a config parser, which Credentials modifies before writing the changes.
+
+        :return: The profiles.
+        :rtype: ConfigParser
+        """
+        config = ConfigParser()
+        config.read_dict(self.load_profiles())
+        return config
+
+    @abc.abstractmethod
+    def get_profile(self, profile):
+        """ Return a single profile.
+
+        :param profile: The profile.
+        :type profile: str
+        :return: The profile attributes or None when the profile is not defined.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_profile_names(self):
+        """ Return the profile names, excluding the default section.
+
+        :return: The profiles in the order they were added.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_profiles_signature(self):
+        """ Return what identifies the current version of the profiles, to detect changes made by other processes.
+
+        :return: A value that changes whenever the profiles change.
+        :rtype: object
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def write_profiles(self, changes):
+        """ Apply profile changes on top of the latest stored profiles.
+
+        :param changes: None, or the attributes to set and remove, keyed by profile.
+        :type changes: dict
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_entry(self, name):
+        """ Read a cache entry.
+
+        :param name: The cache entry name.
+        :type name: str
+        :return: The cache entry or None when it does not exist.
+        :rtype: bytes
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_entry_signature(self, name):
+        """ Return what identifies the current version of a cache entry.
+
+        :param name: The cache entry name.
+        :type name: str
+        :return: A value that changes whenever the entry is written or None when it does not exist.
+        :rtype: object
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_entry_mtime(self, name):
+        """ Return when a cache entry was last written.
+
+        :param name: The cache entry name.
+        :type name: str
+        :return: The epoch seconds the entry was written or None when it does not exist.
+        :rtype: float
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def write_entry(self, name, content):
+        """ Write a cache entry that is only readable by the current user.
+
+        :param name: The cache entry name.
+        :type name: str
+        :param content: The cache entry.
+        :type content: bytes
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_entry(self, name):
+        """ Delete a cache entry.
+
+        :param name: The cache entry name.
+        :type name: str
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_entry_names(self):
+        """ Return the cache entry names.
+
+        :return: The cache entry names.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+
+class FileBackend(Backend):
+    """ Store profiles in the aws shared credentials file and cache entries as files in the aws shared cache directory.
+
+    Lookups are answered from a compiled index of the credentials file (~/.aws/cli/cache/bastion-credentials.index)
+    until the file changes.
+    """
+
+    name = "file"
+
+    def __init__(self, home=None):
+        home = home or pathlib.Path.home()
+        self.aws_shared_credentials_path = os.path.join(home, ".aws/credentials")
+        self.aws_shared_cache_path = os.path.join(home, ".aws/cli/cache")
+        self.aws_shared_credentials_index_path = os.path.join(self.aws_shared_cache_path, "bastion-credentials.index")
+        self._profiles = None
+        self._profiles_signature = None
+
+    def get_profiles_signature(self):
+        """ Return what identifies the current version of the aws shared credentials file.
+
+        :return: The (mtime, size, inode) of the file or None when it does not exist.
+        :rtype: tuple
+        """
+        try:
+            stat = os.stat(self.aws_shared_credentials_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def load_config(self):
+        """ Parse the aws shared credentials file and compile its index.
+
+        :return: The parsed aws shared credentials file.
+        :rtype: ConfigParser
+        """
+        signature = self.get_profiles_signature()
+        config = ConfigParser()
+        config.read(self.aws_shared_credentials_path)
+        self._profiles = _to_dict(config)
+        self._profiles_signature = signature
+        self._write_index(signature)
+        return config
+
+    def load_profiles(self):
+        """ Return every profile without parsing the aws shared credentials file when the index is current.
+
+        :return: The attributes for each profile in the order they are defined.
+        :rtype: dict
+        """
+        signature = self.get_profiles_signature()
+        if self._profiles is None or signature != self._profiles_signature:
+            profiles = self._read_index(signature)
+            if profiles is None:
+                self.load_config()
+            else:
+                self._profiles = profiles
+                self._profiles_signature = signature
+        return self._profiles
+
+    def get_profile(self, profile):
+        return self.load_profiles().get(profile)
+
+    def get_profile_names(self):
+        return [profile for profile in self.load_profiles() if profile != DEFAULTSECT]
+
+    def _write_index(self, signature):
+        """ Write the compiled index of the aws shared credentials file, only readable by the current user.
+
+        :param signature: The (mtime, size, inode) of the file that was parsed.
+        :type signature: tuple
+        """
+        if signature is None:
+            return
+        try:
+            if not os.path.isdir(self.aws_shared_cache_path):
+                os.makedirs(self.aws_shared_cache_path)
+            _atomic_write(self.aws_shared_credentials_index_path,
+                marshal.dumps((INDEX_VERSION, tuple(signature), self._profiles)))
+        except OSError:
+            pass    # the index is only an optimization.
+
+    def _read_index(self, signature):
+        """ Read the compiled index if it matches the current aws shared credentials file.
+
+        :param signature: The (mtime, size, inode) of the current file.
+        :type signature: tuple
+        :return: The attributes for each profile or None when the index is missing or stale.
+        :rtype: dict
+        """
+        try:
+            with open(self.aws_shared_credentials_index_path, 'rb') as f:
+                version, index_signature, profiles = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != INDEX_VERSION or signature is None or index_signature != tuple(signature):
+            return None
+        return profiles
+
+    def write_profiles(self, changes):
+        """ Merge the profile changes into the latest aws shared credentials file on disk.
+
+        The merge happens under a lock file, so concurrent bastion commands do not drop each other's profiles.
+        The file is replaced atomically, keeping its permissions, so readers never see a partially written file.
+
+        :param changes: None, or the attributes to set and remove, keyed by profile.
+        :type changes: dict
+        """
+        path = self.aws_shared_credentials_path
+        with FileLock(path + ".lock"):
+            config = ConfigParser()
+            config.read(path)
+
+            for profile, change in changes.items():
+                if change is None:
+                    config.remove_section(profile)
+                    continue
+                if profile != config.default_section and not config.has_section(profile):
+                    config.add_section(profile)
+                set_options, removed_options = change
+                for option, value in set_options.items():
+                    config.set(profile, option, value)
+                for option in removed_options:
+                    config.remove_option(profile, option)
+
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o600
+
+            content = io.StringIO()
+            config.write(content)
+            _atomic_write(path, content.getvalue().encode("utf-8"), mode=mode, fsync=True)
+
+            self._profiles = _to_dict(config)
+            self._profiles_signature = self.get_profiles_signature()
+            self._write_index(self._profiles_signature)
+
+    def _get_entry_path(self, name):
+        return os.path.join(self.aws_shared_cache_path, name)
+
+    def read_entry(self, name):
+        try:
+            with open(self._get_entry_path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_entry_signature(self, name):
+        """ Return the (mtime, size, inode) of the cache file.
+
+        The file is replaced atomically on write, so the inode changes along with the mtime.
+        """
+        try:
+            stat = os.stat(self._get_entry_path(name))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def get_entry_mtime(self, name):
+        try:
+            return os.stat(self._get_entry_path(name)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def write_entry(self, name, content):
+        if not os.path.isdir(self.aws_shared_cache_path):
+            os.makedirs(self.aws_shared_cache_path)
+        _atomic_write(self._get_entry_path(name), content)
+
+    def delete_entry(self, name):
+        try:
+            os.remove(self._get_entry_path(name))
+        except FileNotFoundError:
+            pass
+
+    def get_entry_names(self):
+        """ Return every file in the aws shared cache directory, including the awscli's own caches.
+
+        The compiled index of the aws shared credentials file belongs to the backend and is not a cache entry.
+        """
+        try:
+            names = os.listdir(self.aws_shared_cache_path)
+        except FileNotFoundError:
+            return []
+        index_name = os.path.basename(self.aws_shared_credentials_index_path)
+        return sorted(name for name in names if name != index_name)
+
+
+class SQLiteBackend(Backend):
+    """ Store profiles and cache entries in an sqlite database (~/.aws/cli/bastion.sqlite3).
+
+    The database uses write-ahead logging, so readers are not blocked while another process upserts a profile.
+    Each thread uses its own connection.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(pathlib.Path.home(), ".aws/cli/bastion.sqlite3")
+        self._local = threading.local()
+
+    def _connect(self):
+        """ Return this thread's connection, creating the database when it does not exist.
+
+        :return: The database connection.
+        :rtype: sqlite3.Connection
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+
+        import sqlite3
+
+        if not os.path.exists(self.path):
+            db_dir = os.path.dirname(self.path)
+            if db_dir and not os.path.isdir(db_dir):
+                os.makedirs(db_dir)
+            os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600))
+
+        # autocommit, so that write transactions are explicitly started with 'BEGIN IMMEDIATE'.
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS profiles "
+            "(name TEXT PRIMARY KEY, position INTEGER NOT NULL, attributes TEXT NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS profiles_position ON profiles (position)")
+        connection.execute("CREATE TABLE IF NOT EXISTS entries "
+            "(name TEXT PRIMARY KEY, content BLOB NOT NULL, version INTEGER NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._local.connection = connection
+        return connection
+
+    def load_profiles(self):
+        rows = self._connect().execute("SELECT name, attributes FROM profiles ORDER BY position")
+        profiles = {DEFAULTSECT: {}}
+        profiles.update((name, json.loads(attributes)) for name, attributes in rows)
+        return profiles
+
+    def get_profile(self, profile):
+        row = self._connect().execute("SELECT attributes FROM profiles WHERE name = ?", (profile,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_profile_names(self):
+        rows = self._connect().execute("SELECT name FROM profiles WHERE name != ? ORDER BY position", (DEFAULTSECT,))
+        return [name for name, in rows]
+
+    def get_profiles_signature(self):
+        """ Return the profiles version, which every write increments. """
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'profiles_version'").fetchone()
+        return row[0] if row else 0
+
+    def write_profiles(self, changes):
+        """ Upsert or delete only the changed profiles in a single transaction.
+
+        :param changes: None, or the attributes to set and remove, keyed by profile.
+        :type changes: dict
+        """
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for profile, change in changes.items():
+                if change is None:
+                    connection.execute("DELETE FROM profiles WHERE name = ?", (profile,))
+                    continue
+                attributes = _apply(self.get_profile(profile), change)
+                connection.execute(
+                    "INSERT INTO profiles (name, position, attributes) "
+                    "VALUES (?, (SELECT COALESCE(MAX(position), 0) + 1 FROM profiles), ?) "
+                    "ON CONFLICT (name) DO UPDATE SET attributes = excluded.attributes",
+                    (profile, json.dumps(attributes)))
+            connection.execute("INSERT INTO meta (key, value) VALUES ('profiles_version', 1) "
+                "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def read_entry(self, name):
+        row = self._connect().execute("SELECT content FROM entries WHERE name = ?", (name,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def get_entry_signature(self, name):
+        """ Return the version of the cache entry, which is the time it was written in nanoseconds. """
+        row = self._connect().execute("SELECT version FROM entries WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def get_entry_mtime(self, name):
+        version = self.get_entry_signature(name)
+        return None if version is None else version / 1e9
+
+    def write_entry(self, name, content):
+        self._connect().execute(
+            "INSERT INTO entries (name, content, version) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET content = excluded.content, version = excluded.version",
+            (name, content, int(time.time() * 1e9)))
+
+    def delete_entry(self, name):
+        self._connect().execute("DELETE FROM entries WHERE name = ?", (name,))
+
+    def get_entry_names(self):
+        return [name for name, in self._connect().execute("SELECT name FROM entries ORDER BY name")]
+
+
+def migrate(source, destination):
+    """ Copy every profile and bastion cache entry from one backend to another.
+
+    Profiles in the destination that are not in the source are removed,
+    so the destination ends up with exactly the source's profiles.
+
+    :param source: The backend to copy from.
+    :type source: Backend
+    :param destination: The backend to copy to.
+    :type destination: Backend
+    :return: The number of profiles and cache entries copied.
+    :rtype: tuple
+    """
+    profiles = source.load_profiles()
+    existing = destination.load_profiles()
+
+    changes = {profile: None for profile in existing if profile not in profiles}
+    for profile, attributes in profiles.items():
+        removed_options = [option for option in existing.get(profile, {}) if option not in attributes]
+        changes[profile] = (attributes, removed_options)
+    destination.write_profiles(changes)
+
+    entries = 0
+    for name in source.get_entry_names():
+        if not name.startswith("bastion-") or not name.endswith((".json", ".response")):
+            continue    # locks, temporary files, the credentials index and the awscli's own caches.
+        content = source.read_entry(name)
+        if content is not None:
+            destination.write_entry(name, content)
+            entries += 1
+
+    return len([profile for profile in profiles if profile != DEFAULTSECT]), entries
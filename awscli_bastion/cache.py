@@ -1,21 +1,115 @@
-from dateutil.tz import tzutc
-from dateutil.parser import parse
-from os.path import isfile
+from . import expiration, timings
+from .backends import get_backend
+from .credentials import Credentials
+from .lock import FileLock
 import click
 import datetime
-import humanize
+import hashlib
 import json
 import os
 import pathlib
+import re
 import sys
+import time
+
+
+DEFAULT_REFRESH_WINDOW_IN_SECONDS = 15 * 60
+
+# Version 2 stores every expiration as epoch seconds ('ExpirationEpoch') next to the iso 8601 'Expiration'.
+CACHE_VERSION = 2
+
+# the '-YYYY-MM-DD' suffix of the role session names from STS._get_role_session_name().
+ROLE_SESSION_DATE = re.compile(r"-\d{4}-\d{2}-\d{2}$")
 
 
 class Cache:
-    """ Manage the bastion-sts credential cache (~/.aws/cli/cache/bastion-sts.json). """
+    """ Manage the bastion-sts credential cache (~/.aws/cli/cache/bastion-sts-*.json)
+    and the assume role credential caches (~/.aws/cli/cache/bastion-role-*.json).
 
-    def __init__(self):
+    The bastion-sts cache is partitioned per bastion/bastion-sts profile pair and region,
+    so several bastions never overwrite each other's session token or wait on each other's refresh.
+    Each entry records the mfa serial it was issued for. When the mfa serial is known, entries issued for
+    another mfa device are treated as expired. The cache entries are stored by a backend, a file per entry by default.
+    """
+
+    # the unpartitioned entries written before the cache was partitioned. They are still read for the default profiles.
+    LEGACY_BASTION_STS = "bastion-sts.json"
+    LEGACY_BASTION_STS_RESPONSE = "bastion-sts.response"
+    LEGACY_BASTION_STS_IDENTITY = "bastion-sts-identity.json"
+
+    def __init__(self, bastion="bastion", bastion_sts="bastion-sts", region="us-west-2", mfa_serial=None, backend=None):
+        self.backend = backend or get_backend()
+        self.bastion = bastion
+        self.bastion_sts = bastion_sts
+        self.region = region
         self.aws_shared_cache_path = os.path.join(pathlib.Path.home(), ".aws/cli/cache")
-        self.bastion_sts_cache_path = os.path.join(self.aws_shared_cache_path, "bastion-sts.json")
+        self.mfa_serial = mfa_serial
+        self._partition = None
+        self._creds = None
+        self._signature = None
+
+    @property
+    def partition(self):
+        """ The cache entry prefix for the bastion/bastion-sts profile pair, e.g. 'bastion-sts-0123456789abcdef'.
+
+        It only depends on the profile names and region, so a cache hit never reads the aws shared credentials file.
+        """
+        if self._partition is None:
+            key = json.dumps([self.bastion, self.bastion_sts, self.region])
+            self._partition = "bastion-sts-{}".format(hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+        return self._partition
+
+    def _is_mfa_serial_current(self, mfa_serial):
+        """ Return whether or not an entry issued for the mfa serial may be used.
+
+        :param mfa_serial: The mfa serial recorded in the entry. Legacy entries do not record it.
+        :type mfa_serial: str
+        :rtype: bool
+        """
+        return not (self.mfa_serial and mfa_serial and mfa_serial != self.mfa_serial)
+
+    def _is_legacy_partition(self):
+        return self.bastion == "bastion" and self.bastion_sts == "bastion-sts"
+
+    def _resolve(self, name, legacy_name):
+        """ Return the partition's cache entry, or the legacy entry while only the legacy entry exists.
+
+        :param name: The partition's cache entry name.
+        :type name: str
+        :param legacy_name: The unpartitioned cache entry name.
+        :type legacy_name: str
+        :return: The cache entry name to read.
+        :rtype: str
+        """
+        if (self._is_legacy_partition() and self.backend.get_entry_signature(name) is None
+            and self.backend.get_entry_signature(legacy_name) is not None):
+            return legacy_name
+        return name
+
+    @property
+    def bastion_sts_cache_name(self):
+        return self._resolve(self.partition + ".json", self.LEGACY_BASTION_STS)
+
+    @property
+    def bastion_sts_response_cache_name(self):
+        return self._resolve(self.partition + ".response", self.LEGACY_BASTION_STS_RESPONSE)
+
+    @property
+    def bastion_sts_identity_cache_name(self):
+        return self._resolve(self.partition + "-identity.json", self.LEGACY_BASTION_STS_IDENTITY)
+
+    @property
+    def bastion_sts_cache_path(self):
+        """ The bastion-sts cache file for the file backend. """
+        return os.path.join(self.aws_shared_cache_path, self.bastion_sts_cache_name)
+
+    def _stat_signature(self):
+        """ Return what identifies the current version of the bastion-sts cache entry.
+
+        :return: The entry signature or None when it does not exist.
+        :rtype: object
+        """
+        return self.backend.get_entry_signature(self.bastion_sts_cache_name)
 
     def does_exist(self):
         """ Return whether or not the bastion-sts credential cache exists.
@@ -23,24 +117,21 @@ class Cache:
         :rtype: bool
         :return: Whether or not the bastion-sts credential cache exists.
         """
-        return isfile(self.bastion_sts_cache_path)
+        return self._stat_signature() is not None
 
+    @timings.timed("Cache.is_expired", cache_hit=lambda expired: not expired)
     def is_expired(self):
         """ Return whether or not the bastion-sts credentials are expired.
 
         :return: Whether or not the bastion-sts credentials are expired.
         :rtype: bool
         """
-        expired = False
-        if self.does_exist():
-            now_dt = datetime.datetime.now(tzutc())
-            expiration_iso = self.read()["Expiration"]
-            expiration_dt = parse(expiration_iso)
-            if now_dt > expiration_dt:
-                expired = True
-        else:
-            expired = True
-        return expired
+        if not self._stat_signature():
+            return True
+        creds = self.read()
+        if not self._is_mfa_serial_current((creds.get("Partition") or {}).get("MfaSerial")):
+            return True
+        return expiration.get_remaining_seconds(creds["ExpirationEpoch"]) < 0
 
     def get_expiration(self, human_readable=True):
         """ Return how much time until the bastion-sts credentials expire.
@@ -51,41 +142,446 @@ class Cache:
         :rtype: str
         """
         try:
-            expiration_iso = self.read()["Expiration"]
+            expiration_epoch = self.read()["ExpirationEpoch"]
         except KeyError:
-            click.echo("The {} profile did not have the 'aws_session_expiration' attribute.")
+            click.echo("The bastion-sts credential cache did not have the 'Expiration' attribute.")
             sys.exit(1)
 
-        expiration_dt = parse(expiration_iso)
-        now_dt = datetime.datetime.now(tzutc())
-        delta = now_dt - expiration_dt
-        return humanize.naturaltime(delta) if human_readable else delta
+        delta = datetime.timedelta(seconds=-expiration.get_remaining_seconds(expiration_epoch))
+        if not human_readable:
+            return delta
+
+        import humanize
+        return humanize.naturaltime(delta)
 
+    @timings.timed("Cache.write")
     def write(self, creds):
         """ Writes json formatted credentials to the bastion-sts cache file.
 
+        The credentials are written to a temporary file that replaces the cache file,
+        so concurrent readers never see a partially written file.
+        The mfa serial is looked up from the bastion-sts profile unless it is known.
+
         :param creds: bastion-sts short-lived credentials.
-        :type creds: bool
         :type creds: dict
-        """    
-        if not os.path.isdir(self.aws_shared_cache_path):
-            os.makedirs(self.aws_shared_cache_path)
+        """
+        if self.mfa_serial is None:
+            self.mfa_serial = Credentials(self.backend).get(self.bastion_sts, "mfa_serial")
+
+        creds["Version"] = CACHE_VERSION
+        creds["ExpirationEpoch"] = expiration.to_epoch(creds["Expiration"])
+        creds["Partition"] = {
+            "Bastion": self.bastion,
+            "BastionSts": self.bastion_sts,
+            "MfaSerial": self.mfa_serial,
+            "Region": self.region
+        }
+        self._write_json(self.partition + ".json", creds)
+        if self._is_legacy_partition():
+            # the partition supersedes the legacy entries.
+            for name in (self.LEGACY_BASTION_STS, self.LEGACY_BASTION_STS_RESPONSE, self.LEGACY_BASTION_STS_IDENTITY):
+                self.backend.delete_entry(name)
+
+        self._creds = creds
+        self._signature = self._stat_signature()
+        self.write_response(creds)
+
+    def write_response(self, creds):
+        """ Write the precomputed credential_process response for the bastion-sts credentials.
+
+        The response is prefixed with its expiration as epoch seconds and the mfa serial it was issued for,
+        so a cache hit only compares an integer to the current time.
+
+        :param creds: bastion-sts short-lived credentials.
+        :type creds: dict
+        """
+        expiration_epoch = creds.get("ExpirationEpoch") or expiration.to_epoch(creds["Expiration"])
+        mfa_serial = (creds.get("Partition") or {}).get("MfaSerial") or self.mfa_serial
+        header = "{} {}".format(expiration_epoch, mfa_serial) if mfa_serial else str(expiration_epoch)
+        response = (header + "\n").encode("utf-8") + self.to_credential_process_response(creds)
+        self.backend.write_entry(self.partition + ".response", response)
+
+    @staticmethod
+    def _split_response(content):
+        """ Split a precomputed response into its header and the credential_process response.
+
+        :param content: The precomputed response cache entry.
+        :type content: bytes
+        :raises ValueError: The header does not start with the expiration.
+        :return: The expiration as epoch seconds, the mfa serial or None and the credential_process response.
+        :rtype: tuple
+        """
+        header, _, response = content.partition(b"\n")
+        expiration_epoch, _, mfa_serial = header.partition(b" ")
+        return int(expiration_epoch), mfa_serial.decode("utf-8") or None, response
+
+    @staticmethod
+    def to_credential_process_response(creds):
+        """ Return the json formatted credentials that awscli expects from a credential_process.
+
+        :param creds: bastion-sts short-lived credentials.
+        :type creds: dict
+        :return: The credential_process response.
+        :rtype: bytes
+        """
+        return json.dumps({
+            "Version": 1,
+            "AccessKeyId": creds["AccessKeyId"],
+            "SecretAccessKey": creds["SecretAccessKey"],
+            "SessionToken": creds["SessionToken"],
+            "Expiration": creds["Expiration"]
+        }, indent=4).encode("utf-8")
 
-        with open(self.bastion_sts_cache_path, 'w+') as f:
-            creds["Version"] = 1
-            json.dump(creds, f, indent=4)
+    @timings.timed("Cache.read_response", cache_hit=lambda result: result is not None)
+    def read_response(self):
+        """ Read the precomputed credential_process response without parsing it.
 
+        :return: The credential_process response or None when it is missing or expired.
+        :rtype: bytes
+        """
+        try:
+            expiration_epoch, mfa_serial, response = self._split_response(
+                self.backend.read_entry(self.bastion_sts_response_cache_name) or b"")
+        except (OSError, ValueError):
+            return None
+        if time.time() >= expiration_epoch or not self._is_mfa_serial_current(mfa_serial):
+            return None
+        return response or None
+
+    @timings.timed("Cache.read")
     def read(self):
-        """ Reads json formatted credentials to the bastion-sts cache file. """
-        with open(self.bastion_sts_cache_path, 'r') as f:
-            return json.load(f)
-
-    def delete(self):
-        """ Deletes the cache files in the aws shared cache directory.  """
-        cache_files = os.listdir(self.aws_shared_cache_path)
-        if cache_files:
-            for cache in os.listdir(self.aws_shared_cache_path):
-                os.remove(os.path.join(self.aws_shared_cache_path, cache))
-                click.echo("- Deleted the '{}' file.".format(cache))
+        """ Reads json formatted credentials from the bastion-sts cache file.
+
+        The file is parsed at most once per process unless its mtime changes.
+        Version 1 files, which only have the iso 8601 'Expiration', are upgraded in memory.
+
+        :return: bastion-sts short-lived credentials.
+        :rtype: dict
+        """
+        signature = self._stat_signature()
+        if self._creds is None or signature != self._signature:
+            name = self.bastion_sts_cache_name
+            content = self.backend.read_entry(name)
+            if content is None:
+                raise FileNotFoundError("The {} cache entry does not exist.".format(name))
+            creds = json.loads(content)
+            if "ExpirationEpoch" not in creds:
+                creds["ExpirationEpoch"] = expiration.to_epoch(creds["Expiration"])
+            self._creds = creds
+            self._signature = signature
+        return self._creds
+
+    def _write_json(self, name, data):
+        """ Write a json cache entry that is only readable by the current user.
+
+        The file backend writes a temporary file that replaces the cache file,
+        so concurrent readers never see a partially written file.
+
+        :param name: The cache entry name.
+        :type name: str
+        :param data: The json serializable data.
+        :type data: dict
+        """
+        self.backend.write_entry(name, json.dumps(data, indent=4).encode("utf-8"))
+
+    def _read_json(self, name):
+        """ Read a json cache entry.
+
+        :param name: The cache entry name.
+        :type name: str
+        :raises ValueError: The cache entry does not exist or is not json.
+        :return: The cache entry.
+        :rtype: dict
+        """
+        content = self.backend.read_entry(name)
+        if content is None:
+            raise ValueError("The {} cache entry does not exist.".format(name))
+        return json.loads(content)
+
+    def get_lock(self):
+        """ Return the lock that serializes refreshing the bastion-sts credentials across processes.
+
+        Each partition has its own lock, so refreshing one bastion never blocks another.
+
+        :return: The bastion-sts cache lock.
+        :rtype: FileLock
+        """
+        return FileLock(os.path.join(self.aws_shared_cache_path, self.partition + ".json.lock"))
+
+    @timings.timed("Cache.read_identity", cache_hit=lambda result: result is not None)
+    def read_identity(self):
+        """ Read the cached bastion iam user identity.
+
+        :return: The 'UserName', 'Account' and 'Arn' of the bastion iam user or None when it is missing or expired.
+        :rtype: dict
+        """
+        try:
+            identity = self._read_json(self.bastion_sts_identity_cache_name)
+            expiration_epoch = identity.get("ExpirationEpoch") or expiration.to_epoch(identity["Expiration"])
+            expired = expiration.get_remaining_seconds(expiration_epoch) < 0
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return None if expired else identity
+
+    @timings.timed("Cache.write_identity")
+    def write_identity(self, identity, expiration_iso):
+        """ Write the bastion iam user identity with the lifetime of the bastion-sts credentials.
+
+        :param identity: The 'UserName', 'Account' and 'Arn' of the bastion iam user.
+        :type identity: dict
+        :param expiration_iso: The iso 8601 formatted expiration of the bastion-sts credentials.
+        :type expiration_iso: str
+        """
+        self._write_json(self.partition + "-identity.json", dict(
+            identity,
+            Version=CACHE_VERSION,
+            Expiration=expiration_iso,
+            ExpirationEpoch=expiration.to_epoch(expiration_iso)
+        ))
+
+    def get_role_cache_name(self, role_arn, role_session_name, duration_seconds):
+        """ Return the assume role credential cache entry for the given sts.assume_role() arguments.
+
+        The date the role session name is stamped with is left out, so cached credentials are still found after midnight.
+
+        :param role_arn: The arn of the assumed role.
+        :type role_arn: str
+        :param role_session_name: The role session name.
+        :type role_session_name: str
+        :param duration_seconds: The duration, in seconds, that the credentials remain valid.
+        :type duration_seconds: int
+        :return: The assume role credential cache entry name.
+        :rtype: str
+        """
+        key = json.dumps([role_arn, ROLE_SESSION_DATE.sub("", role_session_name), int(duration_seconds)])
+        return "bastion-role-{}.json".format(hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    @timings.timed("Cache.read_role", cache_hit=lambda result: result is not None)
+    def read_role(self, role_arn, role_session_name, duration_seconds,
+        refresh_window=DEFAULT_REFRESH_WINDOW_IN_SECONDS):
+        """ Read cached assume role credentials that are valid for longer than the refresh window.
+
+        :param role_arn: The arn of the assumed role.
+        :type role_arn: str
+        :param role_session_name: The role session name.
+        :type role_session_name: str
+        :param duration_seconds: The duration, in seconds, that the credentials remain valid.
+        :type duration_seconds: int
+        :param refresh_window: Credentials that expire within this many seconds are not returned.
+        :type refresh_window: int
+        :return: The cached sts credentials or None when they are missing or due for a refresh.
+        :rtype: dict
+        """
+        name = self.get_role_cache_name(role_arn, role_session_name, duration_seconds)
+        try:
+            role_cache = self._read_json(name)
+            creds = role_cache["Credentials"]
+            expiration_epoch = role_cache.get("ExpirationEpoch") or expiration.to_epoch(creds["Expiration"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        return creds if expiration.get_remaining_seconds(expiration_epoch) > refresh_window else None
+
+    @timings.timed("Cache.write_role")
+    def write_role(self, role_arn, role_session_name, duration_seconds, creds):
+        """ Write assume role credentials to their cache entry.
+
+        :param role_arn: The arn of the assumed role.
+        :type role_arn: str
+        :param role_session_name: The role session name.
+        :type role_session_name: str
+        :param duration_seconds: The duration, in seconds, that the credentials remain valid.
+        :type duration_seconds: int
+        :param creds: The sts credentials with an iso 8601 formatted 'Expiration'.
+        :type creds: dict
+        """
+        name = self.get_role_cache_name(role_arn, role_session_name, duration_seconds)
+        self._write_json(name, {
+            "Version": CACHE_VERSION,
+            "ExpirationEpoch": expiration.to_epoch(creds["Expiration"]),
+            "RoleArn": role_arn,
+            "RoleSessionName": role_session_name,
+            "DurationSeconds": int(duration_seconds),
+            "Credentials": creds
+        })
+
+    def get_expirations(self):
+        """ Return when each credential cache entry expires, including the awscli's own assume role caches
+        when they share the file backend's cache directory.
+
+        :return: The entry name and its expiration as epoch seconds, keyed by cache entry name.
+        :rtype: dict
+        """
+        expirations = {}
+        for entry_name in self.backend.get_entry_names():
+            if not entry_name.endswith(".json") or entry_name.endswith("-identity.json"):
+                continue
+            try:
+                data = self._read_json(entry_name)
+                creds = data.get("Credentials", data)
+                expiration_epoch = data.get("ExpirationEpoch") or expiration.to_epoch(creds["Expiration"])
+            except (OSError, ValueError, KeyError, TypeError, AttributeError, OverflowError):
+                continue
+            partition = data.get("Partition")
+            if data.get("RoleArn"):
+                name = data["RoleArn"]
+            elif isinstance(partition, dict):
+                name = "{} ({})".format(partition.get("BastionSts"), partition.get("Region"))
+            else:
+                name = entry_name[:-len(".json")]
+            expirations[entry_name] = (name, expiration_epoch)
+        return expirations
+
+    def get_entry_expiration(self, name):
+        """ Return when the credentials in a cache entry expire.
+
+        :param name: The cache entry name.
+        :type name: str
+        :return: The expiration as epoch seconds or None when the entry does not hold credentials.
+        :rtype: int
+        """
+        try:
+            if name.endswith(".response"):
+                return self._split_response(self.backend.read_entry(name) or b"")[0]
+            if name.endswith(".json"):
+                data = self._read_json(name)
+                creds = data.get("Credentials", data)
+                return data.get("ExpirationEpoch") or expiration.to_epoch(creds["Expiration"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, OverflowError):
+            pass
+        return None
+
+    def get_entry_names(self, role_arns=(), bastion_sts=False):
+        """ Return the cache entries for the given roles and, optionally, the bastion-sts credentials.
+
+        The bastion-sts cache entries of every region are included, since the partitions of other regions
+        would otherwise survive a clear.
+
+        :param role_arns: The arns of the assumed roles.
+        :type role_arns: list
+        :param bastion_sts: Whether or not to include the bastion-sts cache entries.
+        :type bastion_sts: bool
+        :return: The cache entry names.
+        :rtype: list
+        """
+        entry_names = self.backend.get_entry_names()
+        partitions = {self.partition}
+        for name in entry_names if bastion_sts else ():
+            if name.startswith("bastion-sts-") and name.endswith(".json") and not name.endswith("-identity.json"):
+                try:
+                    partition = self._read_json(name).get("Partition") or {}
+                except (OSError, ValueError, AttributeError):
+                    continue
+                if partition.get("Bastion") == self.bastion and partition.get("BastionSts") == self.bastion_sts:
+                    partitions.add(name[:-len(".json")])
+
+        bastion_sts_names = [partition + suffix for partition in partitions
+            for suffix in (".json", ".response", "-identity.json")]
+        if self._is_legacy_partition():
+            bastion_sts_names.extend([
+                self.LEGACY_BASTION_STS, self.LEGACY_BASTION_STS_RESPONSE, self.LEGACY_BASTION_STS_IDENTITY])
+
+        names = []
+        for name in entry_names:
+            if name in bastion_sts_names:
+                if bastion_sts:
+                    names.append(name)
+            elif role_arns and name.startswith("bastion-role-") and name.endswith(".json"):
+                try:
+                    if self._read_json(name).get("RoleArn") in role_arns:
+                        names.append(name)
+                except (OSError, ValueError, AttributeError):
+                    continue
+        return names
+
+    def _delete_entry(self, name, dry_run=False):
+        if dry_run:
+            click.echo("- Would delete the '{}' file.".format(name))
         else:
+            self.backend.delete_entry(name)
+            click.echo("- Deleted the '{}' file.".format(name))
+
+    @timings.timed("Cache.delete")
+    def delete(self, entry_names=None, expired_only=False, older_than=None, dry_run=False):
+        """ Deletes the cache entries, which are the files in the aws shared cache directory for the file backend.
+
+        Lock files are never deleted, since another process may hold them.
+
+        :param entry_names: Only delete these cache entries. Defaults to every cache entry.
+        :type entry_names: list
+        :param expired_only: Only delete cache entries with credentials that have expired.
+        :type expired_only: bool
+        :param older_than: Only delete cache entries written more than this many seconds ago.
+        :type older_than: int
+        :param dry_run: Only output which cache entries would be deleted.
+        :type dry_run: bool
+        :return: The deleted cache entries.
+        :rtype: list
+        """
+        if entry_names is None:
+            entry_names = self.backend.get_entry_names()
+
+        deleted = []
+        for name in entry_names:
+            if name.endswith(".lock"):
+                continue
+            if expired_only:
+                expiration_epoch = self.get_entry_expiration(name)
+                if expiration_epoch is None or expiration.get_remaining_seconds(expiration_epoch) >= 0:
+                    continue
+            if older_than is not None:
+                mtime = self.backend.get_entry_mtime(name)
+                if mtime is None or time.time() - mtime <= older_than:
+                    continue
+            self._delete_entry(name, dry_run)
+            deleted.append(name)
+
+        if not deleted:
+            click.echo("- No cache files to delete.")
+        return deleted
+
+    @timings.timed("Cache.gc")
+    def gc(self, max_entries=None, max_age=None, dry_run=False):
+        """ Prune stale cache entries without deleting credentials that have not expired.
+
+        Entries written more than max_age seconds ago are deleted first. Then the oldest entries are deleted
+        until at most max_entries remain, unless only unexpired credentials are left. Lock files are never deleted.
+
+        :param max_entries: The maximum number of cache entries to keep.
+        :type max_entries: int
+        :param max_age: The maximum age, in seconds, of cache entries to keep.
+        :type max_age: int
+        :param dry_run: Only output which cache entries would be deleted.
+        :type dry_run: bool
+        :return: The deleted cache entries.
+        :rtype: list
+        """
+        now = time.time()
+        entries = []
+        for name in self.backend.get_entry_names():
+            if name.endswith(".lock"):
+                continue
+            mtime = self.backend.get_entry_mtime(name)
+            if mtime is not None:
+                entries.append((mtime, name))
+        entries.sort()
+
+        deleted = []
+        remaining = len(entries)
+        for mtime, name in entries:
+            is_too_old = max_age is not None and now - mtime > max_age
+            is_too_many = max_entries is not None and remaining > max_entries
+            if not (is_too_old or is_too_many):
+                continue
+
+            expiration_epoch = self.get_entry_expiration(name)
+            if expiration_epoch is not None and expiration_epoch > now:
+                continue    # live credentials are kept regardless of the limits.
+
+            self._delete_entry(name, dry_run)
+            deleted.append(name)
+            remaining -= 1
+
+        if not deleted:
             click.echo("- No cache files to delete.")
+        return deleted
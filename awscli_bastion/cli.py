@@ -1,22 +1,44 @@
 """ Manage the command line interface. """
 
 
+from . import metrics, timings
 from datetime import timedelta
 from .credentials import Credentials
-from .cache import Cache
+from .cache import Cache, DEFAULT_REFRESH_WINDOW_IN_SECONDS
 from .sts import STS
 from .rotate import Rotate
 import sys
 import click
-import humanize
-import json
 import time
 
 
 @click.group()
 @click.version_option()
-def main():
+@click.option("--timings", "timings_enabled", help="Output a json line with the duration of each phase to stderr. Also enabled by $BASTION_TIMINGS=1.", is_flag=True, envvar="BASTION_TIMINGS")
+@click.option("--timings-file", help="Append the timings to this file instead of stderr. Also set by $BASTION_TIMINGS_FILE.", envvar="BASTION_TIMINGS_FILE", default=None)
+@click.option("--metrics-file", help="Append cache hit, sts call latency and credential lifetime metrics to this file. Also set by $BASTION_METRICS_FILE.", envvar="BASTION_METRICS_FILE", default=None)
+@click.option("--profile-out", help="Profile the command, write the pstats file here and output the slowest functions to stderr. Also set by $BASTION_PROFILE_OUT.", envvar="BASTION_PROFILE_OUT", default=None)
+@click.pass_context
+def main(ctx, timings_enabled, timings_file, metrics_file, profile_out):
     """ The main entry point for the cli. """
+    if metrics_file and ctx.invoked_subcommand != "stats":
+        metrics.enable(metrics_file)
+        ctx.call_on_close(metrics.disable)
+
+    if timings_enabled or timings_file:
+        timings.enable(path=timings_file, command=ctx.invoked_subcommand)
+        started_at = time.perf_counter()
+
+        def emit_command_timing():
+            timings.emit("command", time.perf_counter() - started_at)
+            timings.disable()
+
+        ctx.call_on_close(emit_command_timing)
+
+    if profile_out:
+        from . import profiling
+        profiler = profiling.start()
+        ctx.call_on_close(lambda: profiling.stop(profiler, profile_out))
     return 0
 
 
@@ -27,58 +49,236 @@ def main():
 @click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
 @click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
 @click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+@click.option("--sts-endpoint-url", help="The sts endpoint to call. Defaults to the profile's 'sts_endpoint_url' attribute or the probed endpoint.", default=None)
+@click.option("--sts-regional-endpoints", help="Call the 'regional' sts endpoint of the region or the 'legacy' global endpoint.", type=click.Choice(["regional", "legacy"]), default=None)
 @click.option('--write-to-aws-shared-credentials-file', is_flag=True)
 def get_session_token(duration_seconds, mfa_serial, mfa_code,
-    bastion, bastion_sts, region, write_to_aws_shared_credentials_file):
+    bastion, bastion_sts, region, sts_endpoint_url, sts_regional_endpoints, write_to_aws_shared_credentials_file):
     """Output the bastion-sts short-lived credentials from sts.get_session_token(). """
+    cache = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region, mfa_serial=mfa_serial)
+    if not mfa_code and not write_to_aws_shared_credentials_file:
+        response = cache.read_response()
+        if response:
+            if metrics.is_enabled():
+                import json
+                metrics.cache_lookup(bastion_sts, "session", True, json.loads(response))
+            # stdout for awscli credential_process, straight from the cache.
+            click.echo(response)
+            return None
+
     credentials = Credentials()
-    cache = Cache()
     sts = STS(
         bastion=bastion,
         bastion_sts=bastion_sts,
         region=region,
         credentials=credentials,
-        cache=cache
+        cache=cache,
+        endpoint_url=sts_endpoint_url,
+        regional_endpoints=sts_regional_endpoints
     )
     sts_creds = sts.get_session_token(mfa_code=mfa_code, mfa_serial=mfa_serial, duration_seconds=duration_seconds)
+    sts.retrier.report()
 
     if write_to_aws_shared_credentials_file:
-        credentials.config[bastion_sts]["aws_access_key_id"] = sts_creds["AccessKeyId"]
-        credentials.config[bastion_sts]["aws_secret_access_key"] = sts_creds["SecretAccessKey"]
-        credentials.config[bastion_sts]["aws_session_token"] = sts_creds["SessionToken"]
-        credentials.config[bastion_sts]["aws_session_expiration"] = sts_creds["Expiration"]
+        credentials.set_sts_credentials(bastion_sts, sts_creds)
         credentials.write()
         click.echo("Setting the '{}' profile with sts get session token credentials.".format(bastion_sts))
     else:
+        if not mfa_code and not cache.read_response():
+            cache.write_response(sts_creds)  # the cache predates the precomputed response.
+
         # stdout for awscli credential_process
-        click.echo(json.dumps(sts_creds, indent=4))
+        click.echo(cache.to_credential_process_response(sts_creds))
+
+    return None
+
+
+@click.command()
+@click.argument("profiles", nargs=-1)
+@click.option("--all", "all_profiles", help="Assume every profile with a 'role_arn' attribute.", is_flag=True)
+@click.option("--duration-seconds", help="The duration, in seconds, that the credentials should remain valid.", default=timedelta(hours=1).seconds)
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
+@click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
+@click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+@click.option("--sts-endpoint-url", help="The sts endpoint to call. Defaults to the profile's 'sts_endpoint_url' attribute or the probed endpoint.", default=None)
+@click.option("--sts-regional-endpoints", help="Call the 'regional' sts endpoint of the region or the 'legacy' global endpoint.", type=click.Choice(["regional", "legacy"]), default=None)
+@click.option("--refresh-window", help="Reuse cached credentials unless they expire within this many seconds.", default=DEFAULT_REFRESH_WINDOW_IN_SECONDS)
+@click.option("--max-workers", help="The maximum number of concurrent sts.assume_role() calls.", default=8)
+def assume_role(profiles, all_profiles, duration_seconds, bastion, bastion_sts, region, sts_endpoint_url,
+    sts_regional_endpoints, refresh_window, max_workers):
+    """Set the profiles with short-lived credentials from sts.assume_role().
+
+    PROFILES may be profile names or glob patterns, such as 'dev-*'.
+    """
+    credentials = Credentials()
+    role_profiles = credentials.get_role_profiles()
+
+    if all_profiles:
+        profiles = role_profiles
+    elif not profiles:
+        raise click.UsageError("Provide at least one PROFILE or the --all option.")
+    else:
+        profiles = _expand_profiles(profiles, role_profiles)
+
+    sts = STS(
+        bastion=bastion,
+        bastion_sts=bastion_sts,
+        region=region,
+        credentials=credentials,
+        cache=Cache(bastion=bastion, bastion_sts=bastion_sts, region=region),
+        endpoint_url=sts_endpoint_url,
+        regional_endpoints=sts_regional_endpoints
+    )
+    results = sts.assume_roles(profiles, duration_seconds=duration_seconds,
+        refresh_window=refresh_window, max_workers=max_workers)
+
+    failed = [profile for profile, result in results.items() if isinstance(result, Exception)]
+    for profile, result in results.items():
+        if profile not in failed:
+            credentials.set_sts_credentials(profile, result)
+
+    if len(failed) < len(results):
+        credentials.write()
+
+    for profile, result in results.items():
+        if profile in failed:
+            click.echo("Failed to set the '{}' profile with sts assume role credentials: {}".format(profile, result))
+        else:
+            click.echo("Setting the '{}' profile with sts assume role credentials.".format(profile))
+
+    sts.retrier.report()
+    if failed:
+        sys.exit(1)
 
     return None
 
 
+def _expand_profiles(patterns, role_profiles):
+    """ Expand glob patterns into the matching assume role profiles.
+
+    :param patterns: Profile names or glob patterns.
+    :type patterns: tuple
+    :param role_profiles: The profiles with a 'role_arn' attribute.
+    :type role_profiles: list
+    :return: The unique profiles in the order they were given.
+    :rtype: list
+    """
+    import fnmatch
+
+    profiles = []
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            matches = fnmatch.filter(role_profiles, pattern)
+            if not matches:
+                raise click.UsageError("No profiles with a 'role_arn' attribute match '{}'.".format(pattern))
+        else:
+            matches = [pattern]
+
+        profiles.extend(profile for profile in matches if profile not in profiles)
+    return profiles
+
+
 @click.command()
 @click.argument("profile")
+@click.option("--shell", help="The format of the output.", type=click.Choice(["bash", "fish", "json"]), default="bash")
 @click.option("--duration-seconds", help="The duration, in seconds, that the credentials should remain valid.", default=timedelta(hours=1).seconds)
+@click.option("--refresh-window", help="Reuse cached credentials unless they expire within this many seconds.", default=DEFAULT_REFRESH_WINDOW_IN_SECONDS)
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
 @click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
 @click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
-def assume_role(profile, duration_seconds, bastion_sts, region):
-    """Set the profile with short-lived credentials from sts.assume_role(). """
+@click.option("--sts-endpoint-url", help="The sts endpoint to call. Defaults to the profile's 'sts_endpoint_url' attribute or the probed endpoint.", default=None)
+@click.option("--sts-regional-endpoints", help="Call the 'regional' sts endpoint of the region or the 'legacy' global endpoint.", type=click.Choice(["regional", "legacy"]), default=None)
+def env(profile, shell, duration_seconds, refresh_window, bastion, bastion_sts, region, sts_endpoint_url,
+    sts_regional_endpoints):
+    """ Output environment variables with the profile's short-lived credentials.
+
+    The credentials come from the cache and sts is only called when they are stale.
+    The aws shared credentials file is never written. For example: eval "$(bastion env dev-admin)"
+    """
     credentials = Credentials()
+    cache = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region)
     sts = STS(
+        bastion=bastion,
         bastion_sts=bastion_sts,
         region=region,
-        credentials=credentials
+        credentials=credentials,
+        cache=cache,
+        endpoint_url=sts_endpoint_url,
+        regional_endpoints=sts_regional_endpoints
     )
-    sts_creds = sts.assume_role(profile, duration_seconds=duration_seconds)
 
-    credentials.config[profile]["aws_access_key_id"] = sts_creds["AccessKeyId"]
-    credentials.config[profile]["aws_secret_access_key"] = sts_creds["SecretAccessKey"]
-    credentials.config[profile]["aws_session_token"] = sts_creds["SessionToken"]
-    credentials.config[profile]["aws_session_expiration"] = sts_creds["Expiration"].isoformat()
-    credentials.write()
+    # errors go to stderr, so the shell never evaluates them.
+    try:
+        if profile == bastion_sts:
+            sts_creds = sts._get_session_token()
+        else:
+            sts_creds = sts._assume_role(profile, duration_seconds=duration_seconds, refresh_window=refresh_window)
+    except Exception as e:
+        click.echo(e, err=True)
+        sys.exit(1)
+
+    click.echo(_format_env({
+        "AWS_ACCESS_KEY_ID": sts_creds["AccessKeyId"],
+        "AWS_SECRET_ACCESS_KEY": sts_creds["SecretAccessKey"],
+        "AWS_SESSION_TOKEN": sts_creds["SessionToken"],
+        "AWS_CREDENTIAL_EXPIRATION": sts_creds["Expiration"]
+    }, shell))
+    return None
+
+
+def _format_env(variables, shell):
+    """ Format environment variables for the shell to evaluate.
 
-    click.echo("Setting the '{}' profile with sts assume role credentials.".format(profile))
+    :param variables: The environment variable names and values.
+    :type variables: dict
+    :param shell: Either 'bash', 'fish' or 'json'.
+    :type shell: str
+    :return: The formatted environment variables.
+    :rtype: str
+    """
+    if shell == "json":
+        import json
+        return json.dumps(variables, indent=4)
+
+    from shlex import quote
+    line = "set -gx {} {};" if shell == "fish" else "export {}={}"
+    return "\n".join(line.format(name, quote(value)) for name, value in variables.items())
+
+
+@click.command()
+@click.argument("profile")
+@click.option("--duration-seconds", help="The duration, in seconds, that the credentials should remain valid.", default=timedelta(hours=1).seconds)
+@click.option("--refresh-window", help="Reuse cached credentials unless they expire within this many seconds.", default=DEFAULT_REFRESH_WINDOW_IN_SECONDS)
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
+@click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
+@click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+@click.option("--sts-endpoint-url", help="The sts endpoint to call. Defaults to the profile's 'sts_endpoint_url' attribute or the probed endpoint.", default=None)
+@click.option("--sts-regional-endpoints", help="Call the 'regional' sts endpoint of the region or the 'legacy' global endpoint.", type=click.Choice(["regional", "legacy"]), default=None)
+def credential_process(profile, duration_seconds, refresh_window, bastion, bastion_sts, region, sts_endpoint_url,
+    sts_regional_endpoints):
+    """ Output the profile's assume role credentials for awscli credential_process.
 
+    The role is assumed with the cached bastion-sts credentials and the result is cached per role,
+    so the aws shared credentials file is never written.
+    """
+    sts = STS(
+        bastion=bastion,
+        bastion_sts=bastion_sts,
+        region=region,
+        credentials=Credentials(),
+        cache=Cache(bastion=bastion, bastion_sts=bastion_sts, region=region),
+        source_cache=True,
+        endpoint_url=sts_endpoint_url,
+        regional_endpoints=sts_regional_endpoints
+    )
+    try:
+        sts_creds = sts._assume_role(profile, duration_seconds=duration_seconds, refresh_window=refresh_window)
+    except Exception as e:
+        click.echo(e, err=True)
+        sys.exit(1)
+
+    # stdout for awscli credential_process
+    click.echo(sts.cache.to_credential_process_response(sts_creds))
     return None
 
 
@@ -95,11 +295,15 @@ def set_default(profile):
 
 
 @click.command()
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
 @click.option("--bastion-sts", help="the profile that assume role profiles will depend on.", default="bastion-sts")
-def set_mfa_serial(bastion_sts):
+@click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+def set_mfa_serial(bastion, bastion_sts, region):
     """ Set the 'mfa_serial' attribute for the bastion-sts profile. """
     credentials = Credentials()
-    credentials.set_mfa_serial(bastion_sts)
+    identity = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region).read_identity()
+    credentials.set_mfa_serial(bastion_sts=bastion_sts, username=identity["UserName"] if identity else None,
+        region=region)
     credentials.write()
 
     click.echo("Setting the 'mfa_set' attribute for the '{}' profile.".format(bastion_sts))
@@ -107,15 +311,53 @@ def set_mfa_serial(bastion_sts):
 
 
 @click.command()
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
 @click.option("--bastion-sts", help="the profile that assume role profiles will depend on.", default="bastion-sts")
-def get_expiration(bastion_sts):
+@click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+@click.option("--all", "all_profiles", help="Output the expiration of every profile and cache entry, including every bastion-sts partition.", is_flag=True)
+@click.option("--json", "as_json", help="Output json with the remaining lifetime in seconds.", is_flag=True)
+def get_expiration(bastion, bastion_sts, region, all_profiles, as_json):
     """ Output how much time until the bastion-sts credentials expire. """
-    cache = Cache()
-    if cache.is_expired():
-        click.echo("The bastion-sts cached credentials are expired.")
+    cache = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region)
+    if not all_profiles and not as_json:
+        if cache.is_expired():
+            click.echo("The {} cached credentials are expired.".format(bastion_sts))
+        else:
+            delta = cache.get_expiration()
+            click.echo("The {} cached credentials will expire {}.".format(bastion_sts, delta))
+        return None
+
+    if all_profiles:
+        rows = [
+            {"name": profile, "source": "credentials", "expiration_epoch": expiration_epoch}
+            for profile, expiration_epoch in Credentials().get_expirations().items()
+        ]
+        rows.extend(
+            {"name": name, "source": "cache", "expiration_epoch": expiration_epoch}
+            for name, expiration_epoch in cache.get_expirations().values()
+        )
+    elif not cache.is_expired():
+        rows = [{"name": bastion_sts, "source": "cache", "expiration_epoch": cache.read()["ExpirationEpoch"]}]
     else:
-        delta = cache.get_expiration()
-        click.echo("The bastion-sts cached credentials will expire {}.".format(delta))
+        rows = []
+
+    now = time.time()
+    for row in rows:
+        row["remaining_seconds"] = int(row["expiration_epoch"] - now)
+    rows.sort(key=lambda row: row["remaining_seconds"])
+
+    if as_json:
+        import json
+        click.echo(json.dumps(rows, indent=4))
+        return None
+
+    import humanize
+    width = max([len(row["name"]) for row in rows] or [0])
+    for row in rows:
+        remaining = timedelta(seconds=abs(row["remaining_seconds"]))
+        status = "will expire in {}".format(humanize.naturaldelta(remaining)) \
+            if row["remaining_seconds"] > 0 else "expired {} ago".format(humanize.naturaldelta(remaining))
+        click.echo("{}  {:<11}  {}".format(row["name"].ljust(width), row["source"], status))
     return None
 
 
@@ -128,6 +370,10 @@ def get_expiration(bastion_sts):
 def rotate_access_keys(username, deactivate, bastion, bastion_sts, region):
     """ Rotate the bastion long-lived access key id and secret access keys. """
 
+    if not username:
+        identity = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region).read_identity()
+        username = identity["UserName"] if identity else None
+
     credentials = Credentials()
     rotate = Rotate(
         username=username, deactivate=deactivate,
@@ -135,31 +381,285 @@ def rotate_access_keys(username, deactivate, bastion, bastion_sts, region):
         region=region, credentials=credentials
     )
     rotate.rotate()
+    rotate.retrier.report()
 
 
 @click.command()
 @click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
-def clear_cache(bastion):
-    """ Clear the bastion-sts credential cache and sts credentials from the aws shared credentials file. """
+@click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
+@click.option("--profile", "patterns", help="Only clear this profile, or glob pattern, and its cache entries. May be repeated.", multiple=True)
+@click.option("--expired-only", help="Only clear credentials that have expired.", is_flag=True)
+@click.option("--older-than", help="Only delete cache entries written more than this many seconds ago.", type=int, default=None)
+@click.option("--max-entries", help="Garbage collect the cache, keeping at most this many entries. Unexpired credentials are kept.", type=int, default=None)
+@click.option("--max-age", help="Garbage collect cache entries written more than this many seconds ago. Unexpired credentials are kept.", type=int, default=None)
+@click.option("--dry-run", help="Only output what would be cleared.", is_flag=True)
+def clear_cache(bastion, bastion_sts, patterns, expired_only, older_than, max_entries, max_age, dry_run):
+    """ Clear the bastion-sts credential cache and sts credentials from the aws shared credentials file.
+
+    With --max-entries or --max-age, only the cache is garbage collected and the aws shared credentials file is left alone.
+    """
+    cache = Cache(bastion=bastion, bastion_sts=bastion_sts)
+    if max_entries is not None or max_age is not None:
+        click.echo("Garbage collecting the bastion-sts credential cache:")
+        cache.gc(max_entries=max_entries, max_age=max_age, dry_run=dry_run)
+        return None
+
+    credentials = Credentials()
+    entry_names = None
+    if patterns:
+        import fnmatch
+
+        profiles = [profile for profile in credentials.get_profiles()
+            if any(fnmatch.fnmatchcase(profile, pattern) for pattern in patterns)]
+        role_arns = {credentials.get(profile, "role_arn") for profile in profiles} - {None}
+        entry_names = cache.get_entry_names(role_arns=role_arns, bastion_sts=bastion_sts in profiles)
+
     click.echo("Clearing the bastion-sts credential cache:")
-    cache = Cache()
-    cache.delete()
+    cache.delete(entry_names=entry_names, expired_only=expired_only, older_than=older_than, dry_run=dry_run)
 
     click.echo("")
 
     click.echo("Clearing sts credentials from the aws shared credentials file:")
-    credentials = Credentials()
-    credentials.clear()
+    credentials.clear(bastion=bastion, patterns=list(patterns), expired_only=expired_only, dry_run=dry_run)
+    return None
+
+
+@click.command()
+@click.argument("profiles", nargs=-1)
+@click.option("--watch", help="Keep running and refresh each profile before its credentials expire.", is_flag=True)
+@click.option("--lead-time", help="Refresh profiles whose credentials expire within this many seconds.", default=DEFAULT_REFRESH_WINDOW_IN_SECONDS)
+@click.option("--batch-window", help="Refresh profiles that are due within this many seconds of each other together.", default=60)
+@click.option("--duration-seconds", help="The duration, in seconds, that the credentials should remain valid.", default=timedelta(hours=1).seconds)
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
+@click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
+@click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+@click.option("--sts-endpoint-url", help="The sts endpoint to call. Defaults to the profile's 'sts_endpoint_url' attribute or the probed endpoint.", default=None)
+@click.option("--sts-regional-endpoints", help="Call the 'regional' sts endpoint of the region or the 'legacy' global endpoint.", type=click.Choice(["regional", "legacy"]), default=None)
+@click.option("--max-workers", help="The maximum number of concurrent sts.assume_role() calls.", default=8)
+def refresh(profiles, watch, lead_time, batch_window, duration_seconds, bastion, bastion_sts, region, sts_endpoint_url,
+    sts_regional_endpoints, max_workers):
+    """ Refresh assume role profiles that are about to expire.
+
+    PROFILES may be profile names or glob patterns. Defaults to every profile with a 'role_arn' attribute.
+    """
+    from .refresh import Refresher, report
+
+    # otherwise every profile is due again as soon as it is refreshed and --watch calls sts every second.
+    if duration_seconds <= lead_time + batch_window:
+        raise click.BadParameter("must be greater than --lead-time plus --batch-window ({} seconds).".format(
+            lead_time + batch_window), param_hint="'--duration-seconds'")
+
+    refresher = Refresher(
+        patterns=list(profiles),
+        bastion=bastion,
+        bastion_sts=bastion_sts,
+        region=region,
+        endpoint_url=sts_endpoint_url,
+        regional_endpoints=sts_regional_endpoints,
+        duration_seconds=duration_seconds,
+        lead_time=lead_time,
+        batch_window=batch_window,
+        max_workers=max_workers
+    )
+
+    if watch:
+        try:
+            refresher.watch()
+        except KeyboardInterrupt:
+            pass
+        return None
+
+    results = refresher.refresh_due()
+    refresher.sts.retrier.report()
+    if not results:
+        click.echo("No profiles are due for a refresh.")
+    elif not report(results):
+        sys.exit(1)
+    return None
+
+
+@click.command()
+@click.option("--socket", "socket_path", help="The unix socket to listen on. Defaults to $BASTION_AGENT_SOCK or ~/.aws/cli/bastion-agent.sock.", default=None)
+@click.option("--duration-seconds", help="The duration, in seconds, that assume role credentials should remain valid.", default=timedelta(hours=1).seconds)
+@click.option("--refresh-window", help="Refresh assume role credentials that expire within this many seconds.", default=DEFAULT_REFRESH_WINDOW_IN_SECONDS)
+@click.option("--bastion", help="The profile containing the long-lived IAM credentials.", default="bastion")
+@click.option("--bastion-sts", help="The profile that assume role profiles source.", default="bastion-sts")
+@click.option("--region", help="The region used when creating new AWS connections.", default="us-west-2")
+@click.option("--sts-endpoint-url", help="The sts endpoint to call. Defaults to the profile's 'sts_endpoint_url' attribute or the probed endpoint.", default=None)
+@click.option("--sts-regional-endpoints", help="Call the 'regional' sts endpoint of the region or the 'legacy' global endpoint.", type=click.Choice(["regional", "legacy"]), default=None)
+def agent(socket_path, duration_seconds, refresh_window, bastion, bastion_sts, region, sts_endpoint_url,
+    sts_regional_endpoints):
+    """ Serve credentials from memory to 'bastion-agent-client PROFILE' over a unix socket. """
+    from .agent import Agent
+
+    bastion_agent = Agent(
+        bastion=bastion,
+        bastion_sts=bastion_sts,
+        region=region,
+        endpoint_url=sts_endpoint_url,
+        regional_endpoints=sts_regional_endpoints,
+        socket_path=socket_path,
+        duration_seconds=duration_seconds,
+        refresh_window=refresh_window
+    )
+    click.echo("The bastion agent is listening on {}.".format(bastion_agent.socket_path))
+    try:
+        bastion_agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        click.echo(e)
+        sys.exit(1)
+    return None
+
+
+@click.command()
+@click.option("--region", "regions", help="Probe the sts endpoint of this region. May be repeated. Defaults to the common commercial regions unless --endpoint-url is given.", multiple=True)
+@click.option("--endpoint-url", "endpoint_urls", help="Also probe this sts endpoint, such as a vpc endpoint. May be repeated.", multiple=True)
+@click.option("--samples", help="The number of requests to each endpoint.", type=click.IntRange(min=1), default=3)
+@click.option("--dry-run", help="Only output the latencies.", is_flag=True)
+def probe_endpoints(regions, endpoint_urls, samples, dry_run):
+    """ Measure the latency to candidate sts endpoints and store the fastest one for this host.
+
+    Commands call the stored endpoint unless the --sts-endpoint-url or --sts-regional-endpoints options,
+    the AWS_ENDPOINT_URL_STS environment variable or the profile's 'sts_endpoint_url' or 'sts_regional_endpoints'
+    attributes choose another one.
+    """
+    from . import endpoints
+    import socket
+
+    if not regions and not endpoint_urls:
+        regions = endpoints.PROBE_REGIONS
+    candidates = {endpoints.get_regional_endpoint_url(region): region for region in regions}
+    candidates.update((endpoint_url, endpoints.get_endpoint_region(endpoint_url)) for endpoint_url in endpoint_urls)
+
+    results = endpoints.probe_all(candidates, samples=samples)
+    width = max(len(result["endpoint_url"]) for result in results)
+    for result in results:
+        latency = "{:.1f} ms".format(result["latency_ms"]) if result["latency_ms"] is not None else "unreachable"
+        click.echo("{}  {:<14}  {}".format(result["endpoint_url"].ljust(width), result["region"], latency))
+
+    fastest = results[0]
+    if fastest["latency_ms"] is None:
+        click.echo("None of the sts endpoints are reachable.")
+        sys.exit(1)
+
+    if not dry_run:
+        fastest["probed_at"] = int(time.time())
+        endpoints.write_probed_endpoint(fastest)
+        click.echo("Storing {} as the sts endpoint for the '{}' host.".format(fastest["endpoint_url"], socket.gethostname()))
+    return None
+
+
+@click.command()
+@click.option("--metrics-file", help="The metrics file. Defaults to $BASTION_METRICS_FILE.", envvar="BASTION_METRICS_FILE", required=True)
+@click.option("--since", help="Only summarize the metrics recorded in the last this many seconds.", type=int, default=None)
+@click.option("--json", "as_json", help="Output the summary as json.", is_flag=True)
+@click.option("--prometheus", "prometheus_path", help="Also write the metrics to this file in the prometheus textfile collector format.", default=None)
+def stats(metrics_file, since, as_json, prometheus_path):
+    """ Summarize the cache hit ratio, credential lifetime and sts call latency metrics. """
+    try:
+        records = list(metrics.read(metrics_file, since=time.time() - since if since else None))
+    except OSError as e:
+        click.echo("Failed to read the metrics file: {}".format(e))
+        sys.exit(1)
+
+    if prometheus_path:
+        from .backends import _atomic_write
+        # atomically, since the textfile collector may read the file at any time.
+        _atomic_write(prometheus_path, metrics.to_prometheus(records).encode("utf-8"), mode=0o644)
+
+    summary = metrics.summarize(records)
+    if as_json:
+        import json
+        click.echo(json.dumps(summary, indent=4))
+        return None
+
+    def seconds(value):
+        return "-" if value is None else "{:.0f}s".format(value)
+
+    click.echo("{:<24} {:<8} {:>8} {:>8} {:>10} {:>14} {:>14}".format(
+        "profile", "kind", "hits", "misses", "hit ratio", "min remaining", "p50 remaining"))
+    for row in summary["cache"]:
+        click.echo("{:<24} {:<8} {:>8} {:>8} {:>9.1%} {:>14} {:>14}".format(row["profile"], row["kind"], row["hits"],
+            row["misses"], row["hit_ratio"], seconds(row["remaining_seconds_min"]), seconds(row["remaining_seconds_p50"])))
+
+    click.echo("")
+    click.echo("{:<24} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8}".format(
+        "operation", "calls", "p50 ms", "p95 ms", "p99 ms", "retries", "throttles", "errors"))
+    for row in summary["aws_calls"]:
+        click.echo("{:<24} {:>8} {:>8.1f} {:>8.1f} {:>8.1f} {:>8} {:>9} {:>8}".format(row["operation"], row["calls"],
+            row["p50_ms"], row["p95_ms"], row["p99_ms"], row["retries"], row["throttles"], row["errors"]))
+    return None
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.option("--top", help="The number of packages and modules to output.", default=15)
+def import_times(args, top):
+    """ Output which imports dominate the startup of a bastion command.
+
+    ARGS is the bastion command to run under 'python -X importtime', e.g. 'get-session-token'. Its output is discarded.
+    Only the cli is imported when ARGS is empty.
+    """
+    from . import profiling
+
+    imports = profiling.measure_import_times(args)
+    if not imports:
+        click.echo("Failed to measure the import times.")
+        sys.exit(1)
+
+    total_us = sum(self_us for _, self_us, _ in imports)
+    click.echo("Imported {} modules in {:.1f} ms.".format(len(imports), total_us / 1000))
+
+    click.echo("")
+    click.echo("{:<40} {:>10} {:>8} {:>8}".format("package", "self ms", "share", "modules"))
+    for package, self_us, count in profiling.group_import_times(imports)[:top]:
+        click.echo("{:<40} {:>10.1f} {:>7.1%} {:>8}".format(package, self_us / 1000, self_us / total_us, count))
+
+    click.echo("")
+    click.echo("{:<40} {:>10} {:>14}".format("module", "self ms", "cumulative ms"))
+    for module, self_us, cumulative_us in sorted(imports, key=lambda row: -row[1])[:top]:
+        click.echo("{:<40} {:>10.1f} {:>14.1f}".format(module, self_us / 1000, cumulative_us / 1000))
+    return None
+
+
+@click.command()
+@click.argument("source", type=click.Choice(["file", "sqlite"]))
+@click.argument("destination", type=click.Choice(["file", "sqlite"]))
+def migrate_backend(source, destination):
+    """ Copy the profiles and bastion cache entries from the SOURCE backend to the DESTINATION backend.
+
+    Select the backend that bastion uses with the $BASTION_BACKEND environment variable.
+    awscli only reads profiles from the aws shared credentials file, i.e. the 'file' backend.
+    """
+    from .backends import get_backend, migrate
+
+    if source == destination:
+        click.echo("The source and destination backends must be different.")
+        sys.exit(1)
+
+    profiles, entries = migrate(get_backend(source), get_backend(destination))
+    click.echo("Copied {} profiles and {} cache entries from the '{}' backend to the '{}' backend.".format(
+        profiles, entries, source, destination))
     return None
 
 
 main.add_command(get_session_token)
 main.add_command(assume_role)
+main.add_command(env)
+main.add_command(credential_process)
 main.add_command(set_default)
 main.add_command(set_mfa_serial)
 main.add_command(get_expiration)
 main.add_command(rotate_access_keys)
 main.add_command(clear_cache)
+main.add_command(refresh)
+main.add_command(agent)
+main.add_command(migrate_backend)
+main.add_command(probe_endpoints)
+main.add_command(stats)
+main.add_command(import_times)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,23 +1,98 @@
-from botocore.exceptions import ClientError
-from configparser import ConfigParser
-from dateutil.tz import tzutc
-from dateutil.parser import parse
-import boto3
+from . import expiration, timings
+from .backends import get_backend, _to_dict
 import click
 import datetime
-import humanize
 import pathlib
 import os
 import sys
 
 
+STS_CREDENTIAL_OPTIONS = (
+    "aws_access_key_id", "aws_secret_access_key", "aws_session_token",
+    "aws_session_expiration", "aws_session_expiration_epoch"
+)
+
+
 class Credentials:
-    """ Manage getting and setting attributes for the aws shared credentials file. """
+    """ Manage getting and setting attributes for the aws shared credentials file.
 
-    def __init__(self):
+    Profiles are stored by a backend, the aws shared credentials file by default. Lookups are answered by the backend
+    and the profiles are only loaded into 'config' when it is used, typically to modify and write them.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or get_backend()
         self.aws_shared_credentials_path = os.path.join(pathlib.Path.home(), ".aws/credentials")
-        self.config = ConfigParser()
-        self.config.read(self.aws_shared_credentials_path)
+        self._config = None
+        self._snapshot = None
+        self._pending = {}
+
+    @property
+    def config(self):
+        """ The profiles, which are written back to the backend by 'write'. """
+        if self._config is None:
+            self._load_config()
+        return self._config
+
+    @timings.timed("Credentials.load")
+    def _load_config(self):
+        """ Load every profile, applying the changes recorded by 'set'. """
+        self._config = self.backend.load_config()
+        self._snapshot = _to_dict(self._config)
+        for profile, options in self._pending.items():
+            for option, value in options.items():
+                self._config.set(profile, option, value)
+        self._pending = {}
+
+    @config.setter
+    def config(self, config):
+        self._config = config
+
+    def get(self, profile, option, fallback=None):
+        """ Return the raw value of a profile attribute.
+
+        :param profile: The profile.
+        :type profile: str
+        :param option: The attribute.
+        :type option: str
+        :param fallback: The value to return when the profile or attribute is not defined.
+        :type fallback: str
+        :return: The attribute value.
+        :rtype: str
+        """
+        if self._config is not None:
+            return self._config.get(profile, option, raw=True, fallback=fallback)
+        if option in self._pending.get(profile, {}):
+            return self._pending[profile][option]
+        return (self.backend.get_profile(profile) or {}).get(option, fallback)
+
+    def set(self, profile, options):
+        """ Set profile attributes without loading every profile into 'config'.
+
+        :param profile: The profile.
+        :type profile: str
+        :param options: The raw attribute values.
+        :type options: dict
+        :raises KeyError: The profile is not defined.
+        """
+        if self._config is not None:
+            for option, value in options.items():
+                self._config[profile][option] = value
+            return
+
+        if profile not in self._pending and self.backend.get_profile(profile) is None:
+            raise KeyError(profile)
+        self._pending.setdefault(profile, {}).update(options)
+
+    def get_profiles(self):
+        """ Return the profiles defined in the aws shared credentials file.
+
+        :return: The profiles in the order they are defined.
+        :rtype: list
+        """
+        if self._config is not None:
+            return self._config.sections()
+        return self.backend.get_profile_names()
 
     def is_expired(self, bastion_sts="bastion-sts"):
         """ Return whether or not the bastion-sts credentials are expired.
@@ -25,13 +100,44 @@ class Credentials:
         :return: Whether or not the bastion-sts credentials are expired.
         :rtype: bool
         """
-        expired = False
-        now_dt = datetime.datetime.now(tzutc())
-        expiration_iso = self.config[bastion_sts]["aws_session_expiration"]
-        expiration_dt = parse(expiration_iso)
-        if now_dt > expiration_dt:
-            expired = True
-        return expired
+        return expiration.get_remaining_seconds(self.get_expiration_epoch(bastion_sts)) < 0
+
+    def get_expiration_epoch(self, profile="bastion-sts"):
+        """ Return when the profile's sts credentials expire as epoch seconds.
+
+        Profiles written before the 'aws_session_expiration_epoch' attribute existed fall back to parsing 'aws_session_expiration'.
+
+        :param profile: The profile with sts credentials.
+        :type profile: str
+        :raises KeyError: The profile does not have an expiration.
+        :return: The expiration as epoch seconds.
+        :rtype: int
+        """
+        expiration_epoch = self.get(profile, "aws_session_expiration_epoch")
+        if expiration_epoch:
+            try:
+                return int(expiration_epoch)
+            except ValueError:
+                pass
+
+        expiration_iso = self.get(profile, "aws_session_expiration")
+        if expiration_iso is None:
+            raise KeyError("aws_session_expiration")
+        return expiration.to_epoch(expiration_iso)
+
+    def get_expirations(self):
+        """ Return when the sts credentials of every profile expire.
+
+        :return: The expiration as epoch seconds, keyed by profile, for the profiles with sts credentials.
+        :rtype: dict
+        """
+        expirations = {}
+        for profile in self.get_profiles():
+            try:
+                expirations[profile] = self.get_expiration_epoch(profile)
+            except (KeyError, ValueError):
+                continue
+        return expirations
 
     def get_expiration(self, profile="bastion-sts", human_readable=True):
         """ Return how much time until the bastion-sts credentials expire.
@@ -42,15 +148,17 @@ class Credentials:
         :rtype: str
         """
         try:
-            expiration_iso = self.config[profile]["aws_session_expiration"]
+            expiration_epoch = self.get_expiration_epoch(profile)
         except KeyError:
-            click.echo("The '{}' profile did not have the 'aws_session_expiration' attribute.")
+            click.echo("The '{}' profile did not have the 'aws_session_expiration' attribute.".format(profile))
             sys.exit(1)
 
-        now_dt = datetime.datetime.now(tzutc())
-        expiration_dt = parse(expiration_iso)
-        delta = now_dt - expiration_dt
-        return humanize.naturaltime(delta) if human_readable else delta
+        delta = datetime.timedelta(seconds=-expiration.get_remaining_seconds(expiration_epoch))
+        if not human_readable:
+            return delta
+
+        import humanize
+        return humanize.naturaltime(delta)
 
     def get_mfa_serial(self, bastion_sts="bastion-sts"):
         """ Get the mfa serial number for the bastion iam user.
@@ -60,29 +168,40 @@ class Credentials:
         :raises Exception: Failed to get mfa_serial from bastion_sts profile.
         :return: The identification number of the MFA device that is associated with the bastion_sts profile.
         """
-        try:
-            return self.config[bastion_sts]["mfa_serial"]
-        except Exception:
+        mfa_serial = self.get(bastion_sts, "mfa_serial")
+        if mfa_serial is None:
             click.echo("An error occured when getting the mfa_serial from {} profile.".format(bastion_sts))
             click.echo("Try setting mfa_serial attribute with the 'bastion set-mfa-serial' command.")
             sys.exit(1)
+        return mfa_serial
 
-    def set_mfa_serial(self, mfa_serial=None, bastion_sts="bastion_sts"):
+    @timings.timed("Credentials.set_mfa_serial")
+    def set_mfa_serial(self, mfa_serial=None, bastion_sts="bastion_sts", username=None, region="us-west-2"):
         """ Set the 'mfa_serial' attribute for the given profile, typically the bastion-sts profile.
 
         :param mfa_serial: The identification number of the MFA device that is associated with the IAM user.
         :param bastion_sts: The profile that assume role profiles source.
+        :param username: The IAM username, typically from the cached identity. Otherwise, it is looked up with iam.get_user().
+        :param region: The region used when creating new AWS connections.
         :type mfa_serial: str
         :type bastion_sts: str
+        :type username: str
+        :type region: str
         :raises ClientError: Failed to get mfa_serial from the iam user.
         :raises Exception: Failed to set mfa_serial for bastion_sts profile.
         """
         if not mfa_serial:
+            from .retry import Retrier, create_client
+            from botocore.exceptions import ClientError
+            import boto3
+
             try:
-                iam = boto3.client('iam')
-                username = iam.get_user()["User"]["UserName"]
+                retrier = Retrier()
+                iam = create_client(boto3.Session(region_name=region), 'iam')
+                if not username:
+                    username = retrier.call(iam.get_user)["User"]["UserName"]
 
-                for iam_mfa_device in iam.list_mfa_devices(UserName=username)["MFADevices"]:
+                for iam_mfa_device in retrier.call(iam.list_mfa_devices, UserName=username)["MFADevices"]:
                     mfa_serial = iam_mfa_device["SerialNumber"]
                     break   # no need to check another MFA device.
                 else:
@@ -98,7 +217,33 @@ class Credentials:
                     click.echo("Unexpected error: {}".format(e))
                 sys.exit(1)
         
-        self.config[bastion_sts]["mfa_serial"] = mfa_serial
+        self.set(bastion_sts, {"mfa_serial": mfa_serial})
+
+    @timings.timed("Credentials.get_role_profiles")
+    def get_role_profiles(self):
+        """ Return the profiles that have a 'role_arn' attribute.
+
+        :return: The assume role profiles in the order they are defined.
+        :rtype: list
+        """
+        return [profile for profile in self.get_profiles() if self.get(profile, "role_arn") is not None]
+
+    def set_sts_credentials(self, profile, sts_creds):
+        """ Set the profile with short-lived sts credentials.
+
+        :param profile: The profile to set.
+        :type profile: str
+        :param sts_creds: The sts credentials with an iso 8601 formatted 'Expiration'.
+        :type sts_creds: dict
+        """
+        self.set(profile, {
+            "aws_access_key_id": sts_creds["AccessKeyId"],
+            "aws_secret_access_key": sts_creds["SecretAccessKey"],
+            "aws_session_token": sts_creds["SessionToken"],
+            "aws_session_expiration": sts_creds["Expiration"],
+            "aws_session_expiration_epoch": str(
+                sts_creds.get("ExpirationEpoch") or expiration.to_epoch(sts_creds["Expiration"]))
+        })
 
     def set_default(self, profile):
         """ Set the default profile with attributes from another profile.
@@ -113,14 +258,23 @@ class Credentials:
             click.echo("The '{}' profile is not defined in the {} file.".format(profile, self.aws_shared_credentials_path))
             sys.exit(1)
     
-    def clear(self, bastion="bastion"):
+    @timings.timed("Credentials.clear")
+    def clear(self, bastion="bastion", patterns=None, expired_only=False, dry_run=False):
         """ Clear sts credentials from the aws shared credentials file.
 
         :param bastion: The profile containing the long-lived IAM credentials.
         :type bastion: str
-        :return: Whether or not any sts credentials were removed from the aws shared credentials file.
-        :rtype: bool
+        :param patterns: Only clear profiles that match these profile names or glob patterns.
+        :type patterns: list
+        :param expired_only: Only clear sts credentials that have expired.
+        :type expired_only: bool
+        :param dry_run: Only output which sts credentials would be cleared.
+        :type dry_run: bool
+        :return: The profiles that sts credentials were removed from.
+        :rtype: list
         """
+        import fnmatch
+
         profiles = self.config.sections()
 
         # we don't want to remove the long-lived credentials
@@ -128,30 +282,67 @@ class Credentials:
 
         click.echo("- Skipping the '{}' profile because it may contain long-lived credentials.".format(bastion))
 
+        cleared = []
         for profile in profiles:
+            if patterns and not any(fnmatch.fnmatchcase(profile, pattern) for pattern in patterns):
+                continue
+
             if "source_profile" not in self.config[profile]:
                 click.echo("- Skipping the '{}' profile because it may contain long-lived credentials.".format(profile))
                 continue
 
-            is_access_key = "aws_access_key_id" in self.config[profile]
-            is_secret_key = "aws_secret_access_key" in self.config[profile]
-            is_session_token = "aws_session_token" in self.config[profile]
-            is_expiration = "aws_session_expiration" in self.config[profile]
+            if expired_only:
+                try:
+                    is_expired = expiration.get_remaining_seconds(self.get_expiration_epoch(profile)) < 0
+                except (KeyError, ValueError):
+                    is_expired = False
+                if not is_expired:
+                    continue
+
+            options = [option for option in STS_CREDENTIAL_OPTIONS if option in self.config[profile]]
+            if not options:
+                continue
+
+            cleared.append(profile)
+            if dry_run:
+                click.echo("- STS credentials would be removed from the {} profile.".format(profile))
+                continue
 
-            if is_access_key:
-                del self.config[profile]["aws_access_key_id"]
-            if is_secret_key:
-                del self.config[profile]["aws_secret_access_key"]
-            if is_session_token:
-                del self.config[profile]["aws_session_token"]
-            if is_expiration:
-                del self.config[profile]["aws_session_expiration"]
+            for option in options:
+                del self.config[profile][option]
+            click.echo("- STS credentials were removed from the {} profile.".format(profile))
 
-            if any([is_access_key, is_secret_key, is_session_token, is_expiration]):
-                click.echo("- STS credentials were removed from the {} profile.".format(profile))
-        self.write()
+        if not dry_run:
+            self.write()
+        return cleared
 
+    def _get_changes(self):
+        """ Return the changes made to the profiles since they were loaded.
+
+        :return: None, or the attributes to set and remove, keyed by profile.
+        :rtype: dict
+        """
+        current = _to_dict(self.config)
+        changes = {profile: None for profile in self._snapshot if profile not in current}
+
+        for profile, options in current.items():
+            snapshot_options = self._snapshot.get(profile, {})
+            set_options = {option: value for option, value in options.items() if snapshot_options.get(option) != value}
+            removed_options = [option for option in snapshot_options if option not in options]
+            if set_options or removed_options or profile not in self._snapshot:
+                changes[profile] = (set_options, removed_options)
+        return changes
+
+    @timings.timed("Credentials.write")
     def write(self):
-        """ Write credentials to the aws shared credentials file. """
-        with open(self.aws_shared_credentials_path, 'w') as f:
-            self.config.write(f)
+        """ Write credentials to the aws shared credentials file.
+
+        Only the attributes changed since the profiles were loaded are written on top of the latest stored profiles,
+        so concurrent bastion commands do not drop each other's profiles.
+        """
+        changes = self._get_changes() if self._config is not None else {}
+        changes.update((profile, (options, [])) for profile, options in self._pending.items())
+        if changes:
+            self.backend.write_profiles(changes)
+        self._config = self._snapshot = None
+        self._pending = {}
@@ -0,0 +1,215 @@
+""" Choose the sts endpoint that bastion calls.
+
+The endpoint is resolved in order from:
+
+1. The --sts-endpoint-url option.
+2. The --sts-regional-endpoints option.
+3. The AWS_ENDPOINT_URL_STS or AWS_ENDPOINT_URL environment variables, which botocore reads itself.
+4. The 'sts_endpoint_url' attribute of the bastion-sts or bastion profile.
+5. The 'sts_regional_endpoints' attribute of the bastion-sts or bastion profile.
+6. The fastest endpoint found by ``bastion probe-endpoints`` on this host.
+7. botocore's default endpoint for the region.
+"""
+
+import json
+import os
+import time
+
+
+REGIONAL = "regional"
+LEGACY = "legacy"
+LEGACY_ENDPOINT_URL = "https://sts.amazonaws.com"
+
+PROBE_REGIONS = (
+    "us-east-1", "us-east-2", "us-west-1", "us-west-2", "ca-central-1", "sa-east-1",
+    "eu-west-1", "eu-west-2", "eu-central-1", "eu-north-1",
+    "ap-south-1", "ap-southeast-1", "ap-southeast-2", "ap-northeast-1", "ap-northeast-2"
+)
+
+
+def get_regional_endpoint_url(region):
+    """ Return the regional sts endpoint.
+
+    :param region: The aws region.
+    :type region: str
+    :return: The https url of the sts endpoint in the region.
+    :rtype: str
+    """
+    suffix = "amazonaws.com.cn" if region.startswith("cn-") else "amazonaws.com"
+    return "https://sts.{}.{}".format(region, suffix)
+
+
+def get_probed_endpoints_path():
+    """ Return the file that stores the fastest sts endpoint for each host.
+
+    :return: The ~/.aws/cli/bastion-endpoints.json file.
+    :rtype: str
+    """
+    return os.path.join(os.path.expanduser("~"), ".aws", "cli", "bastion-endpoints.json")
+
+
+def read_probed_endpoint(hostname=None):
+    """ Read the fastest sts endpoint found for the host.
+
+    :param hostname: The host. Defaults to this host.
+    :type hostname: str
+    :return: The 'region', 'endpoint_url', 'latency_ms' and 'probed_at' of the endpoint or None when the host was never probed.
+    :rtype: dict
+    """
+    try:
+        with open(get_probed_endpoints_path(), "rb") as f:
+            probed_endpoints = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    import socket
+    return probed_endpoints.get(hostname or socket.gethostname())
+
+
+def write_probed_endpoint(endpoint, hostname=None):
+    """ Store the fastest sts endpoint for the host, keeping the other hosts' endpoints.
+
+    :param endpoint: The 'region', 'endpoint_url', 'latency_ms' and 'probed_at' of the endpoint.
+    :type endpoint: dict
+    :param hostname: The host. Defaults to this host.
+    :type hostname: str
+    """
+    from .backends import _atomic_write
+    import socket
+
+    path = get_probed_endpoints_path()
+    try:
+        with open(path, "rb") as f:
+            probed_endpoints = json.loads(f.read())
+    except (OSError, ValueError):
+        probed_endpoints = {}
+
+    probed_endpoints[hostname or socket.gethostname()] = endpoint
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _atomic_write(path, json.dumps(probed_endpoints, indent=4, sort_keys=True).encode("utf-8"))
+
+
+def probe(endpoint_url, samples=3, timeout=5):
+    """ Measure the round-trip latency to an endpoint.
+
+    Each sample opens a new connection and sends a request, like a new bastion process does.
+    Any http response counts, the request is not signed.
+
+    :param endpoint_url: The endpoint.
+    :type endpoint_url: str
+    :param samples: The number of requests.
+    :type samples: int
+    :param timeout: The seconds to wait for each response.
+    :type timeout: int
+    :return: The median latency in milliseconds or None when the endpoint is unreachable.
+    :rtype: float
+    """
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+    import statistics
+
+    url = urlsplit(endpoint_url)
+    connection_class = HTTPSConnection if url.scheme == "https" else HTTPConnection
+    latencies = []
+    for _ in range(samples):
+        connection = connection_class(url.hostname, url.port, timeout=timeout)
+        start = time.perf_counter()
+        try:
+            connection.request("GET", url.path or "/")
+            connection.getresponse().read()
+        except OSError:
+            return None
+        finally:
+            connection.close()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+
+def get_endpoint_region(endpoint_url, default="us-east-1"):
+    """ Return the region in an sts endpoint's hostname, such as a regional or vpc endpoint.
+
+    :param endpoint_url: The endpoint.
+    :type endpoint_url: str
+    :param default: The region for endpoints without one, such as a local stand-in.
+    :type default: str
+    :return: The region used to sign requests to the endpoint.
+    :rtype: str
+    """
+    import re
+    match = re.search(r"\.([a-z]{2}(?:-gov)?-[a-z]+-\d)\.", endpoint_url + ".")
+    return match.group(1) if match else default
+
+
+def probe_all(candidates, samples=3, timeout=5, max_workers=8):
+    """ Measure the round-trip latency to each candidate endpoint concurrently.
+
+    :param candidates: The region of each candidate endpoint, keyed by endpoint.
+    :type candidates: dict
+    :param samples: The number of requests per endpoint.
+    :type samples: int
+    :param timeout: The seconds to wait for each response.
+    :type timeout: int
+    :param max_workers: The maximum number of endpoints probed at once.
+    :type max_workers: int
+    :return: The 'region', 'endpoint_url' and 'latency_ms' of each endpoint, fastest first. Unreachable endpoints are last.
+    :rtype: list
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(candidates)))) as executor:
+        latencies = executor.map(lambda endpoint_url: probe(endpoint_url, samples, timeout), candidates)
+        results = [
+            {"region": region, "endpoint_url": endpoint_url, "latency_ms": latency_ms}
+            for (endpoint_url, region), latency_ms in zip(candidates.items(), latencies)
+        ]
+    return sorted(results, key=lambda result: (result["latency_ms"] is None, result["latency_ms"] or 0))
+
+
+def _resolve_regional_endpoints(region, regional_endpoints):
+    if regional_endpoints == LEGACY:
+        return "us-east-1", LEGACY_ENDPOINT_URL
+    return region, get_regional_endpoint_url(region)
+
+
+def resolve(credentials, profiles, region, endpoint_url=None, regional_endpoints=None):
+    """ Return the region and endpoint to create the sts client with.
+
+    :param credentials: The credentials to read the profile attributes from. May be None.
+    :type credentials: Credentials
+    :param profiles: The profiles to read the 'sts_endpoint_url' and 'sts_regional_endpoints' attributes from, in order.
+    :type profiles: list
+    :param region: The region used when creating new AWS connections.
+    :type region: str
+    :param endpoint_url: The --sts-endpoint-url option.
+    :type endpoint_url: str
+    :param regional_endpoints: The --sts-regional-endpoints option, either 'regional' or 'legacy'.
+    :type regional_endpoints: str
+    :return: The region and the endpoint, which is None when botocore should choose it.
+    :rtype: tuple
+    """
+    if endpoint_url:
+        return get_endpoint_region(endpoint_url, default=region), endpoint_url
+    if regional_endpoints:
+        return _resolve_regional_endpoints(region, regional_endpoints)
+    if os.environ.get("AWS_ENDPOINT_URL_STS") or os.environ.get("AWS_ENDPOINT_URL"):
+        return region, None
+
+    def get(option):
+        for profile in profiles if credentials is not None else ():
+            value = credentials.get(profile, option)
+            if value:
+                return value
+        return None
+
+    endpoint_url = get("sts_endpoint_url")
+    if endpoint_url:
+        return get_endpoint_region(endpoint_url, default=region), endpoint_url
+
+    regional_endpoints = get("sts_regional_endpoints")
+    if regional_endpoints in (REGIONAL, LEGACY):
+        return _resolve_regional_endpoints(region, regional_endpoints)
+
+    probed_endpoint = read_probed_endpoint()
+    if probed_endpoint:
+        return probed_endpoint["region"], probed_endpoint["endpoint_url"]
+    return region, None
@@ -0,0 +1,53 @@
+""" Lightweight helpers for working with sts credential expirations. """
+
+import datetime
+import time
+
+
+def now():
+    """ Return the current time as a timezone aware utc datetime.
+
+    :return: The current time.
+    :rtype: datetime.datetime
+    """
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parse(expiration_iso):
+    """ Parse an iso 8601 formatted expiration.
+
+    The stdlib parser handles the format written by this package. The dateutil parser
+    is only imported for anything else, since importing it noticeably slows down startup.
+
+    :param expiration_iso: The iso 8601 formatted expiration.
+    :type expiration_iso: str
+    :return: The timezone aware expiration.
+    :rtype: datetime.datetime
+    """
+    try:
+        return datetime.datetime.fromisoformat(expiration_iso)
+    except (AttributeError, ValueError):
+        from dateutil.parser import parse as dateutil_parse
+        return dateutil_parse(expiration_iso)
+
+
+def to_epoch(expiration_iso):
+    """ Convert an iso 8601 formatted expiration to epoch seconds.
+
+    :param expiration_iso: The iso 8601 formatted expiration.
+    :type expiration_iso: str
+    :return: The expiration as epoch seconds.
+    :rtype: int
+    """
+    return int(parse(expiration_iso).timestamp())
+
+
+def get_remaining_seconds(expiration_epoch):
+    """ Return how many seconds remain until the expiration.
+
+    :param expiration_epoch: The expiration as epoch seconds.
+    :type expiration_epoch: int
+    :return: The remaining seconds, which is negative once expired.
+    :rtype: float
+    """
+    return expiration_epoch - time.time()
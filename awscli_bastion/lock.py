@@ -0,0 +1,87 @@
+""" Advisory file locks that coordinate bastion processes sharing the same files. """
+
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+
+DEFAULT_LOCK_TIMEOUT_IN_SECONDS = 300
+
+
+class LockTimeout(Exception):
+    """ The lock was not acquired before the timeout. """
+
+
+class FileLock:
+    """ An exclusive advisory lock on a lock file that is shared between processes.
+
+    The lock is released when the process exits, even if it is killed.
+    """
+
+    def __init__(self, path, timeout=DEFAULT_LOCK_TIMEOUT_IN_SECONDS, poll_interval=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def _try_lock(self):
+        try:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def acquire(self, until=None):
+        """ Wait for the lock.
+
+        :param until: Stop waiting, without the lock, as soon as this callable returns True.
+        :type until: callable
+        :raises LockTimeout: The lock was not acquired before the timeout.
+        :return: Whether or not the lock was acquired.
+        :rtype: bool
+        """
+        lock_dir = os.path.dirname(self.path)
+        if lock_dir and not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self._try_lock():
+            if until and until():
+                self._close()
+                return False
+            if deadline is not None and time.monotonic() > deadline:
+                self._close()
+                raise LockTimeout("Timed out waiting for the {} lock file.".format(self.path))
+            time.sleep(self.poll_interval)
+        return True
+
+    def release(self):
+        """ Release the lock. """
+        if self._fd is None:
+            return
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        self._close()
+
+    def _close(self):
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
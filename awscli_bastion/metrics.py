@@ -0,0 +1,308 @@
+""" Opt-in metrics of cache hits, sts and iam call latency and credential lifetimes.
+
+Enable them with the --metrics-file option or the BASTION_METRICS_FILE environment variable. Every cache lookup
+and aws call appends a line in the InfluxDB line protocol to the file::
+
+    bastion_cache,profile=dev-admin,kind=role,result=hit count=1i,remaining_seconds=2400i 1700000000000000000
+    bastion_aws_call,operation=assume_role,result=ok duration_ms=23.4,attempts=1i,throttles=0i 1700000000000000000
+
+``bastion stats`` summarizes the file and converts it to the prometheus textfile collector format.
+The file is only appended to, so rotate or truncate it like any other log.
+"""
+
+from . import expiration
+from .timings import _FileWriter
+import re
+import threading
+import time
+
+
+CACHE = "bastion_cache"
+AWS_CALL = "bastion_aws_call"
+
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REMAINING_SECONDS_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 14400, 43200)
+
+_write = None
+_lock = threading.Lock()
+
+
+def enable(path):
+    """ Start appending metrics to the file.
+
+    :param path: The metrics file.
+    :type path: str
+    """
+    global _write
+    _write = _FileWriter(path)
+
+
+def disable():
+    """ Stop appending metrics and close the metrics file. """
+    global _write
+    if _write is not None:
+        _write.close()
+        _write = None
+
+
+def is_enabled():
+    return _write is not None
+
+
+def _escape(value):
+    return re.sub(r"([\\, =])", r"\\\1", str(value))
+
+
+def _unescape(value):
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def _split(value, separator):
+    """ Split on the separators that are not escaped. """
+    return re.findall(r"(?:\\.|[^\\{}])+".format(separator), value)
+
+
+def _format_field(value):
+    if isinstance(value, (bool, int)):
+        return "{}i".format(int(value))
+    return repr(float(value))
+
+
+def _parse_field(value):
+    return int(value[:-1]) if value.endswith("i") else float(value)
+
+
+def record(measurement, tags, fields):
+    """ Append a line to the metrics file when metrics are enabled.
+
+    :param measurement: The measurement, e.g. 'bastion_cache'.
+    :type measurement: str
+    :param tags: The string labels of the line.
+    :type tags: dict
+    :param fields: The numeric values of the line.
+    :type fields: dict
+    """
+    if _write is None:
+        return
+
+    line = "{}{} {} {}\n".format(
+        measurement,
+        "".join(",{}={}".format(_escape(name), _escape(value)) for name, value in tags.items() if value is not None),
+        ",".join("{}={}".format(_escape(name), _format_field(value)) for name, value in fields.items()),
+        int(time.time() * 1e9)
+    )
+    with _lock:
+        _write(line)
+
+
+def cache_lookup(profile, kind, hit, creds=None):
+    """ Record whether credentials were served from the cache and how long they remained valid.
+
+    :param profile: The bastion-sts profile or the assume role profile.
+    :type profile: str
+    :param kind: Either 'session' for bastion-sts credentials or 'role' for assume role credentials.
+    :type kind: str
+    :param hit: Whether or not the credentials were served from the cache.
+    :type hit: bool
+    :param creds: The sts credentials that were used, with the 'Expiration' or 'ExpirationEpoch' attribute.
+    :type creds: dict
+    """
+    if _write is None:
+        return
+
+    fields = {"count": 1}
+    if creds:
+        expiration_epoch = creds.get("ExpirationEpoch") or expiration.to_epoch(creds["Expiration"])
+        fields["remaining_seconds"] = int(expiration.get_remaining_seconds(expiration_epoch))
+    record(CACHE, {"profile": profile, "kind": kind, "result": "hit" if hit else "miss"}, fields)
+
+
+def aws_call(operation, duration, attempts, throttles, error=None):
+    """ Record the latency of an sts or iam call, including its retries.
+
+    :param operation: The boto3 method, e.g. 'assume_role'.
+    :type operation: str
+    :param duration: The seconds the call took.
+    :type duration: float
+    :param attempts: The number of attempts.
+    :type attempts: int
+    :param throttles: The number of throttled attempts.
+    :type throttles: int
+    :param error: The name of the error that failed the call.
+    :type error: str
+    """
+    record(AWS_CALL, {"operation": operation, "result": "error" if error else "ok", "error": error}, {
+        "duration_ms": round(duration * 1000, 3), "attempts": attempts, "throttles": throttles
+    })
+
+
+def read(path, since=None):
+    """ Read the lines of a metrics file. Malformed lines, e.g. from a full disk, are skipped.
+
+    :param path: The metrics file.
+    :type path: str
+    :param since: Only read the lines recorded at or after this epoch.
+    :type since: float
+    :return: The measurement, tags, fields and epoch of each line.
+    :rtype: generator
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            parts = _split(line.rstrip("\n"), " ")
+            if len(parts) != 3:
+                continue
+            try:
+                timestamp = int(parts[2]) / 1e9
+                if since is not None and timestamp < since:
+                    continue
+                measurement, *tag_pairs = _split(parts[0], ",")
+                tags = {}
+                for tag in tag_pairs:
+                    name, value = _split(tag, "=")
+                    tags[_unescape(name)] = _unescape(value)
+                fields = {}
+                for field in _split(parts[1], ","):
+                    name, value = _split(field, "=")
+                    fields[_unescape(name)] = _parse_field(value)
+            except ValueError:
+                continue
+            yield _unescape(measurement), tags, fields, timestamp
+
+
+def percentile(values, p):
+    """ Return a percentile, interpolating between the closest ranks.
+
+    It matches statistics.quantiles(values, n=100, method="inclusive"), which needs python 3.8.
+
+    :param values: The sorted values. There must be at least one.
+    :type values: list
+    :param p: The percentile, from 0 to 100.
+    :type p: int
+    :return: The percentile.
+    :rtype: float
+    """
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(records):
+    """ Summarize metrics lines into hit ratios, lifetimes and call latencies.
+
+    :param records: The lines from 'read'.
+    :type records: iterable
+    :return: The 'cache' and 'aws_calls' summaries, sorted by profile and operation.
+    :rtype: dict
+    """
+    lookups = {}
+    calls = {}
+    for measurement, tags, fields, _ in records:
+        if measurement == CACHE:
+            lookup = lookups.setdefault((tags.get("profile"), tags.get("kind")), {"hits": 0, "misses": 0, "remaining_seconds": []})
+            lookup["hits" if tags.get("result") == "hit" else "misses"] += fields.get("count", 1)
+            if "remaining_seconds" in fields:
+                lookup["remaining_seconds"].append(fields["remaining_seconds"])
+        elif measurement == AWS_CALL:
+            call = calls.setdefault(tags.get("operation"), {"durations_ms": [], "retries": 0, "throttles": 0, "errors": 0})
+            call["durations_ms"].append(fields.get("duration_ms", 0.0))
+            call["retries"] += fields.get("attempts", 1) - 1
+            call["throttles"] += fields.get("throttles", 0)
+            call["errors"] += tags.get("result") == "error"
+
+    cache = []
+    for (profile, kind), lookup in sorted(lookups.items()):
+        remaining_seconds = sorted(lookup["remaining_seconds"])
+        cache.append({
+            "profile": profile,
+            "kind": kind,
+            "hits": lookup["hits"],
+            "misses": lookup["misses"],
+            "hit_ratio": lookup["hits"] / (lookup["hits"] + lookup["misses"]),
+            "remaining_seconds_min": remaining_seconds[0] if remaining_seconds else None,
+            "remaining_seconds_p50": percentile(remaining_seconds, 50) if remaining_seconds else None
+        })
+
+    aws_calls = []
+    for operation, call in sorted(calls.items()):
+        durations_ms = sorted(call["durations_ms"])
+        aws_calls.append({
+            "operation": operation,
+            "calls": len(durations_ms),
+            "p50_ms": percentile(durations_ms, 50),
+            "p95_ms": percentile(durations_ms, 95),
+            "p99_ms": percentile(durations_ms, 99),
+            "retries": call["retries"],
+            "throttles": call["throttles"],
+            "errors": call["errors"]
+        })
+    return {"cache": cache, "aws_calls": aws_calls}
+
+
+def _labels(labels):
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()) + "}"
+
+
+def _histogram(lines, name, labels, values, buckets):
+    for bucket in buckets:
+        lines.append("{}_bucket{} {}".format(name, _labels(dict(labels, le=bucket)), sum(value <= bucket for value in values)))
+    lines.append("{}_bucket{} {}".format(name, _labels(dict(labels, le="+Inf")), len(values)))
+    lines.append("{}_sum{} {}".format(name, _labels(labels), sum(values)))
+    lines.append("{}_count{} {}".format(name, _labels(labels), len(values)))
+
+
+def to_prometheus(records):
+    """ Convert metrics lines to the prometheus text format, for the node exporter's textfile collector.
+
+    :param records: The lines from 'read'.
+    :type records: iterable
+    :return: The counters and histograms in the prometheus text format.
+    :rtype: str
+    """
+    lookups = {}
+    remaining = {}
+    durations = {}
+    retries = {}
+    throttles = {}
+    for measurement, tags, fields, _ in records:
+        if measurement == CACHE:
+            key = (tags.get("profile"), tags.get("kind"), tags.get("result"))
+            lookups[key] = lookups.get(key, 0) + fields.get("count", 1)
+            if "remaining_seconds" in fields:
+                remaining.setdefault(key[:2], []).append(fields["remaining_seconds"])
+        elif measurement == AWS_CALL:
+            key = (tags.get("operation"), tags.get("result"))
+            durations.setdefault(key, []).append(fields.get("duration_ms", 0.0) / 1000)
+            retries[key[0]] = retries.get(key[0], 0) + fields.get("attempts", 1) - 1
+            throttles[key[0]] = throttles.get(key[0], 0) + fields.get("throttles", 0)
+
+    lines = [
+        "# HELP bastion_cache_lookups_total Credentials served from the cache (hit) or from sts (miss).",
+        "# TYPE bastion_cache_lookups_total counter"
+    ]
+    for (profile, kind, result), count in sorted(lookups.items()):
+        lines.append("bastion_cache_lookups_total{} {}".format(
+            _labels({"profile": profile, "kind": kind, "result": result}), count))
+
+    lines.append("# HELP bastion_credential_remaining_seconds The remaining lifetime of credentials when they were used.")
+    lines.append("# TYPE bastion_credential_remaining_seconds histogram")
+    for (profile, kind), values in sorted(remaining.items()):
+        _histogram(lines, "bastion_credential_remaining_seconds", {"profile": profile, "kind": kind}, values,
+            REMAINING_SECONDS_BUCKETS)
+
+    lines.append("# HELP bastion_aws_call_duration_seconds The latency of sts and iam calls, including retries.")
+    lines.append("# TYPE bastion_aws_call_duration_seconds histogram")
+    for (operation, result), values in sorted(durations.items()):
+        _histogram(lines, "bastion_aws_call_duration_seconds", {"operation": operation, "result": result}, values,
+            DURATION_BUCKETS)
+
+    for name, help_text, counts in (
+        ("bastion_aws_call_retries_total", "Retried sts and iam call attempts.", retries),
+        ("bastion_aws_call_throttles_total", "Throttled sts and iam call attempts.", throttles)
+    ):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} counter".format(name))
+        for operation, count in sorted(counts.items()):
+            lines.append("{}{} {}".format(name, _labels({"operation": operation}), count))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,108 @@
+""" Profile slow bastion commands and break down where startup spends its time importing modules.
+
+Profile a command with the --profile-out option or the BASTION_PROFILE_OUT environment variable::
+
+    $ bastion --profile-out bastion.prof assume-role --all
+    $ python -m pstats bastion.prof
+
+Break down the import time of a command with ``bastion import-times``, which runs it under ``python -X importtime``::
+
+    $ bastion import-times -- get-session-token
+"""
+
+import sys
+
+
+DEFAULT_TOP = 25
+
+
+def start():
+    """ Start profiling the current thread.
+
+    :return: The running profiler.
+    :rtype: cProfile.Profile
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop(profiler, path, top=DEFAULT_TOP, stream=None):
+    """ Stop profiling, write the pstats file and output the functions with the most cumulative time.
+
+    :param profiler: The profiler from 'start'.
+    :type profiler: cProfile.Profile
+    :param path: The pstats file to write.
+    :type path: str
+    :param top: The number of functions to output.
+    :type top: int
+    :param stream: Where to output the functions. Defaults to stderr, so stdout stays clean for credential_process.
+    :type stream: file
+    """
+    import pstats
+
+    profiler.disable()
+    profiler.dump_stats(path)
+    stream = stream or sys.stderr
+    stream.write("Wrote the profile to {}. The top {} functions by cumulative time:\n".format(path, top))
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+
+
+def parse_import_times(output):
+    """ Parse the output of 'python -X importtime'.
+
+    :param output: The stderr of the python process.
+    :type output: str
+    :return: The module, self microseconds and cumulative microseconds of each import.
+    :rtype: list
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            self_us, cumulative_us, module = line[len("import time:"):].split("|")
+            imports.append((module.strip(), int(self_us), int(cumulative_us)))
+        except ValueError:
+            continue    # the header line.
+    return imports
+
+
+def measure_import_times(args=(), python=None):
+    """ Run a bastion command under 'python -X importtime' and return its imports.
+
+    :param args: The bastion command and its arguments. Only the cli is imported when empty.
+    :type args: list
+    :param python: The python interpreter. Defaults to the current one.
+    :type python: str
+    :return: The module, self microseconds and cumulative microseconds of each import.
+    :rtype: list
+    """
+    import subprocess
+
+    script = "import sys\nfrom awscli_bastion.cli import main\n"
+    if args:
+        script += "try:\n    main(sys.argv[1:], prog_name='bastion')\nexcept SystemExit:\n    pass\n"
+
+    # the command's stdout may contain credentials, it is discarded.
+    result = subprocess.run([python or sys.executable, "-X", "importtime", "-c", script] + list(args),
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return parse_import_times(result.stderr.decode("utf-8", "replace"))
+
+
+def group_import_times(imports):
+    """ Sum the self time of the imports per top-level package, e.g. 'botocore'.
+
+    :param imports: The imports from 'measure_import_times'.
+    :type imports: list
+    :return: The package, self microseconds and number of modules of each package, slowest first.
+    :rtype: list
+    """
+    packages = {}
+    for module, self_us, _ in imports:
+        package = module.split(".")[0]
+        total_us, count = packages.get(package, (0, 0))
+        packages[package] = (total_us + self_us, count + 1)
+    return sorted(((package, total_us, count) for package, (total_us, count) in packages.items()),
+        key=lambda row: -row[1])
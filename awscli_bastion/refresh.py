@@ -0,0 +1,141 @@
+from . import expiration
+from .cache import Cache, DEFAULT_REFRESH_WINDOW_IN_SECONDS
+from .credentials import Credentials
+from .sts import STS, ONE_HOUR_IN_SECONDS
+import click
+import fnmatch
+import threading
+import time
+
+
+DEFAULT_BATCH_WINDOW_IN_SECONDS = 60
+DEFAULT_RETRY_INTERVAL_IN_SECONDS = 60
+
+
+class Refresher:
+    """ Refresh assume role profiles in the aws shared credentials file before their credentials expire. """
+
+    def __init__(self, patterns=None, bastion="bastion", bastion_sts="bastion-sts", region="us-west-2",
+        endpoint_url=None, regional_endpoints=None, duration_seconds=ONE_HOUR_IN_SECONDS, lead_time=DEFAULT_REFRESH_WINDOW_IN_SECONDS,
+        batch_window=DEFAULT_BATCH_WINDOW_IN_SECONDS, retry_interval=DEFAULT_RETRY_INTERVAL_IN_SECONDS,
+        max_workers=8):
+        self.patterns = patterns or ["*"]
+        self.duration_seconds = duration_seconds
+        self.lead_time = lead_time
+        self.batch_window = batch_window
+        self.retry_interval = retry_interval
+        self.max_workers = max_workers
+
+        self.credentials = Credentials()
+        # a single sts client, sourcing the cached bastion-sts credentials, is reused for every batch.
+        self.sts = STS(
+            bastion=bastion,
+            bastion_sts=bastion_sts,
+            region=region,
+            credentials=self.credentials,
+            cache=Cache(bastion=bastion, bastion_sts=bastion_sts, region=region),
+            endpoint_url=endpoint_url,
+            regional_endpoints=regional_endpoints
+        )
+        self._retry_at = {}
+        self._stopped = threading.Event()
+
+    def get_profiles(self):
+        """ Return the assume role profiles that match the patterns.
+
+        :return: The matching profiles with a 'role_arn' attribute.
+        :rtype: list
+        """
+        return [
+            profile for profile in self.credentials.get_role_profiles()
+            if any(fnmatch.fnmatchcase(profile, pattern) for pattern in self.patterns)
+        ]
+
+    def get_due_times(self):
+        """ Return when each profile is due for a refresh as epoch seconds.
+
+        Profiles without an expiration are due immediately. Profiles that failed to refresh are retried after the retry interval.
+
+        :return: The epoch seconds each profile is due.
+        :rtype: dict
+        """
+        due_times = {}
+        for profile in self.get_profiles():
+            try:
+                due_time = self.credentials.get_expiration_epoch(profile) - self.lead_time
+            except (KeyError, ValueError):
+                due_time = 0
+            due_times[profile] = max(due_time, self._retry_at.get(profile, 0))
+        return due_times
+
+    def refresh_due(self):
+        """ Refresh every profile that is due within the batch window with a single credentials file write.
+
+        :return: The sts credentials, or the exception raised, for each refreshed profile.
+        :rtype: dict
+        """
+        self.credentials = self.sts.credentials = Credentials()
+        now = time.time()
+        batch = [profile for profile, due_time in self.get_due_times().items() if due_time <= now + self.batch_window]
+        if not batch:
+            return {}
+
+        # the role cache must not hand back the credentials that are being replaced.
+        results = self.sts.assume_roles(batch, duration_seconds=self.duration_seconds,
+            refresh_window=self.lead_time + self.batch_window, max_workers=self.max_workers)
+
+        for profile, result in results.items():
+            if isinstance(result, Exception):
+                self._retry_at[profile] = now + self.retry_interval
+            else:
+                self._retry_at.pop(profile, None)
+                self.credentials.set_sts_credentials(profile, result)
+
+        if any(not isinstance(result, Exception) for result in results.values()):
+            self.credentials.write()
+        return results
+
+    def get_next_due_time(self):
+        """ Return when the next profile is due for a refresh as epoch seconds.
+
+        :return: The earliest due time or None when there are no matching profiles.
+        :rtype: float
+        """
+        due_times = self.get_due_times()
+        return min(due_times.values()) if due_times else None
+
+    def watch(self, max_sleep=300):
+        """ Refresh profiles as they come due until stopped.
+
+        The credentials file is re-read on every wake up, so profiles that are added or refreshed elsewhere are picked up.
+
+        :param max_sleep: The maximum number of seconds to sleep between checks.
+        :type max_sleep: int
+        """
+        while not self._stopped.is_set():
+            report(self.refresh_due())
+
+            next_due_time = self.get_next_due_time()
+            sleep = max_sleep if next_due_time is None else min(max(next_due_time - time.time(), 1), max_sleep)
+            self._stopped.wait(sleep)
+
+    def stop(self):
+        """ Stop watching. Safe to call from another thread. """
+        self._stopped.set()
+
+
+def report(results):
+    """ Output whether or not each profile was refreshed.
+
+    :param results: The sts credentials, or the exception raised, for each profile.
+    :type results: dict
+    :return: Whether or not every profile was refreshed.
+    :rtype: bool
+    """
+    for profile, result in results.items():
+        if isinstance(result, Exception):
+            click.echo("Failed to set the '{}' profile with sts assume role credentials: {}".format(profile, result))
+        else:
+            click.echo("Setting the '{}' profile with sts assume role credentials. They will expire at {}.".format(
+                profile, expiration.parse(result["Expiration"]).astimezone().strftime("%H:%M:%S")))
+    return not any(isinstance(result, Exception) for result in results.values())
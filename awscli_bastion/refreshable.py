@@ -0,0 +1,104 @@
+""" Build boto3 sessions whose credentials are refreshed in-process, without a credential_process. """
+
+from .cache import Cache, DEFAULT_REFRESH_WINDOW_IN_SECONDS
+from .credentials import Credentials
+from .sts import STS, ONE_HOUR_IN_SECONDS, TWELVE_HOURS_IN_SECONDS
+
+
+def _to_metadata(sts_creds):
+    """ Convert sts credentials into the metadata botocore refreshable credentials expect.
+
+    :param sts_creds: sts credentials
+    :type sts_creds: dict
+    :return: The credential metadata.
+    :rtype: dict
+    """
+    return {
+        "access_key": sts_creds["AccessKeyId"],
+        "secret_key": sts_creds["SecretAccessKey"],
+        "token": sts_creds["SessionToken"],
+        "expiry_time": sts_creds["Expiration"]
+    }
+
+
+def _create_session(refresh_using, region):
+    """ Create a boto3 session backed by botocore refreshable credentials.
+
+    :param refresh_using: Returns fresh sts credentials.
+    :type refresh_using: callable
+    :param region: The region used when creating new AWS connections.
+    :type region: str
+    :return: The boto3 session.
+    :rtype: boto3.Session
+    """
+    from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
+    import boto3
+    import botocore.session
+
+    class BastionProvider(CredentialProvider):
+        METHOD = "bastion"
+
+        def load(self):
+            return RefreshableCredentials.create_from_metadata(
+                metadata=_to_metadata(refresh_using()),
+                refresh_using=lambda: _to_metadata(refresh_using()),
+                method=self.METHOD
+            )
+
+    botocore_session = botocore.session.get_session()
+    botocore_session.register_component("credential_provider", CredentialResolver([BastionProvider()]))
+    return boto3.Session(botocore_session=botocore_session, region_name=region)
+
+
+def session(profile="bastion-sts", bastion="bastion", bastion_sts="bastion-sts", region="us-west-2",
+    duration_seconds=ONE_HOUR_IN_SECONDS, session_duration_seconds=TWELVE_HOURS_IN_SECONDS,
+    refresh_window=DEFAULT_REFRESH_WINDOW_IN_SECONDS, mfa_prompt=True):
+    """ Return a boto3 session for the profile whose credentials are refreshed in-process.
+
+    The bastion-sts credentials come from the same cache as 'bastion get-session-token' and assume role
+    credentials from the same per role cache as 'bastion assume-role'. The mfa code is only prompted for
+    when the cached bastion-sts credentials expire. A failed refresh raises an exception instead of exiting the process.
+
+    :param profile: The bastion-sts profile or an assume role profile.
+    :type profile: str
+    :param bastion: The profile containing the long-lived IAM credentials.
+    :type bastion: str
+    :param bastion_sts: The profile that assume role profiles source.
+    :type bastion_sts: str
+    :param region: The region used when creating new AWS connections.
+    :type region: str
+    :param duration_seconds: The duration, in seconds, that assume role credentials should remain valid.
+    :type duration_seconds: int
+    :param session_duration_seconds: The duration, in seconds, that bastion-sts credentials should remain valid.
+    :type session_duration_seconds: int
+    :param refresh_window: Refresh cached assume role credentials that expire within this many seconds.
+    :type refresh_window: int
+    :param mfa_prompt: Whether or not to prompt for the mfa code. Otherwise, refreshing expired bastion-sts credentials
+        raises a RuntimeError, so long-lived workers never block on a prompt.
+    :type mfa_prompt: bool
+    :return: The boto3 session.
+    :rtype: boto3.Session
+    """
+    credentials = Credentials()
+    cache = Cache(bastion=bastion, bastion_sts=bastion_sts, region=region)
+    bastion_sts_session = _create_session(
+        lambda: STS(
+            bastion=bastion, bastion_sts=bastion_sts, region=region, credentials=credentials, cache=cache
+        )._get_session_token(duration_seconds=session_duration_seconds, prompt=mfa_prompt),
+        region
+    )
+    if profile == bastion_sts:
+        return bastion_sts_session
+
+    sts = STS(
+        bastion=bastion,
+        bastion_sts=bastion_sts,
+        region=region,
+        credentials=credentials,
+        cache=cache,
+        session=bastion_sts_session
+    )
+    return _create_session(
+        lambda: sts._assume_role(profile, duration_seconds=duration_seconds, refresh_window=refresh_window),
+        region
+    )
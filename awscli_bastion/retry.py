@@ -0,0 +1,194 @@
+""" Retry sts and iam calls with jittered exponential backoff and a shared, adaptive rate limit.
+
+botocore's own retries are disabled on the clients created here, so every attempt goes through
+the rate limiter and is counted.
+"""
+
+from . import metrics, timings
+import click
+import collections
+import random
+import threading
+import time
+
+
+RETRYABLE = "retryable"
+THROTTLED = "throttled"
+FATAL = "fatal"
+
+THROTTLING_ERROR_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled", "RequestThrottledException",
+    "TooManyRequestsException", "RequestLimitExceeded", "PriorRequestNotComplete", "SlowDown"
+}
+TRANSIENT_ERROR_CODES = {
+    "RequestTimeout", "RequestTimeoutException", "InternalError", "InternalFailure", "ServiceUnavailable",
+    "IDPCommunicationError"
+}
+
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_MAX_RATE = 500
+
+
+def classify(error):
+    """ Classify an error raised by a boto3 call.
+
+    :param error: The error raised by the call.
+    :type error: Exception
+    :return: Either 'retryable', 'throttled' or 'fatal'.
+    :rtype: str
+    """
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if code in THROTTLING_ERROR_CODES or status == 429:
+            return THROTTLED
+        if code in TRANSIENT_ERROR_CODES or status in (500, 502, 503, 504):
+            return RETRYABLE
+        return FATAL
+
+    try:
+        from botocore.exceptions import ConnectionError, HTTPClientError
+    except ImportError:
+        return FATAL
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return RETRYABLE
+    return FATAL
+
+
+def create_client(session, service_name, **kwargs):
+    """ Create a boto3 client with botocore's own retries disabled.
+
+    :param session: The boto3 session.
+    :type session: boto3.Session
+    :param service_name: The aws service, e.g. 'sts' or 'iam'.
+    :type service_name: str
+    :return: The client.
+    :rtype: botocore.client.BaseClient
+    """
+    from botocore.config import Config
+    return session.client(service_name, config=Config(retries={"mode": "standard", "total_max_attempts": 1}), **kwargs)
+
+
+class TokenBucket:
+    """ A rate limiter shared by concurrent workers that adapts to throttling.
+
+    Like botocore's adaptive retry mode, calls are not limited until the first throttle. The rate then starts
+    at half the rate calls were being sent, is halved on every throttle and grows back by one call per second
+    for every rate's worth of successful calls, up to the maximum rate.
+    """
+
+    def __init__(self, rate=None, max_rate=DEFAULT_MAX_RATE, min_rate=1):
+        self.rate = None if rate is None else float(rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self._tokens = self.rate or 0.0
+        self._updated_at = time.monotonic()
+        self._successes = 0
+        self._sent = collections.deque()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self):
+        """ Wait until a call is allowed. """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    # measure the send rate over the last second for the first throttle.
+                    self._sent.append(now)
+                    while self._sent[0] < now - 1:
+                        self._sent.popleft()
+                    return
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        """ Additively increase the rate after a rate's worth of successful calls. """
+        with self._lock:
+            if self.rate is None:
+                return
+            self._successes += 1
+            if self._successes >= self.rate:
+                self._successes = 0
+                self.rate = min(self.max_rate, self.rate + 1)
+
+    def on_throttle(self):
+        """ Halve the rate and drain the bucket. """
+        with self._lock:
+            rate = self.rate if self.rate is not None else min(self.max_rate, len(self._sent))
+            self.rate = max(self.min_rate, rate / 2)
+            self._tokens = 0
+            self._updated_at = time.monotonic()
+            self._successes = 0
+            self._sent.clear()
+
+
+class Retrier:
+    """ Call boto3 functions, retrying retryable and throttled errors with jittered exponential backoff. """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=0.2, max_delay=20, rate_limiter=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket()
+        self.retries = 0
+        self.throttles = 0
+        self._lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        """ Call the function until it succeeds, fails with a fatal error or runs out of attempts.
+
+        :param function: The boto3 client method or any other callable.
+        :type function: callable
+        :raises Exception: The last error raised by the function.
+        :return: The function's return value.
+        """
+        attempt = 1
+        throttles = 0
+        started_at = time.perf_counter()
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                if kind == FATAL or attempt >= self.max_attempts:
+                    duration = time.perf_counter() - started_at
+                    operation = getattr(function, "__name__", None)
+                    timings.emit("aws_call", duration, operation=operation, attempts=attempt, error=type(e).__name__)
+                    metrics.aws_call(operation, duration, attempt, throttles, error=type(e).__name__)
+                    raise
+
+                with self._lock:
+                    self.retries += 1
+                    if kind == THROTTLED:
+                        self.throttles += 1
+                if kind == THROTTLED:
+                    throttles += 1
+                    self.rate_limiter.on_throttle()
+
+                # full jitter: sleep a random amount up to the exponential backoff.
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))))
+                attempt += 1
+            else:
+                self.rate_limiter.on_success()
+                duration = time.perf_counter() - started_at
+                operation = getattr(function, "__name__", None)
+                timings.emit("aws_call", duration, operation=operation, attempts=attempt)
+                metrics.aws_call(operation, duration, attempt, throttles)
+                return result
+
+    def report(self):
+        """ Output how many calls were retried and throttled, when there were any, to stderr. """
+        if self.retries:
+            click.echo("Retried {} sts and iam calls, {} of them were throttled.".format(
+                self.retries, self.throttles), err=True)
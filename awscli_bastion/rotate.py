@@ -1,8 +1,6 @@
-from configparser import ConfigParser
+from . import timings
+from .retry import Retrier, create_client
 import click
-import boto3
-import pathlib
-import time
 import sys
 
 class Rotate:
@@ -13,23 +11,27 @@ class Rotate:
         self.bastion = bastion
         self.region = region
         self.credentials = credentials
+        self.retrier = Retrier()
+
+        import boto3
 
         try:
             self.bastion_session = boto3.Session(profile_name=bastion,region_name=self.region)
             self.bastion_sts_session = boto3.Session(profile_name=bastion_sts,region_name=self.region)
 
-            iam = self.bastion_session.client("iam")
-            self.username = username if username else iam.get_user()["User"]["UserName"]
+            iam = create_client(self.bastion_session, "iam")
+            self.username = username if username else self.retrier.call(iam.get_user)["User"]["UserName"]
 
         except Exception as e:
             print(e)
             sys.exit(1)
 
+    @timings.timed("Rotate.create_access_key")
     def create_access_key(self):
         """ Create aws access key for the bastion profile. """
         try:
-            iam_client = self.bastion_sts_session.client("iam")
-            return iam_client.create_access_key(UserName=self.username)
+            iam_client = create_client(self.bastion_sts_session, "iam")
+            return self.retrier.call(iam_client.create_access_key, UserName=self.username)
 
         except Exception as e:
             print(e)
@@ -48,6 +50,7 @@ class Rotate:
         # return iam.AccessKey('user_name', access_key.access_key_id).status == "Active"
         return True
 
+    @timings.timed("Rotate.retire_bastion_access_key")
     def retire_bastion_access_key(self):
         """
         Retire aws access key for the bastion profile.
@@ -56,16 +59,17 @@ class Rotate:
         bastion_aws_access_key_id = self.credentials.config.get(
             self.bastion, 'aws_access_key_id', fallback=None)
 
-        iam = self.bastion_sts_session.resource("iam")
-        access_key = iam.AccessKey(self.username, bastion_aws_access_key_id)
+        iam = create_client(self.bastion_sts_session, "iam")
         if self.deactivate:
-            access_key.deactivate()
+            self.retrier.call(iam.update_access_key,
+                UserName=self.username, AccessKeyId=bastion_aws_access_key_id, Status="Inactive")
         else:
-            access_key.delete()
+            self.retrier.call(iam.delete_access_key, UserName=self.username, AccessKeyId=bastion_aws_access_key_id)
         
         self.credentials.config[self.bastion]["aws_access_key_id"] = ""
         self.credentials.config[self.bastion]["aws_secret_access_key"] = ""
     
+    @timings.timed("Rotate.write")
     def write(self, access_key):
         """ Write access key to the bastion profile in the aws share credentials file.
 
@@ -76,6 +80,7 @@ class Rotate:
         self.credentials.config[self.bastion]["aws_secret_access_key"] = access_key["AccessKey"]["SecretAccessKey"]
         self.credentials.write()
 
+    @timings.timed("Rotate.rotate")
     def rotate(self):
         """ Rotate aws access key credentials for the bastion profile. """
         access_key = self.create_access_key()
@@ -1,30 +1,57 @@
-from botocore.exceptions import ClientError
+from . import endpoints, expiration, metrics, timings
+from .cache import DEFAULT_REFRESH_WINDOW_IN_SECONDS
+from .retry import Retrier, create_client
 from datetime import timedelta
-from dateutil.tz import tzutc
-import boto3
 import click
-import datetime
 import getpass
 import sys
+import threading
 
 
 ONE_HOUR_IN_SECONDS = timedelta(hours=1).seconds
 TWELVE_HOURS_IN_SECONDS = timedelta(hours=12).seconds
 
+def _identity(response):
+    """ Return the identity to cache from an sts.get_caller_identity() response.
+
+    :param response: The sts.get_caller_identity() response.
+    :type response: dict
+    :return: The 'UserName', 'Account' and 'Arn' of the caller.
+    :rtype: dict
+    """
+    return {
+        "UserName": response["Arn"].split("/")[-1],
+        "Account": response["Account"],
+        "Arn": response["Arn"]
+    }
+
+
 class STS:
     """ A small class that wraps relevant boto3 sts function calls. """
 
     def __init__(self, bastion="bastion", bastion_sts="bastion-sts", region="us-west-2",
-        credentials=None, cache=None):
+        credentials=None, cache=None, session=None, source_cache=False, retrier=None,
+        endpoint_url=None, regional_endpoints=None):
         self.bastion = bastion
         self.bastion_sts = bastion_sts
         self.region = region
         self.credentials = credentials
         self.cache = cache
+        self.session = session
+        self.source_cache = source_cache
+        # shared by every concurrent worker, so they back off together when sts throttles.
+        self.retrier = retrier or Retrier()
+        self.endpoint_url = endpoint_url
+        self.regional_endpoints = regional_endpoints
+        self._client = None
+        self._client_source = None
+        self._role_session_name = None
+        self._lock = threading.RLock()
 
     def is_mfa_code_invalid(self, mfa_code):
         return len(mfa_code) != 6 or not mfa_code.isdigit()
     
+    @timings.timed("STS.mfa_prompt")
     def _get_mfa_code(self, mfa_serial):
         """ Prompt the user for the mfa code and return it.
 
@@ -38,7 +65,8 @@ class STS:
             mfa_code = getpass.getpass("Enter MFA code for {}: ".format(mfa_serial))
             is_mfa_code_invalid = self.is_mfa_code_invalid(mfa_code)
             if is_mfa_code_invalid:
-                click.echo("Warning: The MFA code must be 6 digits. For example: 123456")
+                # stderr, since stdout is evaluated by the shell or parsed by awscli.
+                click.echo("Warning: The MFA code must be 6 digits. For example: 123456", err=True)
         return mfa_code
 
     def get_session_token(self, mfa_code=None, mfa_serial=None,
@@ -58,68 +86,309 @@ class STS:
         if not mfa_serial:
             mfa_serial = self.credentials.get_mfa_serial(bastion_sts=self.bastion_sts)
 
-        cached_sts_creds = None
+        try:
+            return self._get_session_token(mfa_code=mfa_code, mfa_serial=mfa_serial, duration_seconds=duration_seconds)
+        except Exception as e:
+            click.echo(e)
+            sys.exit(1)
+
+    @timings.timed("STS.get_session_token")
+    def _get_session_token(self, mfa_code=None, mfa_serial=None,
+        duration_seconds=TWELVE_HOURS_IN_SECONDS, prompt=True):
+        """ Get the short-lived credentials from the cache or sts.get_session_token() without exiting on failure.
+
+        Concurrent processes that miss the cache wait on a lock file while a single process prompts
+        for the mfa code and refreshes the credentials. The waiting processes then read the fresh cache.
+
+        :param mfa_code: The value provided by the MFA device.
+        :type mfa_code: str
+        :param mfa_serial: The identification number of the MFA device that is associated with the IAM user.
+        :type mfa_serial: str
+        :param duration_seconds: The duration, in seconds, that the credentials should remain valid.
+        :type duration_seconds: str
+        :param prompt: Whether or not to prompt for the mfa code when it is missing or invalid.
+        :type prompt: bool
+        :raises ValueError: The bastion-sts profile does not have the 'mfa_serial' attribute.
+        :raises RuntimeError: The credentials must be refreshed, the mfa code is missing and 'prompt' is not set.
+        :raises LockTimeout: Another process held the refresh lock for too long.
+        :raises ClientError: Failed to get the session token, after retrying retryable and throttled errors.
+        :return: sts credentials
+        :rtype: dict
+        """
+        if not mfa_serial:
+            mfa_serial = self.credentials.get(self.bastion_sts, "mfa_serial")
+            if not mfa_serial:
+                raise ValueError("An error occured when getting the mfa_serial from '{}' profile.".format(self.bastion_sts))
+        # cached credentials issued for another mfa device are refreshed.
+        self.cache.mfa_serial = mfa_serial
+
         if not mfa_code and not self.cache.is_expired():
-            cached_sts_creds = self.cache.read()
-
-        if cached_sts_creds:
-            sts_creds = cached_sts_creds
-        else:
-            if not mfa_code or self.is_mfa_code_invalid(mfa_code):
-                mfa_code = self._get_mfa_code(mfa_serial)
-
-            session = boto3.Session(profile_name=self.bastion, region_name=self.region)
-            sts = session.client("sts")
-            try:
-                sts_creds = sts.get_session_token(
-                    DurationSeconds=duration_seconds,
-                    SerialNumber=mfa_serial,
-                    TokenCode=mfa_code
-                )["Credentials"]
-                sts_creds["Expiration"] = sts_creds["Expiration"].isoformat()
-
-            except Exception as e:
-                click.echo(e)
-                sys.exit(1)
+            return self._read_cache()
 
-        self.cache.write(sts_creds)
+        # single-flight: one process refreshes while the others wait for the fresh cache.
+        lock = self.cache.get_lock()
+        is_refreshed = (lambda: not self.cache.is_expired()) if not mfa_code else None
+        if not lock.acquire(until=is_refreshed):
+            return self._read_cache()
+
+        try:
+            if not mfa_code and not self.cache.is_expired():
+                return self._read_cache()
+            if not prompt and (not mfa_code or self.is_mfa_code_invalid(mfa_code)):
+                raise RuntimeError("The '{}' credentials expired and refreshing them requires an mfa code.".format(
+                    self.bastion_sts))
+            sts_creds = self._refresh_session_token(mfa_code, mfa_serial, duration_seconds)
+            metrics.cache_lookup(self.bastion_sts, "session", False, sts_creds)
+            return sts_creds
+        finally:
+            lock.release()
+
+    def _read_cache(self):
+        """ Read the cached bastion-sts credentials and record the cache hit.
+
+        :return: sts credentials
+        :rtype: dict
+        """
+        sts_creds = self.cache.read()
+        metrics.cache_lookup(self.bastion_sts, "session", True, sts_creds)
         return sts_creds
 
-    def assume_role(self, profile, duration_seconds=ONE_HOUR_IN_SECONDS):
-        """Get the short-lived credentials from sts.assume_role().
+    @timings.timed("STS.refresh_session_token")
+    def _refresh_session_token(self, mfa_code, mfa_serial, duration_seconds):
+        """ Get the short-lived credentials from sts.get_session_token() and cache them.
 
-        :param profile: The profile that contains the 'role_arn' and 'source_profile' attributes.
-        :type profile: str
+        :param mfa_code: The value provided by the MFA device. Prompt for it when it is missing or invalid.
+        :type mfa_code: str
+        :param mfa_serial: The identification number of the MFA device that is associated with the IAM user.
+        :type mfa_serial: str
         :param duration_seconds: The duration, in seconds, that the credentials should remain valid.
         :type duration_seconds: str
+        :raises ClientError: Failed to get the session token, after retrying retryable and throttled errors.
         :return: sts credentials
         :rtype: dict
         """
-        session = boto3.Session(profile_name=self.bastion_sts, region_name=self.region)
-        sts = session.client("sts")
+        if not mfa_code or self.is_mfa_code_invalid(mfa_code):
+            mfa_code = self._get_mfa_code(mfa_serial)
+
+        import boto3
+        session = boto3.Session(profile_name=self.bastion, region_name=self.region)
+        sts = self._create_client(session)
+        sts_creds = self.retrier.call(
+            sts.get_session_token,
+            DurationSeconds=duration_seconds,
+            SerialNumber=mfa_serial,
+            TokenCode=mfa_code
+        )["Credentials"]
+        sts_creds["Expiration"] = sts_creds["Expiration"].isoformat()
+
+        self.cache.write(sts_creds)
 
         try:
-            role_arn = self.credentials.config[profile]["role_arn"]
+            self.cache.write_identity(_identity(self.retrier.call(sts.get_caller_identity)), sts_creds["Expiration"])
         except Exception:
-            click.echo("An error occured when getting the role_arn from '{}' profile.".format(profile))
-            sys.exit(1)
-        
-        timestamp = datetime.datetime.now(tzutc()).strftime("%Y-%m-%d")
+            pass    # the identity is looked up again when it is needed.
+
+        return sts_creds
+
+    @timings.timed("STS.get_caller_identity")
+    def get_caller_identity(self):
+        """ Get the bastion iam user identity from the cache or sts.get_caller_identity().
+
+        The identity is cached alongside the bastion-sts credentials, with the same lifetime,
+        so that commands do not need to look up the iam user on every invocation.
+
+        :return: The 'UserName', 'Account' and 'Arn' of the bastion iam user.
+        :rtype: dict
+        """
+        identity = self.cache.read_identity() if self.cache else None
+        if identity:
+            return identity
+
+        identity = _identity(self._call("get_caller_identity"))
+        if self.cache and not self.cache.is_expired():
+            self.cache.write_identity(identity, self.cache.read()["Expiration"])
+        return identity
+
+    @timings.timed("STS.get_client")
+    def _get_client(self):
+        """ Return the sts client for the bastion-sts profile.
+
+        The client is shared, boto3 clients are safe to use across threads.
+        It uses the given boto3 session, a session with the cached bastion-sts credentials when 'source_cache' is set
+        or, by default, a session for the bastion-sts profile. botocore loads the credentials once, so the client is
+        created again when they change, e.g. when 'bastion get-session-token' writes fresh credentials.
+
+        :return: sts client
+        :rtype: botocore.client.STS
+        """
+        source = self._get_client_source()
+        with self._lock:
+            if self._client is None or source != self._client_source:
+                session = self.session
+                if session is None and self.source_cache:
+                    import boto3
+                    sts_creds = self._get_session_token()
+                    session = boto3.Session(
+                        aws_access_key_id=sts_creds["AccessKeyId"],
+                        aws_secret_access_key=sts_creds["SecretAccessKey"],
+                        aws_session_token=sts_creds["SessionToken"],
+                        region_name=self.region
+                    )
+                elif session is None:
+                    import boto3
+                    session = boto3.Session(profile_name=self.bastion_sts, region_name=self.region)
+                self._client = self._create_client(session)
+                self._client_source = source
+        return self._client
+
+    def _get_client_source(self):
+        """ Return what identifies the credentials the sts client is created with.
+
+        :return: The signature of the bastion-sts cache entry or of the profiles, or None for a given boto3 session.
+        :rtype: object
+        """
+        if self.session is not None:
+            return None
+        if self.source_cache:
+            return self.cache.backend.get_entry_signature(self.cache.bastion_sts_cache_name)
+        return self.credentials.backend.get_profiles_signature() if self.credentials else None
+
+    def _call(self, operation, **kwargs):
+        """ Call an sts operation, creating the client again once if its credentials have expired.
+
+        :param operation: The boto3 method, e.g. 'assume_role'.
+        :type operation: str
+        :raises ClientError: The call failed, after retrying retryable and throttled errors.
+        :return: The sts response.
+        :rtype: dict
+        """
         try:
-            iam = boto3.client('iam')
-            username = iam.get_user()["User"]["UserName"]
-            role_session_name = "{}-{}".format(username, timestamp)
-        except Exception:
-            role_session_name = "bastion-assume-role-{}".format(timestamp)
+            return self.retrier.call(getattr(self._get_client(), operation), **kwargs)
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") not in ("ExpiredToken", "ExpiredTokenException"):
+                raise
+        with self._lock:
+            self._client = None
+        return self.retrier.call(getattr(self._get_client(), operation), **kwargs)
+
+    def _create_client(self, session):
+        """ Create an sts client for the resolved endpoint.
+
+        :param session: The boto3 session.
+        :type session: boto3.Session
+        :return: sts client
+        :rtype: botocore.client.STS
+        """
+        region, endpoint_url = endpoints.resolve(self.credentials, [self.bastion_sts, self.bastion], self.region,
+            endpoint_url=self.endpoint_url, regional_endpoints=self.regional_endpoints)
+        return create_client(session, "sts", region_name=region, endpoint_url=endpoint_url)
+
+    def _get_role_session_name(self):
+        """ Return the role session name used for sts.assume_role().
+
+        :return: The iam username and date, or a generic name if the username is unavailable.
+        :rtype: str
+        """
+        with self._lock:
+            if self._role_session_name is None:
+                timestamp = expiration.now().strftime("%Y-%m-%d")
+                try:
+                    username = self.get_caller_identity()["UserName"]
+                    self._role_session_name = "{}-{}".format(username, timestamp)
+                except Exception:
+                    self._role_session_name = "bastion-assume-role-{}".format(timestamp)
+        return self._role_session_name
+
+    @timings.timed("STS.assume_role")
+    def _assume_role(self, profile, duration_seconds=ONE_HOUR_IN_SECONDS,
+        refresh_window=DEFAULT_REFRESH_WINDOW_IN_SECONDS):
+        """ Get the short-lived credentials from sts.assume_role() without exiting on failure.
+
+        Cached credentials are returned without calling sts when they are valid for longer than the refresh window.
+
+        :param profile: The profile that contains the 'role_arn' and 'source_profile' attributes.
+        :type profile: str
+        :param duration_seconds: The duration, in seconds, that the credentials should remain valid.
+        :type duration_seconds: int
+        :param refresh_window: Refresh cached credentials that expire within this many seconds.
+        :type refresh_window: int
+        :raises ValueError: The profile does not have the 'role_arn' attribute.
+        :raises ClientError: Failed to assume the role, after retrying retryable and throttled errors.
+        :return: sts credentials
+        :rtype: dict
+        """
+        role_arn = self.credentials.get(profile, "role_arn")
+        if not role_arn:
+            raise ValueError("An error occured when getting the role_arn from '{}' profile.".format(profile))
+
+        role_session_name = self._get_role_session_name()
+        if self.cache:
+            cached_sts_creds = self.cache.read_role(role_arn, role_session_name, duration_seconds,
+                refresh_window=refresh_window)
+            if cached_sts_creds:
+                metrics.cache_lookup(profile, "role", True, cached_sts_creds)
+                return cached_sts_creds
+
+        sts_creds = self._call(
+            "assume_role",
+            RoleArn=role_arn,
+            RoleSessionName=role_session_name,
+            DurationSeconds=duration_seconds
+        )["Credentials"]
+        sts_creds["Expiration"] = sts_creds["Expiration"].isoformat()
+
+        if self.cache:
+            self.cache.write_role(role_arn, role_session_name, duration_seconds, sts_creds)
+        metrics.cache_lookup(profile, "role", False, sts_creds)
+        return sts_creds
 
+    def assume_role(self, profile, duration_seconds=ONE_HOUR_IN_SECONDS,
+        refresh_window=DEFAULT_REFRESH_WINDOW_IN_SECONDS):
+        """Get the short-lived credentials from sts.assume_role().
+
+        :param profile: The profile that contains the 'role_arn' and 'source_profile' attributes.
+        :type profile: str
+        :param duration_seconds: The duration, in seconds, that the credentials should remain valid.
+        :type duration_seconds: str
+        :param refresh_window: Refresh cached credentials that expire within this many seconds.
+        :type refresh_window: int
+        :return: sts credentials
+        :rtype: dict
+        """
         try:
-            sts_creds = sts.assume_role(
-                RoleArn=role_arn,
-                RoleSessionName=role_session_name,
-                DurationSeconds=duration_seconds
-            )["Credentials"]
-        except ClientError as e:
+            return self._assume_role(profile, duration_seconds=duration_seconds, refresh_window=refresh_window)
+        except Exception as e:
             click.echo(e)
             sys.exit(1)
-        
-        return sts_creds
+
+    @timings.timed("STS.assume_roles")
+    def assume_roles(self, profiles, duration_seconds=ONE_HOUR_IN_SECONDS,
+        refresh_window=DEFAULT_REFRESH_WINDOW_IN_SECONDS, max_workers=8):
+        """ Get the short-lived credentials from sts.assume_role() for many profiles concurrently.
+
+        The sts client and role session name are resolved once and shared by every worker.
+
+        :param profiles: The profiles that contain the 'role_arn' and 'source_profile' attributes.
+        :type profiles: list
+        :param duration_seconds: The duration, in seconds, that the credentials should remain valid.
+        :type duration_seconds: int
+        :param refresh_window: Refresh cached credentials that expire within this many seconds.
+        :type refresh_window: int
+        :param max_workers: The maximum number of concurrent sts.assume_role() calls.
+        :type max_workers: int
+        :return: The sts credentials, or the exception raised, for each profile in the given order.
+        :rtype: dict
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(profiles) or 1))) as executor:
+            futures = [
+                (profile, executor.submit(self._assume_role, profile, duration_seconds, refresh_window))
+                for profile in profiles
+            ]
+
+        results = {}
+        for profile, future in futures:
+            error = future.exception()
+            results[profile] = error if error else future.result()
+        return results
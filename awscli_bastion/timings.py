@@ -0,0 +1,133 @@
+""" Opt-in timings of each phase of a bastion command, output as json lines.
+
+Enable them with the --timings option or the BASTION_TIMINGS=1 environment variable. The lines go to stderr,
+or are appended to the --timings-file or $BASTION_TIMINGS_FILE file, so stdout stays clean for credential_process::
+
+    $ BASTION_TIMINGS=1 bastion credential-process dev-admin > /dev/null
+    {"ts": 1700000000.123, "pid": 4242, "command": "credential-process", "phase": "imports", "duration_ms": 41.2}
+    {"ts": 1700000000.125, "pid": 4242, "command": "credential-process", "phase": "Cache.read_role", "duration_ms": 0.3, "cache": "hit"}
+
+Every line has the 'ts', 'pid', 'command', 'phase' and 'duration_ms' keys. Cache lookups add 'cache', failed phases
+add 'error' and aws calls add 'operation' and 'attempts'. The pid groups the lines of one invocation, so they can be
+aggregated across many invocations. Timings cost a single check per hook while they are disabled.
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+
+# as early as possible, the cli imports this module before its other modules.
+_STARTED_AT = time.perf_counter()
+
+_write = None
+_context = {}
+_lock = threading.Lock()
+
+
+class _FileWriter:
+    """ Append lines to a file with a single write per line, so concurrent invocations never interleave their lines. """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def __call__(self, line):
+        os.write(self.fd, line.encode("utf-8"))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _StderrWriter:
+    """ Write lines to stderr, leaving stdout clean for credential_process. """
+
+    def __call__(self, line):
+        sys.stderr.write(line)
+        sys.stderr.flush()
+
+    def close(self):
+        pass
+
+
+def enable(path=None, command=None):
+    """ Start emitting timings and emit how long the cli took to import.
+
+    :param path: The file to append the timings to. Defaults to stderr.
+    :type path: str
+    :param command: The name of the cli command, added to every line.
+    :type command: str
+    """
+    global _write
+    _write = _FileWriter(path) if path else _StderrWriter()
+
+    _context.clear()
+    _context.update(pid=os.getpid(), command=command)
+    emit("imports", time.perf_counter() - _STARTED_AT)
+
+
+def disable():
+    """ Stop emitting timings and close the timings file. """
+    global _write
+    if _write is not None:
+        _write.close()
+        _write = None
+
+
+def is_enabled():
+    return _write is not None
+
+
+def emit(phase, duration, **fields):
+    """ Emit a json line for the phase when timings are enabled.
+
+    :param phase: The name of the phase, typically 'Class.method'.
+    :type phase: str
+    :param duration: The duration of the phase in seconds.
+    :type duration: float
+    :param fields: Extra fields, such as 'cache' or 'error'.
+    :type fields: dict
+    """
+    if _write is None:
+        return
+
+    record = {"ts": round(time.time(), 3), "pid": _context["pid"], "command": _context["command"],
+        "phase": phase, "duration_ms": round(duration * 1000, 3)}
+    record.update(fields)
+    line = json.dumps(record) + "\n"
+    with _lock:
+        _write(line)
+
+
+def timed(phase, cache_hit=None):
+    """ Decorate a function to emit its duration, and whether it was a cache hit, as the phase.
+
+    :param phase: The name of the phase, typically 'Class.method'.
+    :type phase: str
+    :param cache_hit: Return whether the function's return value is a cache hit.
+    :type cache_hit: callable
+    :return: The decorator.
+    :rtype: callable
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _write is None:
+                return function(*args, **kwargs)
+
+            started_at = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                emit(phase, time.perf_counter() - started_at, error=type(e).__name__)
+                raise
+
+            if cache_hit is None:
+                emit(phase, time.perf_counter() - started_at)
+            else:
+                emit(phase, time.perf_counter() - started_at, cache="hit" if cache_hit(result) else "miss")
+            return result
+        return wrapper
+    return decorator
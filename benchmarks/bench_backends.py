@@ -0,0 +1,95 @@
+""" Compare the storage backends at 10, 1,000 and 10,000 profiles.
+
+Each operation is measured with a fresh backend, like a new bastion process:
+
+- lookup: read the 'role_arn' of a single profile.
+- upsert: set sts credentials on a single profile and write them.
+- cache:  write and read back an assume role cache entry.
+
+    $ python -m benchmarks.bench_backends --iterations 50
+"""
+
+from awscli_bastion.backends import FileBackend, SQLiteBackend, migrate
+from awscli_bastion.cache import Cache
+from awscli_bastion.credentials import Credentials
+from unittest import mock
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import time
+
+
+SIZES = (10, 1000, 10000)
+
+
+def make_home(home, size):
+    """ Populate a temporary home directory with the given number of assume role profiles. """
+    os.makedirs(os.path.join(home, ".aws/cli/cache"))
+    with open(os.path.join(home, ".aws/credentials"), "w") as f:
+        f.write("[bastion]\naws_access_key_id = AKIAEXAMPLE\naws_secret_access_key = secret\n\n")
+        f.write("[bastion-sts]\nmfa_serial = arn:aws:iam::123456789012:mfa/bench\nsource_profile = bastion\n\n")
+        for i in range(size):
+            f.write("[profile-{0}]\nrole_arn = arn:aws:iam::123456789012:role/role-{0}\n".format(i))
+            f.write("source_profile = bastion-sts\n\n")
+
+
+def sts_creds():
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    return {
+        "AccessKeyId": "ASIAEXAMPLE",
+        "SecretAccessKey": "secret",
+        "SessionToken": "token",
+        "Expiration": expiration.isoformat()
+    }
+
+
+def lookup(new_backend, profile):
+    Credentials(new_backend()).get(profile, "role_arn")
+
+
+def upsert(new_backend, profile):
+    credentials = Credentials(new_backend())
+    credentials.set_sts_credentials(profile, sts_creds())
+    credentials.write()
+
+
+def cache(new_backend, profile):
+    cache = Cache(backend=new_backend())
+    cache.write_role(profile, "bench", 3600, sts_creds())
+    cache.read_role(profile, "bench", 3600)
+
+
+def sample(operation, new_backend, size, iterations):
+    """ Return the wall time, in milliseconds, of each run of the operation. """
+    timings = []
+    for i in range(iterations):
+        profile = "profile-{}".format(i * 7919 % size)
+        start = time.perf_counter()
+        operation(new_backend, profile)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    print("{:<8} {:>7} {:<7} {:>12} {:>12}".format("backend", "size", "op", "median ms", "max ms"))
+    for size in SIZES:
+        with tempfile.TemporaryDirectory() as home, mock.patch.dict(os.environ, HOME=home, USERPROFILE=home):
+            make_home(home, size)
+            migrate(FileBackend(), SQLiteBackend())
+
+            for new_backend in (FileBackend, SQLiteBackend):
+                for operation in (lookup, upsert, cache):
+                    sample(operation, new_backend, size, 2)     # warm the index and page caches
+                    timings = sample(operation, new_backend, size, args.iterations)
+                    print("{:<8} {:>7} {:<7} {:>12.2f} {:>12.2f}".format(
+                        new_backend.name, size, operation.__name__, statistics.median(timings), max(timings)))
+
+
+if __name__ == "__main__":
+    main()
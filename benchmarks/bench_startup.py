@@ -0,0 +1,83 @@
+""" Measure the process startup time of 'bastion get-session-token' on a cache hit.
+
+Each sample spawns a fresh interpreter, exactly like awscli does for a credential_process.
+The 'eager' variant imports boto3, dateutil and humanize up front the way the cli used to,
+which gives a baseline for the lazy import fast path.
+
+    $ python -m benchmarks.bench_startup --iterations 20
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+LAZY = [sys.executable, "-m", "awscli_bastion.cli", "get-session-token"]
+EAGER = [
+    sys.executable, "-c",
+    "import boto3, dateutil.parser, dateutil.tz, humanize, sys;"
+    "from awscli_bastion.cli import main; sys.exit(main())",
+    "get-session-token"
+]
+
+
+def make_home(home):
+    """ Populate a temporary home directory with a bastion-sts cache hit. """
+    os.makedirs(os.path.join(home, ".aws/cli/cache"))
+    with open(os.path.join(home, ".aws/credentials"), "w") as f:
+        f.write("[bastion]\naws_access_key_id = AKIAEXAMPLE\naws_secret_access_key = secret\n\n")
+        f.write("[bastion-sts]\nmfa_serial = arn:aws:iam::123456789012:mfa/bench\n")
+        f.write("credential_process = bastion get-session-token\nsource_profile = bastion\n")
+
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=12)
+    with open(os.path.join(home, ".aws/cli/cache/bastion-sts.json"), "w") as f:
+        json.dump({
+            "AccessKeyId": "ASIAEXAMPLE",
+            "SecretAccessKey": "secret",
+            "SessionToken": "token",
+            "Expiration": expiration.isoformat(),
+            "Version": 1
+        }, f)
+
+
+def sample(cmd, env, iterations):
+    """ Return the wall time, in milliseconds, of each run of the command. """
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        make_home(home)
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+
+        # warm the filesystem and bytecode caches before measuring
+        sample(LAZY, env, 2)
+        sample(EAGER, env, 2)
+
+        results = {"lazy": sample(LAZY, env, args.iterations), "eager": sample(EAGER, env, args.iterations)}
+
+    for name, timings in results.items():
+        print("{:<6} median {:7.1f} ms   min {:7.1f} ms   max {:7.1f} ms".format(
+            name, statistics.median(timings), min(timings), max(timings)))
+
+    saved = statistics.median(results["eager"]) - statistics.median(results["lazy"])
+    print("lazy imports save {:.1f} ms per cache hit".format(saved))
+
+
+if __name__ == "__main__":
+    main()
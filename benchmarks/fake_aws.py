@@ -0,0 +1,200 @@
+""" A local stand-in for the sts and iam query apis with deterministic latency injection.
+
+Point boto3 at it with the AWS_ENDPOINT_URL_STS and AWS_ENDPOINT_URL_IAM environment variables::
+
+    with FakeAWS(latency=0.02) as fake:
+        os.environ.update(fake.environ())
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+import datetime
+import itertools
+import threading
+import time
+
+
+STS_NAMESPACE = "https://sts.amazonaws.com/doc/2011-06-15/"
+IAM_NAMESPACE = "https://iam.amazonaws.com/doc/2010-05-08/"
+
+
+def _xml(fields):
+    """ Render a dict as xml elements. Lists are rendered as 'member' elements. """
+    parts = []
+    for name, value in fields.items():
+        if isinstance(value, dict):
+            value = _xml(value)
+        elif isinstance(value, list):
+            value = "".join("<member>{}</member>".format(_xml(member)) for member in value)
+        else:
+            value = escape(str(value))
+        parts.append("<{0}>{1}</{0}>".format(name, value))
+    return "".join(parts)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        params = {name: values[0] for name, values in parse_qs(body).items()}
+        status, response = self.server.fake.handle(params)
+        response = response.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128    # the default of 5 drops connections from concurrent workers
+
+
+class FakeAWS:
+    """ Answer sts and iam requests for a single bastion iam user on a local port.
+
+    :param latency: The seconds to wait before answering each request, or a dict of seconds keyed by action.
+    :param throttle_every: Answer every nth request with a 'Throttling' error. Disabled when 0.
+    """
+
+    def __init__(self, latency=0.0, throttle_every=0, account="123456789012", username="bench"):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.account = account
+        self.username = username
+        self.requests = {}
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def environ(self):
+        """ Return the environment variables that point boto3 at the stand-in. """
+        return {
+            "AWS_ENDPOINT_URL_STS": self.endpoint_url,
+            "AWS_ENDPOINT_URL_IAM": self.endpoint_url,
+            "AWS_EC2_METADATA_DISABLED": "true"
+        }
+
+    def start(self):
+        self._server = _Server(("127.0.0.1", 0), _RequestHandler)
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def handle(self, params):
+        """ Return the http status and xml response for a query api request. """
+        action = params.get("Action")
+        with self._lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+            number = next(self._counter)
+
+        latency = self.latency.get(action, 0.0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        if self.throttle_every and number % self.throttle_every == 0:
+            return 400, self._error("Throttling", "Rate exceeded")
+
+        handler = getattr(self, "_" + (action or ""), None)
+        if handler is None:
+            return 400, self._error("InvalidAction", "Could not find operation {}".format(action))
+
+        result = handler(params)
+        namespace = STS_NAMESPACE if action in ("GetSessionToken", "AssumeRole", "GetCallerIdentity") else IAM_NAMESPACE
+        return 200, '<{0}Response xmlns="{1}">{2}<ResponseMetadata><RequestId>{3}</RequestId></ResponseMetadata></{0}Response>'.format(
+            action, namespace, _xml({action + "Result": result}) if result is not None else "", number)
+
+    def _error(self, code, message):
+        return "<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>{}</Message></Error>" \
+            "<RequestId>error</RequestId></ErrorResponse>".format(code, escape(message))
+
+    def _credentials(self, prefix, duration_seconds):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=int(duration_seconds))
+        return {
+            "AccessKeyId": prefix,
+            "SecretAccessKey": "secret",
+            "SessionToken": "token",
+            "Expiration": expiration.strftime("%Y-%m-%dT%H:%M:%SZ")
+        }
+
+    def _GetSessionToken(self, params):
+        return {"Credentials": self._credentials("ASIASESSION", params.get("DurationSeconds", 43200))}
+
+    def _AssumeRole(self, params):
+        role = params["RoleArn"].split("/")[-1]
+        return {
+            "Credentials": self._credentials("ASIA" + role.upper(), params.get("DurationSeconds", 3600)),
+            "AssumedRoleUser": {
+                "AssumedRoleId": "AROAEXAMPLE:" + params["RoleSessionName"],
+                "Arn": "arn:aws:sts::{}:assumed-role/{}/{}".format(self.account, role, params["RoleSessionName"])
+            }
+        }
+
+    def _GetCallerIdentity(self, params):
+        return {
+            "Arn": "arn:aws:iam::{}:user/{}".format(self.account, self.username),
+            "UserId": "AIDAEXAMPLE",
+            "Account": self.account
+        }
+
+    def _user(self):
+        return {
+            "Path": "/",
+            "UserName": self.username,
+            "UserId": "AIDAEXAMPLE",
+            "Arn": "arn:aws:iam::{}:user/{}".format(self.account, self.username),
+            "CreateDate": "2020-01-01T00:00:00Z"
+        }
+
+    def _GetUser(self, params):
+        return {"User": self._user()}
+
+    def _ListMFADevices(self, params):
+        return {
+            "MFADevices": [{
+                "UserName": self.username,
+                "SerialNumber": "arn:aws:iam::{}:mfa/{}".format(self.account, self.username),
+                "EnableDate": "2020-01-01T00:00:00Z"
+            }],
+            "IsTruncated": "false"
+        }
+
+    def _CreateAccessKey(self, params):
+        return {
+            "AccessKey": {
+                "UserName": self.username,
+                "AccessKeyId": "AKIAROTATED{:09d}".format(next(self._counter)),
+                "Status": "Active",
+                "SecretAccessKey": "rotated",
+                "CreateDate": "2020-01-01T00:00:00Z"
+            }
+        }
+
+    def _UpdateAccessKey(self, params):
+        return None
+
+    def _DeleteAccessKey(self, params):
+        return None
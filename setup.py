@@ -35,6 +35,7 @@ setup(
     entry_points={
         'console_scripts': [
             'bastion=awscli_bastion.cli:main',
+            'bastion-agent-client=awscli_bastion.agent_client:main',
             'bastion-minimal=awscli_bastion.minimal:main'
         ],
     },
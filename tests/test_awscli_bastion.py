@@ -4,10 +4,18 @@
 """Tests for `awscli_bastion` package."""
 
 
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 from click.testing import CliRunner
 
 from awscli_bastion import cli
+from awscli_bastion.cache import Cache
 # from awscli_bastion import credentials
 # from awscli_bastion import cache
 
@@ -17,9 +25,36 @@ class TestAwscli_bastion(unittest.TestCase):
 
     def setUp(self):
         """Set up test fixtures, if any."""
+        self.home = tempfile.TemporaryDirectory()
+        self.env = dict(os.environ, HOME=self.home.name, USERPROFILE=self.home.name)
+        self.aws_shared_cache_path = os.path.join(self.home.name, ".aws/cli/cache")
+        os.makedirs(self.aws_shared_cache_path)
+
+        with open(os.path.join(self.home.name, ".aws/credentials"), "w") as f:
+            f.write("[bastion]\naws_access_key_id = AKIAEXAMPLE\naws_secret_access_key = secret\n\n")
+            f.write("[bastion-sts]\nmfa_serial = arn:aws:iam::123456789012:mfa/test\n")
+            f.write("credential_process = bastion get-session-token\nsource_profile = bastion\n\n")
+            f.write("[dev-admin]\nrole_arn = arn:aws:iam::234567890123:role/admin\nsource_profile = bastion-sts\n\n")
+            f.write("[stage-poweruser]\nrole_arn = arn:aws:iam::345678901234:role/poweruser\nsource_profile = bastion-sts\n")
 
     def tearDown(self):
         """Tear down test fixtures, if any."""
+        self.home.cleanup()
+
+    def write_bastion_sts_cache(self, hours=12):
+        """Write a bastion-sts cache entry that expires in the given number of hours."""
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=hours)
+        path = os.path.join(self.aws_shared_cache_path, "bastion-sts.json")
+        # atomically, like the cache, since concurrent tests read it while it is written.
+        with open(path + ".tmp", "w") as f:
+            json.dump({
+                "AccessKeyId": "ASIAEXAMPLE",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": expiration.isoformat(),
+                "Version": 1
+            }, f)
+        os.replace(path + ".tmp", path)
 
     def test_command_line_interface(self):
         """Test the CLI."""
@@ -29,16 +64,810 @@ class TestAwscli_bastion(unittest.TestCase):
         assert 'main' in result.output
         help_result = runner.invoke(cli.main, ['--help'])
         assert help_result.exit_code == 0
-        assert '--help     Show this message and exit.' in help_result.output
+        assert '--help               Show this message and exit.' in help_result.output
 
     def test_cli_get_session_token(self):
-        """Test get_session_token."""
+        """Test get_session_token end to end against the local sts/iam stand-in."""
+        from benchmarks.fake_aws import FakeAWS
+        with FakeAWS() as fake:
+            env = dict(self.env, **fake.environ())
+            runner = CliRunner()
+            result = runner.invoke(cli.main, ["get-session-token", "--mfa-code", "123456",
+                "--write-to-aws-shared-credentials-file"], env=env)
+            assert "Setting the 'bastion-sts' profile with sts get session token credentials." in result.output
+
+            result = runner.invoke(cli.main, ["get-session-token"], env=env)
+            assert json.loads(result.output)["AccessKeyId"] == "ASIASESSION"
+
+            result = runner.invoke(cli.main, ["assume-role", "--all"], env=env)
+            assert result.exit_code == 0
+
+        assert fake.requests["GetSessionToken"] == 1
+        assert fake.requests["AssumeRole"] == 2
+        config = self.read_credentials()
+        assert config["bastion-sts"]["aws_access_key_id"] == "ASIASESSION"
+        assert config["dev-admin"]["aws_access_key_id"] == "ASIAADMIN"
+
+    def test_cli_get_session_token_cache_hit_skips_boto3(self):
+        """Test that a get_session_token cache hit does not import boto3."""
+        self.write_bastion_sts_cache()
+        script = (
+            "import sys; from awscli_bastion.cli import main\n"
+            "try:\n    main(['get-session-token'])\n"
+            "except SystemExit:\n    pass\n"
+            "sys.stderr.write(str(sorted(m for m in ('boto3', 'botocore', 'dateutil.parser', 'humanize') if m in sys.modules)))"
+        )
+        result = subprocess.run([sys.executable, "-c", script], env=self.env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        assert json.loads(result.stdout.decode())["AccessKeyId"] == "ASIAEXAMPLE"
+        assert result.stderr.decode() == "[]"
+
+    def test_cli_get_session_token_cache_hit_is_read_only(self):
+        """Test that a get_session_token cache hit parses the cache once and never rewrites it."""
+        self.write_bastion_sts_cache()
+        cache_path = os.path.join(self.aws_shared_cache_path, "bastion-sts.json")
+        mtime_ns = os.stat(cache_path).st_mtime_ns
+
+        with mock.patch("awscli_bastion.cache.json.loads", wraps=json.loads) as load:
+            result = CliRunner().invoke(cli.main, ["get-session-token"], env=self.env)
+
+        assert result.exit_code == 0
+        assert json.loads(result.output)["SessionToken"] == "token"
+        assert load.call_count == 1
+        assert os.stat(cache_path).st_mtime_ns == mtime_ns
+
+    def test_cli_get_session_token_precomputed_response(self):
+        """Test that a cache hit streams the precomputed response without parsing json."""
+        self.write_bastion_sts_cache()
+        runner = CliRunner()
+        first = runner.invoke(cli.main, ["get-session-token"], env=self.env)
+
+        with mock.patch("awscli_bastion.cache.json.loads", wraps=json.loads) as loads, \
+                mock.patch("awscli_bastion.cache.Cache.read_response", autospec=True,
+                    side_effect=Cache.read_response) as read_response:
+            second = runner.invoke(cli.main, ["get-session-token"], env=self.env)
+
+        assert loads.call_count == 0
+        assert read_response.call_count == 1
+        assert second.output == first.output
+        assert json.loads(second.output)["Version"] == 1
+
+        with mock.patch.dict(os.environ, self.env), mock.patch("awscli_bastion.cache.time.time", return_value=2 ** 40):
+            assert Cache().read_response() is None
+
+    def test_cache_version_2_schema(self):
+        """Test that version 1 caches are readable and writes use the version 2 epoch schema."""
+        from awscli_bastion.credentials import Credentials
+        self.write_bastion_sts_cache()
+
+        with mock.patch.dict(os.environ, self.env):
+            cache = Cache()
+            creds = cache.read()
+            assert isinstance(creds["ExpirationEpoch"], int)
+            assert not cache.is_expired()
+
+            cache.write({key: value for key, value in creds.items() if key != "ExpirationEpoch"})
+            with open(cache.bastion_sts_cache_path) as f:
+                cached = json.load(f)
+            assert cached["Version"] == 2
+            assert cached["ExpirationEpoch"] == creds["ExpirationEpoch"]
+            assert json.loads(cache.read_response())["Version"] == 1
+
+            credentials = Credentials()
+            credentials.set_sts_credentials("dev-admin", cached)
+            assert credentials.config["dev-admin"]["aws_session_expiration_epoch"] == str(cached["ExpirationEpoch"])
+            assert not credentials.is_expired("dev-admin")
+
+    def test_cache_read_invalidates_on_change(self):
+        """Test that the memoized cache is re-read once the file is replaced."""
+        self.write_bastion_sts_cache()
+        with mock.patch.dict(os.environ, self.env):
+            cache = Cache()
+            assert cache.read()["SessionToken"] == "token"
+            cache.write(dict(cache.read(), SessionToken="other"))
+            assert Cache().read()["SessionToken"] == "other"
+            assert not [f for f in os.listdir(self.aws_shared_cache_path) if f.endswith(".tmp")]
+
+    def fake_sts_client(self):
+        """Return a fake sts client that hands out credentials named after the role."""
+        client = mock.Mock()
+
+        def assume_role(RoleArn, RoleSessionName, DurationSeconds):
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)
+            return {"Credentials": {
+                "AccessKeyId": "ASIA" + RoleArn.split("/")[-1].upper(),
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": expiration
+            }}
+
+        client.assume_role.side_effect = assume_role
+        return client
+
+    def read_credentials(self):
+        """Read the aws shared credentials file from the test home directory."""
+        from configparser import ConfigParser
+        config = ConfigParser()
+        config.read(os.path.join(self.home.name, ".aws/credentials"))
+        return config
+
+    def test_cli_assume_role_many_profiles(self):
+        """Test assume_role with a glob, a missing profile and a single credentials file write."""
+        client = self.fake_sts_client()
+        with mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"), \
+                mock.patch("awscli_bastion.credentials.Credentials.write", autospec=True,
+                    side_effect=cli.Credentials.write) as write:
+            result = CliRunner().invoke(cli.main, ["assume-role", "*-*", "missing"], env=self.env)
+
+        assert result.exit_code == 1
+        assert "Setting the 'dev-admin' profile" in result.output
+        assert "Setting the 'stage-poweruser' profile" in result.output
+        assert "Failed to set the 'missing' profile" in result.output
+        assert write.call_count == 1
+        assert client.assume_role.call_count == 2
+
+        config = self.read_credentials()
+        assert config["dev-admin"]["aws_access_key_id"] == "ASIAADMIN"
+        assert config["stage-poweruser"]["aws_access_key_id"] == "ASIAPOWERUSER"
+
+    def test_cli_assume_role_uses_role_cache(self):
+        """Test that assume_role reuses cached credentials until the refresh window."""
+        client = self.fake_sts_client()
+        with mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            runner = CliRunner()
+            assert runner.invoke(cli.main, ["assume-role", "dev-admin"], env=self.env).exit_code == 0
+            assert runner.invoke(cli.main, ["assume-role", "dev-admin"], env=self.env).exit_code == 0
+            assert client.assume_role.call_count == 1
+
+            result = runner.invoke(cli.main, ["assume-role", "dev-admin", "--refresh-window", "3600"], env=self.env)
+            assert result.exit_code == 0
+            assert client.assume_role.call_count == 2
+
+        # the cached credentials are still found once the session name is stamped with the next day.
+        with mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", side_effect=["alice-2026-01-01", "alice-2026-01-02"]):
+            assert runner.invoke(cli.main, ["assume-role", "dev-admin"], env=self.env).exit_code == 0
+            assert runner.invoke(cli.main, ["assume-role", "dev-admin"], env=self.env).exit_code == 0
+            assert client.assume_role.call_count == 3
+
+    def test_sts_caller_identity_is_cached(self):
+        """Test that the caller identity is looked up once and reused for the role session name."""
+        from awscli_bastion.sts import STS
+        self.write_bastion_sts_cache()
+        client = mock.Mock()
+        client.get_caller_identity.return_value = {
+            "UserId": "AIDAEXAMPLE", "Account": "123456789012", "Arn": "arn:aws:iam::123456789012:user/alice"
+        }
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._get_client", return_value=client):
+            assert STS(cache=Cache()).get_caller_identity()["UserName"] == "alice"
+            assert STS(cache=Cache())._get_role_session_name().startswith("alice-")
+
+        assert client.get_caller_identity.call_count == 1
+
+    def test_cli_refresh_only_due_profiles(self):
+        """Test that refresh batches the profiles that are due and skips fresh ones."""
+        client = self.fake_sts_client()
+        with mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            runner = CliRunner()
+            result = runner.invoke(cli.main, ["refresh"], env=self.env)
+            assert result.exit_code == 0
+            assert client.assume_role.call_count == 2
+
+            result = runner.invoke(cli.main, ["refresh"], env=self.env)
+            assert "No profiles are due for a refresh." in result.output
+            assert client.assume_role.call_count == 2
+
+            result = runner.invoke(cli.main, ["refresh", "dev-*", "--lead-time", "3600", "--duration-seconds", "7200"], env=self.env)
+            assert "Setting the 'dev-admin' profile" in result.output
+            assert "stage-poweruser" not in result.output
+            assert client.assume_role.call_count == 3
+
+    def test_cli_refresh_rejects_short_duration(self):
+        """Test that refresh rejects credentials that would be due again as soon as they are refreshed."""
+        client = self.fake_sts_client()
+        with mock.patch("awscli_bastion.sts.STS._get_client", return_value=client):
+            runner = CliRunner()
+            for args in (["--duration-seconds", "900"], ["--duration-seconds", "960"], ["--lead-time", "3600"]):
+                result = runner.invoke(cli.main, ["refresh", "--watch"] + args, env=self.env)
+                assert result.exit_code == 2
+                assert "--duration-seconds" in result.output
+            assert client.assume_role.call_count == 0
+
+    def test_refresher_recreates_expired_sts_client(self):
+        """Test that a long-running refresher creates its sts client again when the bastion-sts credentials change."""
+        from awscli_bastion.refresh import Refresher
+        from botocore.exceptions import ClientError
+        expired = self.fake_sts_client()
+        expired.assume_role.side_effect = ClientError({"Error": {"Code": "ExpiredToken"}}, "AssumeRole")
+        clients = [expired, expired, self.fake_sts_client()]
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._create_client", side_effect=clients) as create_client, \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            refresher = Refresher(patterns=["dev-admin"], retry_interval=0)
+            assert isinstance(refresher.refresh_due()["dev-admin"], ClientError)
+            assert create_client.call_count == 2
+
+            # 'bastion get-session-token --write-to-aws-shared-credentials-file' writes fresh credentials.
+            with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+                f.write("\n[bastion-sts-fresh]\naws_session_token = fresh\n")
+            assert refresher.refresh_due()["dev-admin"]["AccessKeyId"] == "ASIAADMIN"
+            assert create_client.call_count == 3
+
+    def test_cli_assume_role_requires_profile(self):
+        """Test that assume_role without profiles or --all is a usage error."""
+        result = CliRunner().invoke(cli.main, ["assume-role"], env=self.env)
+        assert result.exit_code == 2
+
+    def test_agent_serves_credentials(self):
+        """Test that the agent answers the client from memory over a unix socket."""
+        from awscli_bastion.agent import Agent
+        from awscli_bastion.agent_client import request
+        import threading
+        import time
+
+        self.write_bastion_sts_cache()
+        client = self.fake_sts_client()
+        socket_path = os.path.join(self.home.name, "agent.sock")
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            bastion_agent = Agent(socket_path=socket_path)
+            thread = threading.Thread(target=bastion_agent.serve_forever, daemon=True)
+            thread.start()
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+
+            try:
+                assert json.loads(request("dev-admin", socket_path))["AccessKeyId"] == "ASIAADMIN"
+                assert json.loads(request("dev-admin", socket_path))["Version"] == 1
+                assert json.loads(request("bastion-sts", socket_path))["AccessKeyId"] == "ASIAEXAMPLE"
+                with self.assertRaises(RuntimeError):
+                    request("missing", socket_path)
+            finally:
+                bastion_agent.stop()
+                thread.join()
+
+        assert client.assume_role.call_count == 1
+        assert not os.path.exists(socket_path)
+
+    def test_agent_recreates_expired_sts_client(self):
+        """Test that the agent creates its sts client again after get-session-token writes fresh credentials."""
+        from awscli_bastion.agent import Agent
+        from botocore.exceptions import ClientError
+        expired = self.fake_sts_client()
+        expired.assume_role.side_effect = ClientError({"Error": {"Code": "ExpiredToken"}}, "AssumeRole")
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._create_client", side_effect=[expired, expired, self.fake_sts_client()]), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            bastion_agent = Agent(socket_path=os.path.join(self.home.name, "agent.sock"))
+            with self.assertRaises(ClientError):
+                bastion_agent.get_credentials("dev-admin")
+
+            with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+                f.write("\n[bastion-sts-fresh]\naws_session_token = fresh\n")
+            bastion_agent.reload_if_changed()
+            assert bastion_agent.get_credentials("dev-admin")["AccessKeyId"] == "ASIAADMIN"
+
+    def test_sts_get_session_token_single_flight(self):
+        """Test that concurrent cache misses refresh the bastion-sts credentials once."""
+        from awscli_bastion.credentials import Credentials
+        from awscli_bastion.sts import STS
+        import threading
+        import time
+
+        self.write_bastion_sts_cache(hours=-1)
+
+        def refresh(sts, mfa_code, mfa_serial, duration_seconds):
+            time.sleep(0.2)
+            self.write_bastion_sts_cache()
+            return sts.cache.read()
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._refresh_session_token", autospec=True, side_effect=refresh) as refresh_mock:
+            results = []
+
+            def get_session_token():
+                results.append(STS(credentials=Credentials(), cache=Cache()).get_session_token())
+
+            threads = [threading.Thread(target=get_session_token) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert refresh_mock.call_count == 1
+        assert [creds["SessionToken"] for creds in results] == ["token"] * 8
+
+    def test_credentials_write_merges_concurrent_changes(self):
+        """Test that writes only merge their own changes into the latest credentials file."""
+        from awscli_bastion.credentials import Credentials
+
+        with mock.patch.dict(os.environ, self.env):
+            first, second = Credentials(), Credentials()
+            first.config["dev-admin"]["aws_session_token"] = "first"
+            del first.config["stage-poweruser"]["source_profile"]
+            second.config["stage-poweruser"]["aws_session_token"] = "second"
+            second.config["new-profile"] = {"role_arn": "arn:aws:iam::456789012345:role/spectator"}
+            first.write()
+            second.write()
+
+        config = self.read_credentials()
+        assert config["dev-admin"]["aws_session_token"] == "first"
+        assert config["stage-poweruser"]["aws_session_token"] == "second"
+        assert "source_profile" not in config["stage-poweruser"]
+        assert config["new-profile"]["role_arn"] == "arn:aws:iam::456789012345:role/spectator"
+        assert config["bastion"]["aws_access_key_id"] == "AKIAEXAMPLE"
+        assert not [f for f in os.listdir(os.path.join(self.home.name, ".aws")) if f.endswith(".tmp")]
+
+    def test_credentials_write_keeps_symlink(self):
+        """Test that writing a symlinked credentials file writes through the link."""
+        from awscli_bastion.credentials import Credentials
+        credentials_path = os.path.join(self.home.name, ".aws/credentials")
+        target_path = os.path.join(self.home.name, "dotfiles-credentials")
+        os.replace(credentials_path, target_path)
+        os.symlink(target_path, credentials_path)
+
+        with mock.patch.dict(os.environ, self.env):
+            credentials = Credentials()
+            credentials.set("dev-admin", {"aws_session_token": "linked"})
+            credentials.write()
+
+        assert os.path.islink(credentials_path)
+        assert self.read_credentials()["dev-admin"]["aws_session_token"] == "linked"
+
+    def test_session_refreshes_in_process(self):
+        """Test that awscli_bastion.session() refreshes assume role credentials without a subprocess."""
+        import awscli_bastion
+        calls = []
+
+        def assume_role(sts, profile, duration_seconds, refresh_window):
+            assert sts.session is not None
+            calls.append(profile)
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=5 * len(calls) ** 3)
+            return {
+                "AccessKeyId": "ASIA{}".format(len(calls)),
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": expiration.isoformat()
+            }
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._assume_role", autospec=True, side_effect=assume_role), \
+                mock.patch("subprocess.Popen") as popen:
+            session = awscli_bastion.session("dev-admin")
+            credentials = session.get_credentials()
+            assert credentials.get_frozen_credentials().access_key == "ASIA2"
+            assert credentials.get_frozen_credentials().access_key == "ASIA2"
+
+        assert calls == ["dev-admin", "dev-admin"]
+        assert popen.call_count == 0
+
+    def test_session_failed_refresh_raises(self):
+        """Test that a failed awscli_bastion.session() refresh raises an exception rather than exiting."""
+        import awscli_bastion
+        from botocore.exceptions import ClientError
+        client = mock.Mock()
+        client.get_session_token.side_effect = ClientError({"Error": {"Code": "AccessDenied"}}, "GetSessionToken")
+
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._create_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_mfa_code", return_value="123456"), \
+                mock.patch("getpass.getpass") as getpass:
+            with self.assertRaises(ClientError):
+                awscli_bastion.session().get_credentials()
+            with self.assertRaises(RuntimeError):
+                awscli_bastion.session(mfa_prompt=False).get_credentials()
+
+        assert client.get_session_token.call_count == 1
+        assert getpass.call_count == 0
+
+    def test_cli_env(self):
+        """Test that env prints the cached credentials without writing the credentials file."""
+        client = self.fake_sts_client()
+        credentials_path = os.path.join(self.home.name, ".aws/credentials")
+        mtime_ns = os.stat(credentials_path).st_mtime_ns
+
+        with mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            runner = CliRunner()
+            bash = runner.invoke(cli.main, ["env", "dev-admin"], env=self.env)
+            fish = runner.invoke(cli.main, ["env", "dev-admin", "--shell", "fish"], env=self.env)
+            as_json = runner.invoke(cli.main, ["env", "dev-admin", "--shell", "json"], env=self.env)
+
+        assert "export AWS_ACCESS_KEY_ID=ASIAADMIN" in bash.output
+        assert "set -gx AWS_SESSION_TOKEN token;" in fish.output
+        assert json.loads(as_json.output)["AWS_SECRET_ACCESS_KEY"] == "secret"
+        assert client.assume_role.call_count == 1
+        assert os.stat(credentials_path).st_mtime_ns == mtime_ns
+
+        # errors go to stderr, so 'eval "$(bastion env ...)"' never evaluates them.
+        with open(credentials_path, "a") as f:
+            f.write("\n[partner-sts]\nsource_profile = bastion\n")
+        result = subprocess.run([sys.executable, "-m", "awscli_bastion.cli", "env", "partner-sts", "--bastion-sts", "partner-sts"],
+            env=dict(self.env, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert result.returncode == 1
+        assert result.stdout == b""
+        assert b"mfa_serial" in result.stderr
+
+    def test_cli_credential_process(self):
+        """Test that credential_process sources the cached bastion-sts credentials and caches the role."""
+        self.write_bastion_sts_cache()
+        client = self.fake_sts_client()
+        credentials_path = os.path.join(self.home.name, ".aws/credentials")
+        mtime_ns = os.stat(credentials_path).st_mtime_ns
+
+        with mock.patch("boto3.Session") as session, \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            session.return_value.client.return_value = client
+            runner = CliRunner()
+            first = runner.invoke(cli.main, ["credential-process", "dev-admin"], env=self.env)
+            second = runner.invoke(cli.main, ["credential-process", "dev-admin"], env=self.env)
+            missing = runner.invoke(cli.main, ["credential-process", "missing"], env=self.env)
+
+        assert json.loads(first.output)["AccessKeyId"] == "ASIAADMIN"
+        assert json.loads(first.output)["Version"] == 1
+        assert second.output == first.output
+        assert missing.exit_code == 1
+        assert session.call_args[1]["aws_session_token"] == "token"
+        assert client.assume_role.call_count == 1
+        assert os.stat(credentials_path).st_mtime_ns == mtime_ns
+
+    def test_credentials_index(self):
+        """Test that lookups use the compiled index until the credentials file changes."""
+        from awscli_bastion.credentials import Credentials
+
+        with mock.patch.dict(os.environ, self.env):
+            assert Credentials().get_mfa_serial() == "arn:aws:iam::123456789012:mfa/test"
+
+            with mock.patch("awscli_bastion.backends.ConfigParser.read") as read:
+                credentials = Credentials()
+                assert credentials.get("dev-admin", "role_arn") == "arn:aws:iam::234567890123:role/admin"
+                assert credentials.get_role_profiles() == ["dev-admin", "stage-poweruser"]
+                assert read.call_count == 0
+
+            with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+                f.write("\n[prod-spectator]\nrole_arn = arn:aws:iam::456789012345:role/spectator\n")
+            assert Credentials().get_role_profiles() == ["dev-admin", "stage-poweruser", "prod-spectator"]
+
+    def test_sqlite_backend(self):
+        """Test that migrate-backend copies profiles to the sqlite backend, which upserts single profiles."""
+        from awscli_bastion.credentials import Credentials
+
+        self.write_bastion_sts_cache()
+        result = CliRunner().invoke(cli.main, ["migrate-backend", "file", "sqlite"], env=self.env)
+        assert result.exit_code == 0
+        assert "Copied 4 profiles and 1 cache entries" in result.output
+
+        credentials_path = os.path.join(self.home.name, ".aws/credentials")
+        mtime_ns = os.stat(credentials_path).st_mtime_ns
+        with mock.patch.dict(os.environ, dict(self.env, BASTION_BACKEND="sqlite")):
+            credentials = Credentials()
+            assert credentials.get_role_profiles() == ["dev-admin", "stage-poweruser"]
+            credentials.set_sts_credentials("dev-admin", {
+                "AccessKeyId": "ASIAADMIN", "SecretAccessKey": "secret", "SessionToken": "token",
+                "Expiration": "2100-01-01T00:00:00+00:00"
+            })
+            credentials.write()
+            assert Credentials().get("dev-admin", "aws_access_key_id") == "ASIAADMIN"
+            assert Credentials().get_expiration_epoch("dev-admin") == 4102444800
+            assert Cache().read()["AccessKeyId"] == "ASIAEXAMPLE"
+
+            connection = Credentials().backend._connect()
+            assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert os.stat(credentials_path).st_mtime_ns == mtime_ns
+
+    def test_incomplete_backend_fails_on_creation(self):
+        """Test that a backend missing part of the interface cannot be created."""
+        from awscli_bastion.backends import Backend
+
+        class IncompleteBackend(Backend):
+            def load_profiles(self):
+                return {}
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend()
+
+    def test_retry_throttled_assume_roles(self):
+        """Test that throttled assume_role calls are retried, counted and slow down the shared rate limiter."""
+        from botocore.exceptions import ClientError
+        from awscli_bastion.credentials import Credentials
+        from awscli_bastion.retry import Retrier, TokenBucket, classify
+        from awscli_bastion.sts import STS
+
+        throttling = ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}}, "AssumeRole")
+        assert classify(throttling) == "throttled"
+        assert classify(ClientError({"Error": {"Code": "AccessDenied"}}, "AssumeRole")) == "fatal"
+
+        client = self.fake_sts_client()
+        assume_role = client.assume_role.side_effect
+        calls = []
+
+        def throttle_first_call(**kwargs):
+            calls.append(kwargs["RoleArn"])
+            if calls.count(kwargs["RoleArn"]) == 1:
+                raise throttling
+            return assume_role(**kwargs)
+
+        client.assume_role.side_effect = throttle_first_call
+        retrier = Retrier(base_delay=0.001, rate_limiter=TokenBucket())
+        with mock.patch.dict(os.environ, self.env), \
+                mock.patch("awscli_bastion.sts.STS._get_client", return_value=client), \
+                mock.patch("awscli_bastion.sts.STS._get_role_session_name", return_value="test"):
+            results = STS(credentials=Credentials(), retrier=retrier).assume_roles(["dev-admin", "stage-poweruser"])
+
+        assert results["dev-admin"]["AccessKeyId"] == "ASIAADMIN"
+        assert results["stage-poweruser"]["AccessKeyId"] == "ASIAPOWERUSER"
+        assert (retrier.retries, retrier.throttles) == (2, 2)
+        assert retrier.rate_limiter.rate >= 1     # limited since the first throttle
+
+    def test_sts_endpoint_selection(self):
+        """Test that the options win the sts endpoint precedence and that probe-endpoints stores the fastest endpoint for this host."""
+        from benchmarks.fake_aws import FakeAWS
+        from awscli_bastion import endpoints
+        from awscli_bastion.credentials import Credentials
+
+        with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+            f.write("\n[bastion-eu]\nsts_regional_endpoints = regional\n")
+            f.write("\n[bastion-ap]\nsts_endpoint_url = https://sts.ap-southeast-2.amazonaws.com\n")
+        env = {name: value for name, value in self.env.items() if not name.startswith("AWS_")}
+        with FakeAWS() as fake, mock.patch.dict(os.environ, env, clear=True):
+            result = CliRunner().invoke(cli.main, ["probe-endpoints", "--endpoint-url", fake.endpoint_url,
+                "--samples", "0"], env=env)
+            assert result.exit_code == 2
+
+            result = CliRunner().invoke(cli.main, ["probe-endpoints", "--endpoint-url", fake.endpoint_url], env=env)
+            assert result.exit_code == 0
+            assert "Storing {} as the sts endpoint".format(fake.endpoint_url) in result.output
+
+            credentials = Credentials()
+            assert endpoints.resolve(credentials, ["bastion-sts"], "eu-central-1") == ("us-east-1", fake.endpoint_url)
+            assert endpoints.resolve(credentials, ["bastion-eu"], "eu-central-1") == \
+                ("eu-central-1", "https://sts.eu-central-1.amazonaws.com")
+            assert endpoints.resolve(credentials, ["bastion-ap"], "eu-central-1") == \
+                ("ap-southeast-2", "https://sts.ap-southeast-2.amazonaws.com")
+            assert endpoints.resolve(credentials, ["bastion-eu"], "eu-central-1", regional_endpoints="legacy") == \
+                ("us-east-1", "https://sts.amazonaws.com")
+            assert endpoints.resolve(credentials, ["bastion-eu"], "eu-central-1", endpoint_url="http://localhost") == \
+                ("eu-central-1", "http://localhost")
+            assert endpoints.resolve(credentials, ["bastion-eu"], "us-west-2",
+                endpoint_url="https://sts.eu-central-1.amazonaws.com") == \
+                ("eu-central-1", "https://sts.eu-central-1.amazonaws.com")
+            assert endpoints.resolve(credentials, ["bastion-ap"], "eu-central-1", regional_endpoints="regional") == \
+                ("eu-central-1", "https://sts.eu-central-1.amazonaws.com")
+            with mock.patch.dict(os.environ, {"AWS_ENDPOINT_URL_STS": "http://localhost"}):
+                assert endpoints.resolve(credentials, ["bastion-ap"], "eu-central-1") == ("eu-central-1", None)
+                assert endpoints.resolve(credentials, ["bastion-ap"], "eu-central-1", regional_endpoints="legacy") == \
+                    ("us-east-1", "https://sts.amazonaws.com")
+
+            env["AWS_EC2_METADATA_DISABLED"] = "true"
+            result = CliRunner().invoke(cli.main, ["get-session-token", "--mfa-code", "123456"], env=env)
+            assert json.loads(result.output)["AccessKeyId"] == "ASIASESSION"
+        assert fake.requests["GetSessionToken"] == 1
+
+    def test_cli_timings(self):
+        """Test that timings are appended as json lines per phase and keep stdout clean."""
+        self.write_bastion_sts_cache()
+        timings_path = os.path.join(self.home.name, "timings.jsonl")
+        env = dict(self.env, BASTION_TIMINGS_FILE=timings_path)
+
+        runner = CliRunner()
+        for _ in range(2):
+            result = runner.invoke(cli.main, ["get-session-token"], env=env)
+            assert json.loads(result.output)["AccessKeyId"] == "ASIAEXAMPLE"
+
+        with open(timings_path) as f:
+            lines = [json.loads(line) for line in f]
+        phases = [(line["phase"], line.get("cache")) for line in lines]
+        # the legacy cache has no precomputed response, so the first call reads and writes it.
+        assert ("Cache.read_response", "miss") in phases[:3]
+        assert ("Cache.is_expired", "hit") in phases
+        assert ("STS.get_session_token", None) in phases
+        assert phases[-3:] == [("imports", None), ("Cache.read_response", "hit"), ("command", None)]
+        assert all(line["duration_ms"] >= 0 and line["pid"] == os.getpid() for line in lines)
+
+    def test_cli_metrics_and_stats(self):
+        """Test that cache lookups and sts calls are recorded and summarized by stats."""
+        from benchmarks.fake_aws import FakeAWS
+        metrics_path = os.path.join(self.home.name, "metrics.lp")
+        prometheus_path = os.path.join(self.home.name, "bastion.prom")
+
+        with FakeAWS() as fake:
+            env = dict(self.env, BASTION_METRICS_FILE=metrics_path, **fake.environ())
+            runner = CliRunner()
+            for args in (["get-session-token", "--mfa-code", "123456", "--write-to-aws-shared-credentials-file"],
+                    ["get-session-token"],
+                    ["assume-role", "dev-admin"], ["assume-role", "dev-admin"]):
+                assert runner.invoke(cli.main, args, env=env).exit_code == 0
+
+            result = runner.invoke(cli.main, ["stats", "--json", "--prometheus", prometheus_path], env=env)
+        summary = json.loads(result.output)
+        cache = {(row["profile"], row["kind"]): row for row in summary["cache"]}
+        assert (cache["bastion-sts", "session"]["hits"], cache["bastion-sts", "session"]["misses"]) == (1, 1)
+        assert (cache["dev-admin", "role"]["hits"], cache["dev-admin", "role"]["misses"]) == (1, 1)
+        assert 0 < cache["dev-admin", "role"]["remaining_seconds_min"] <= 3600
+        assert {row["operation"]: row["calls"] for row in summary["aws_calls"]}["assume_role"] == 1
+
+        with open(prometheus_path) as f:
+            prometheus = f.read()
+        assert 'bastion_cache_lookups_total{profile="dev-admin",kind="role",result="hit"} 1' in prometheus
+        assert 'bastion_aws_call_duration_seconds_count{operation="get_session_token",result="ok"} 1' in prometheus
+
+        result = runner.invoke(cli.main, ["stats"], env=env)
+        assert result.exit_code == 0
+        assert "dev-admin" in result.output
+
+        from awscli_bastion.metrics import percentile
+        assert [round(percentile([1, 2, 3, 4, 10], p), 6) for p in (0, 50, 95, 100)] == [1, 3, 8.8, 10]
+        assert percentile([7], 99) == 7
+
+    def test_cli_profile_out_and_import_times(self):
+        """Test that a command is profiled to a pstats file and that import times are broken down per package."""
+        import pstats
+        self.write_bastion_sts_cache()
+        profile_path = os.path.join(self.home.name, "bastion.prof")
+
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ["--profile-out", profile_path, "get-expiration"], env=self.env)
+        assert result.exit_code == 0
+        assert "The top 25 functions by cumulative time" in result.output
+        assert any(function[2] == "get_expiration" for function in pstats.Stats(profile_path).stats)
+
+        result = runner.invoke(cli.main, ["import-times", "--top", "1000", "get-expiration"], env=self.env)
+        assert result.exit_code == 0
+        assert "awscli_bastion.cli" in result.output
+        assert "bastion-sts cached credentials" not in result.output
 
     def test_cli_set_default(self):
         """Test set_default."""
+        result = CliRunner().invoke(cli.main, ["set-default", "dev-admin"], env=self.env)
+        assert result.exit_code == 0
+        assert "Setting the 'default' profile with attributes from the 'dev-admin' profile." in result.output
+        assert self.read_credentials()["default"]["role_arn"] == "arn:aws:iam::234567890123:role/admin"
 
     def test_cli_reset_cache(self):
-        """Test reset_cache."""
+        """Test that clear_cache removes every cache entry and the sts credentials."""
+        self.write_bastion_sts_cache()
+        with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+            f.write("aws_session_token = token\naws_session_expiration_epoch = 4102444800\n")
+
+        lock_path = os.path.join(self.aws_shared_cache_path, "bastion-sts.json.lock")
+        open(lock_path, "w").close()
+        os.utime(lock_path, (0, 0))
+
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ["clear-cache", "--older-than", "60"], env=self.env)
+        assert result.exit_code == 0
+        assert os.path.exists(lock_path)
+
+        result = runner.invoke(cli.main, ["clear-cache"], env=self.env)
+        assert result.exit_code == 0
+        assert not [name for name in os.listdir(self.aws_shared_cache_path) if name.endswith(".json")]
+        assert "aws_session_token" not in self.read_credentials()["stage-poweruser"]
+        assert os.path.exists(lock_path)
+        assert os.path.exists(os.path.join(self.aws_shared_cache_path, "bastion-credentials.index"))
+
+    def test_cli_clear_cache_selective(self):
+        """Test that clear_cache --expired-only keeps live credentials and that gc never deletes them."""
+        self.write_bastion_sts_cache()
+        with open(os.path.join(self.aws_shared_cache_path, "awscli-expired.json"), "w") as f:
+            json.dump({"Credentials": {"Expiration": "2000-01-01T00:00:00Z"}}, f)
+        with open(os.path.join(self.aws_shared_cache_path, "stale.tmp"), "w") as f:
+            f.write("partial")
+        with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+            f.write("aws_session_token = expired\naws_session_expiration_epoch = 946684800\n")
+
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ["clear-cache", "--expired-only", "--dry-run"], env=self.env)
+        assert "- Would delete the 'awscli-expired.json' file." in result.output
+        assert "- STS credentials would be removed from the stage-poweruser profile." in result.output
+        assert os.path.exists(os.path.join(self.aws_shared_cache_path, "awscli-expired.json"))
+
+        result = runner.invoke(cli.main, ["clear-cache", "--expired-only", "--profile", "stage-*"], env=self.env)
+        assert result.exit_code == 0
+        assert "- STS credentials were removed from the stage-poweruser profile." in result.output
+        assert os.path.exists(os.path.join(self.aws_shared_cache_path, "awscli-expired.json"))
+
+        result = runner.invoke(cli.main, ["clear-cache", "--max-entries", "1"], env=self.env)
+        assert result.exit_code == 0
+        assert sorted(os.listdir(self.aws_shared_cache_path)) == ["bastion-credentials.index", "bastion-sts.json"]
+
+    def test_cache_partitions(self):
+        """Test that each bastion/bastion-sts pair has its own cache entries, lock and expiration."""
+        def creds(hours):
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=hours)
+            return {"AccessKeyId": "ASIA{}".format(hours), "SecretAccessKey": "secret", "SessionToken": "token",
+                "Expiration": expiration.isoformat()}
+
+        self.write_bastion_sts_cache(hours=12)
+        with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+            f.write("\n[partner-sts]\nmfa_serial = arn:aws:iam::567890123456:mfa/test\n")
+        with mock.patch.dict(os.environ, self.env):
+            cache = Cache()
+            partner_cache = Cache(bastion="partner", bastion_sts="partner-sts")
+            assert cache.read()["AccessKeyId"] == "ASIAEXAMPLE"     # the legacy entry
+            assert partner_cache.is_expired()
+            assert cache.get_lock().path != partner_cache.get_lock().path
+            assert Cache(region="eu-west-1").partition != cache.partition
+
+            cache.write(creds(2))
+            partner_cache.write(creds(3))
+            assert Cache().read()["AccessKeyId"] == "ASIA2"
+            assert Cache(bastion="partner", bastion_sts="partner-sts").read()["AccessKeyId"] == "ASIA3"
+            assert Cache(bastion="partner", bastion_sts="partner-sts", mfa_serial="arn:aws:iam::1:mfa/other").is_expired()
+            assert "bastion-sts.json" not in os.listdir(self.aws_shared_cache_path)
+
+            # a cache hit never reads the credentials file, the mfa serial is only checked when it is known.
+            assert Cache(mfa_serial="arn:aws:iam::1:mfa/other").partition == cache.partition
+            with mock.patch("awscli_bastion.cache.Credentials") as credentials:
+                assert Cache().read_response() is not None
+                assert not Cache().is_expired()
+            assert credentials.call_count == 0
+            assert Cache(mfa_serial="arn:aws:iam::123456789012:mfa/test").read_response() is not None
+            assert Cache(mfa_serial="arn:aws:iam::1:mfa/other").read_response() is None
+            assert Cache().get_entry_expiration(cache.partition + ".response") == cache.read()["ExpirationEpoch"]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ["get-expiration", "--bastion-sts", "partner-sts", "--bastion", "partner"],
+            env=self.env)
+        assert "The partner-sts cached credentials will expire" in result.output
+
+        result = runner.invoke(cli.main, ["get-expiration", "--all", "--json"], env=self.env)
+        assert [row["name"] for row in json.loads(result.output)] == ["bastion-sts (us-west-2)", "partner-sts (us-west-2)"]
+
+        with mock.patch("awscli_bastion.cache.Cache.read_identity", autospec=True, return_value=None) as read_identity, \
+                mock.patch("awscli_bastion.credentials.Credentials.set_mfa_serial"):
+            result = runner.invoke(cli.main, ["set-mfa-serial", "--bastion", "partner", "--bastion-sts", "partner-sts"],
+                env=self.env)
+        assert result.exit_code == 0
+        assert read_identity.call_args[0][0].partition == partner_cache.partition
+
+        # clearing a bastion-sts profile clears its partition in every region and leaves the other bastions alone.
+        with mock.patch.dict(os.environ, self.env):
+            eu_cache = Cache(region="eu-west-1")
+            eu_cache.write(creds(4))
+        result = runner.invoke(cli.main, ["clear-cache", "--profile", "bastion-sts"], env=self.env)
+        assert result.exit_code == 0
+        names = os.listdir(self.aws_shared_cache_path)
+        assert eu_cache.partition + ".json" not in names and cache.partition + ".json" not in names
+        assert partner_cache.partition + ".json" in names
 
     def test_cli_get_expiration_delta(self):
-        """Test get_expiration_delta."""
+        """Test get_expiration with cached and expired bastion-sts credentials."""
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ["get-expiration"], env=self.env)
+        assert "The bastion-sts cached credentials are expired." in result.output
+
+        self.write_bastion_sts_cache(hours=3.5)
+        result = runner.invoke(cli.main, ["get-expiration"], env=self.env)
+        assert result.exit_code == 0
+        assert "The bastion-sts cached credentials will expire 3 hours from now." in result.output
+
+    def test_cli_get_expiration_all_json(self):
+        """Test that get_expiration --all --json reports profiles and cache entries sorted by lifetime."""
+        self.write_bastion_sts_cache(hours=2)
+        with open(os.path.join(self.aws_shared_cache_path, "awscli-role.json"), "w") as f:
+            json.dump({"Credentials": {"Expiration": "2000-01-01T00:00:00Z"}}, f)
+        with open(os.path.join(self.home.name, ".aws/credentials"), "a") as f:
+            # away from a minute boundary, so every humanize version rounds it to 10 minutes.
+            f.write("aws_session_expiration_epoch = {}\n".format(int(datetime.datetime.now().timestamp()) + 630))
+
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ["get-expiration", "--all", "--json"], env=self.env)
+        rows = json.loads(result.output)
+        assert [(row["name"], row["source"]) for row in rows] == [
+            ("awscli-role", "cache"), ("stage-poweruser", "credentials"), ("bastion-sts", "cache")
+        ]
+        assert 0 < rows[1]["remaining_seconds"] <= 630
+
+        result = runner.invoke(cli.main, ["get-expiration", "--all"], env=self.env)
+        assert result.exit_code == 0
+        assert "stage-poweruser  credentials  will expire in 10 minutes" in result.output